@@ -0,0 +1,326 @@
+#!/usr/bin/python
+"""Helpers to manage the monitor child processes of the supervisor.
+
+ChildRegistry is the supervisor's record of which process monitors which
+cluster. The registry learns about exits through SIGCHLD: the signal wakes
+up the main loop through a pipe (signal.set_wakeup_fd) and only then are the
+registered processes polled, so checking whether a cluster has a live
+monitor is a dictionary lookup.
+
+PreforkPool keeps a few processes forked ahead of time, idle and waiting
+for work, so that starting a monitor for a new cluster is a message over a
+pipe instead of a fork.
+"""
+
+import os, time, signal, fcntl, errno
+import ctypes, ctypes.util
+import multiprocessing
+from collections import deque
+
+import log
+
+_logger = log.get_logger("lib.children", relative_name=True)
+
+# How often we look for exited children while stopping them. We start
+# small so that quick exits are noticed quickly and back off up to the max.
+MIN_REAP_INTERVAL = 0.001   # in seconds
+MAX_REAP_INTERVAL = 0.05    # in seconds
+
+# After SIGKILL the kernel takes it from here; wait at most this long.
+KILL_WAIT = 5               # in seconds
+
+# see <linux/prctl.h>
+PR_SET_PDEATHSIG = 1
+
+
+def set_parent_death_signal(signum):
+    '''
+    Ask the kernel to send signum to the calling process when its parent
+    dies (Linux only). Returns True on success.
+    '''
+    libc_name = ctypes.util.find_library('c')
+    if not libc_name:
+        return False
+    try:
+        libc = ctypes.CDLL(libc_name, use_errno=True)
+        return libc.prctl(PR_SET_PDEATHSIG, signum, 0, 0, 0) == 0
+    except (OSError, AttributeError), ex:
+        _logger.debug("prctl(PR_SET_PDEATHSIG) not available: %s", ex)
+    return False
+
+
+class StopResult(object):
+    """Outcome of stopping one child process
+    """
+    def __init__(self, key, pid, latency, killed):
+        self.key = key
+        self.pid = pid
+        self.latency = latency  # seconds from SIGTERM to exit
+        self.killed = killed    # True if it needed a SIGKILL
+
+    def __repr__(self):
+        return "StopResult(%r, pid=%s, latency=%.3f, killed=%s)" \
+               % (self.key, self.pid, self.latency, self.killed)
+
+
+def stop_processes(phandles, timeout):
+    '''
+    Stop a set of multiprocessing.Process objects at once. phandles maps
+    a caller chosen key (e.g. the cluster id) to the process.
+
+    All the processes get SIGTERM first, then they are reaped as they exit
+    against a single deadline of timeout seconds which is shared by all of
+    them. Whatever is still alive at the deadline gets SIGKILL. Stopping
+    any number of processes therefore takes at most timeout + KILL_WAIT
+    seconds.
+
+    Returns a list of StopResult, one per process that was alive.
+    '''
+    start = time.time()
+    pending = {}
+    for key, phandle in phandles.items():
+        if phandle.is_alive():
+            try:
+                phandle.terminate()
+            except OSError, ex:
+                # exited in the meantime
+                _logger.debug("Failed to terminate %s: %s", phandle.pid, ex)
+            pending[key] = phandle
+
+    results = []
+    deadline = start + timeout
+    interval = MIN_REAP_INTERVAL
+    while pending:
+        now = time.time()
+        # is_alive() reaps the child with a non blocking waitpid()
+        for key, phandle in pending.items():
+            if not phandle.is_alive():
+                results.append(StopResult(key, phandle.pid, now - start, False))
+                del pending[key]
+        if not pending or now >= deadline:
+            break
+        time.sleep(min(interval, max(deadline - now, 0)))
+        interval = min(interval * 2, MAX_REAP_INTERVAL)
+
+    if pending:
+        _logger.warn("%d processes did not exit within %d seconds, " \
+                     "killing them now" % (len(pending), timeout))
+        for key, phandle in pending.items():
+            try:
+                os.kill(phandle.pid, signal.SIGKILL)
+            except OSError:
+                # exited just now
+                pass
+        kill_deadline = time.time() + KILL_WAIT
+        for key, phandle in pending.items():
+            # now join it so as to collect resources
+            phandle.join(max(kill_deadline - time.time(), 0))
+            results.append(StopResult(key, phandle.pid, \
+                                      time.time() - start, True))
+    return results
+
+
+class ChildRegistry(object):
+    """Authoritative map of key (cluster id) to the multiprocessing.Process
+    monitoring it, and to the sending end of its control pipe if it has one.
+    """
+    def __init__(self):
+        self._by_key = {}
+        self._started = {}
+        self._conns = {}
+        self._wakeup_r = -1
+        self._wakeup_w = -1
+        self._sigchld = False
+
+    def __contains__(self, key):
+        return key in self._by_key
+
+    def __len__(self):
+        return len(self._by_key)
+
+    def get(self, key, default=None):
+        return self._by_key.get(key, default)
+
+    def items(self):
+        return self._by_key.items()
+
+    def add(self, key, phandle, conn=None):
+        self._by_key[key] = phandle
+        self._started[key] = time.time()
+        if conn:
+            self._conns[key] = conn
+
+    def remove(self, key):
+        self._started.pop(key, None)
+        conn = self._conns.pop(key, None)
+        if conn:
+            conn.close()
+        return self._by_key.pop(key, None)
+
+    def send_all(self, message):
+        '''
+        Send message to every child with a control pipe. Returns the number
+        of children it was sent to.
+        '''
+        sent = 0
+        for key, conn in self._conns.items():
+            try:
+                conn.send(message)
+                sent += 1
+            except (IOError, OSError), ex:
+                # it is exiting, we will hear about it through SIGCHLD
+                _logger.debug("Failed to send %s to %s: %s", \
+                              message[0], key, ex)
+        return sent
+
+    def _on_sigchld(self, signum, frame):
+        self._sigchld = True
+
+    def install(self):
+        '''
+        Start listening for SIGCHLD. Returns the fd that becomes readable
+        when a child exits, to be waited on in the caller's event loop.
+        '''
+        if self._wakeup_r < 0:
+            self._wakeup_r, self._wakeup_w = os.pipe()
+            for fd in (self._wakeup_r, self._wakeup_w):
+                flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+                fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+        signal.signal(signal.SIGCHLD, self._on_sigchld)
+        # restart interrupted syscalls, the pipe is what wakes us up
+        signal.siginterrupt(signal.SIGCHLD, False)
+        signal.set_wakeup_fd(self._wakeup_w)
+        return self._wakeup_r
+
+    def fileno(self):
+        return self._wakeup_r
+
+    def reset_in_child(self):
+        '''
+        To be called first thing in a forked child: forget the parent's
+        children and stop sharing its wakeup pipe.
+        '''
+        for conn in self._conns.values():
+            conn.close()
+        self._conns = {}
+        self._by_key = {}
+        self._started = {}
+        self._sigchld = False
+        signal.set_wakeup_fd(-1)
+        signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+        for fd in (self._wakeup_r, self._wakeup_w):
+            if fd >= 0:
+                os.close(fd)
+        self._wakeup_r = self._wakeup_w = -1
+
+    def _drain(self):
+        while True:
+            try:
+                if not os.read(self._wakeup_r, 4096):
+                    break
+            except OSError, ex:
+                if ex.errno == errno.EINTR:
+                    continue
+                break
+
+    def reap(self):
+        '''
+        Collect the registered children that have exited since the last
+        call, removing them from the registry. This is a no-op unless a
+        SIGCHLD was received. Returns a list of (key, process, uptime).
+        '''
+        if self._wakeup_r >= 0:
+            self._drain()
+        if not self._sigchld:
+            return []
+        # clear the flag first, an exit from now on triggers another round
+        self._sigchld = False
+        now = time.time()
+        exited = [(key, phandle, now - self._started[key]) \
+                  for key, phandle in self._by_key.items() \
+                  if not phandle.is_alive()]
+        for key, _phandle, _uptime in exited:
+            self.remove(key)
+        if exited:
+            # let multiprocessing forget about them as well
+            multiprocessing.active_children()
+        return exited
+
+
+class PreforkPool(object):
+    """A pool of size idle processes forked ahead of time.
+
+    Each process runs target(parent_pid, conn) which is expected to do
+    whatever setup does not depend on the work, then block on conn for the
+    message telling it what to do. handoff() sends that message to an idle
+    process and returns it; refill() forks replacements and is meant to be
+    called once the latency sensitive work is done.
+    """
+    def __init__(self, target, size):
+        self.target = target
+        self.size = size
+        self._idle = deque()    # (process, sending end of its pipe)
+
+    def __len__(self):
+        return len(self._idle)
+
+    def _child_main(self, parent_pid, conn, writer):
+        # the sending ends inherited from the parent, our own included,
+        # would keep us from seeing EOF once the parent lets go of us
+        writer.close()
+        for _phandle, idle_conn in self._idle:
+            idle_conn.close()
+        self._idle.clear()
+        self.target(parent_pid, conn)
+
+    def _fork_one(self):
+        reader, writer = multiprocessing.Pipe(duplex=False)
+        phandle = multiprocessing.Process(target=self._child_main, \
+                                          args=(os.getpid(), reader, writer))
+        phandle.start()
+        reader.close()
+        self._idle.append((phandle, writer))
+
+    def refill(self):
+        '''
+        Fork idle processes until there are size of them. Returns the
+        number of processes forked.
+        '''
+        # forget the ones which died while idle
+        for phandle, conn in list(self._idle):
+            if not phandle.is_alive():
+                self._idle.remove((phandle, conn))
+                conn.close()
+        forked = 0
+        while len(self._idle) < self.size:
+            self._fork_one()
+            forked += 1
+        return forked
+
+    def handoff(self, message):
+        '''
+        Send message to an idle process. Returns (process, conn) where conn
+        is the sending end of its pipe, or (None, None) if the pool is
+        empty.
+        '''
+        while self._idle:
+            phandle, conn = self._idle.popleft()
+            try:
+                conn.send(message)
+                return phandle, conn
+            except (IOError, OSError), ex:
+                # died while idle, it will be reaped with the others
+                _logger.warn("Idle process %d is gone: %s" % (phandle.pid, ex))
+                conn.close()
+        return None, None
+
+    def drain(self):
+        '''
+        Empty the pool, returns the idle processes so they can be stopped
+        '''
+        idle = []
+        while self._idle:
+            phandle, conn = self._idle.popleft()
+            conn.close()
+            idle.append(phandle)
+        return idle
@@ -8,11 +8,50 @@ Consider the following example: if the library uses the logger name
 the actual logger name will be "cluster.lib.idb.logrorate".
 
 It is expected that all libraries will get their loggers using the
-:py:func:`get_logger` function in this module.
+:py:func:`get_logger` function in this module. The loggers it returns only
+format a message if it is going to be written, so pass the arguments
+instead of formatting them yourself, and take keyword arguments as
+structured fields::
+
+    _logger.info("Spawning a new monitor process for cluster: %d", cid,
+                 cid=cid)
+
+The fields are appended as key=value by :py:class:`TextFormatter` and
+become keys of their own with :py:class:`JsonFormatter`, which writes a
+JSON object per line; either is selected as the class of a formatter in
+the logging configuration file.
+
+With :py:func:`start_queue_logging` the handlers set up from the
+configuration file are owned by a writer thread of the calling process.
+The loggers, in that process and in every process forked from it
+afterwards, only put their records on a queue, so the log files are written
+and rotated from one place and logging never waits for the disk. The
+queue is a Unix datagram socket: every record is sent as one datagram, so
+a process killed while logging cannot leave a lock held or half a record
+behind for the others.
 """
 
-import os, logging
-import logging.config
+import os, sys, time, copy, json, errno, atexit, logging, hashlib, threading
+import logging.config, logging.handlers
+import socket, cPickle, weakref, ConfigParser
+from Queue import Full
+from collections import OrderedDict
+
+# Bytes of records waiting for the writer at most, as far as the kernel
+# allows; more are dropped, not waited for
+QUEUE_SIZE = 4 * 1024 * 1024
+# Largest record sent to the writer; longer messages and tracebacks are cut
+MAX_RECORD_SIZE = 64 * 1024
+
+# Defaults of DuplicateFilter: the window in seconds and the lowest level
+# whose records are deduplicated
+SUPPRESS_WINDOW = 60
+SUPPRESS_LEVEL = logging.WARNING
+
+# Per-cluster logs of add_child_handler: where they go and how many of them
+# a process keeps open at most; the least recently written is closed first
+CLUSTER_LOGS_PATH = '/logs'
+MAX_OPEN_CLUSTER_LOGS = 256
 
 logging.raiseExceptions = False
 CWD=os.getcwd()
@@ -20,9 +59,311 @@ _DEFAULT_LOGGING_CONFIG = CWD+'/'+"/logging.conf"
 
 _logging_prefix = ""
 
-def config_logging(config_file=_DEFAULT_LOGGING_CONFIG):
-    open(config_file)
-    logging.config.fileConfig(config_file)
+# The configuration file last loaded and a digest of its contents
+_logging_config_file = None
+_logging_config_digest = None
+
+def config_logging(config_file=_DEFAULT_LOGGING_CONFIG, \
+                   disable_existing_loggers=True):
+    global _logging_config_file, _logging_config_digest
+    data = open(config_file).read()
+    logging.config.fileConfig(config_file, \
+                              disable_existing_loggers=disable_existing_loggers)
+    _install_duplicate_filters(config_file)
+    _logging_config_file = config_file
+    _logging_config_digest = hashlib.md5(data).hexdigest()
+
+def _attached_handlers():
+    handlers = set(logging.getLogger().handlers)
+    for logger in logging.Logger.manager.loggerDict.values():
+        if isinstance(logger, logging.Logger):
+            handlers.update(logger.handlers)
+    return handlers
+
+def reload_logging():
+    """Load the logging configuration again if the file changed since it was
+    last loaded. Loggers the file does not mention, e.g. the ones set up by
+    add_child_handler, are left alone. Returns True if it was reloaded.
+    """
+    if not _logging_config_file:
+        return False
+    data = open(_logging_config_file).read()
+    if hashlib.md5(data).hexdigest() == _logging_config_digest:
+        return False
+    old_handlers = _attached_handlers()
+    if _listener:
+        if _listener.owned():
+            # the writer finishes with the old handlers first
+            _listener.stop()
+        old_handlers.update(_listener.handlers.values())
+    config_logging(_logging_config_file, disable_existing_loggers=False)
+    if _listener:
+        _listener.handlers = _install_queue_handlers(_listener.queue)
+        if _listener.owned():
+            _listener.start()
+        else:
+            # only the writer process needs them
+            for handler in _listener.handlers.values():
+                _close_handler(handler)
+            _listener.handlers = {}
+    # fileConfig() drops the handlers it replaces without closing them
+    for handler in old_handlers - _attached_handlers():
+        _close_handler(handler)
+    return True
+
+
+class DatagramQueue(object):
+    """A queue between processes made of a pair of Unix datagram sockets.
+    The processes forked after it was created put items on it, the one
+    which created it gets them. An item is pickled into one datagram,
+    which the kernel queues whole or not at all, and nothing is shared
+    between the senders but the socket.
+    """
+    # SO_SNDBUFFORCE of <asm-generic/socket.h>, lets root go beyond wmem_max
+    _SO_SNDBUFFORCE = 32
+
+    def __init__(self, size=QUEUE_SIZE):
+        self._reader, self._writer = socket.socketpair(socket.AF_UNIX, \
+                                                       socket.SOCK_DGRAM)
+        for option in (self._SO_SNDBUFFORCE, socket.SO_SNDBUF):
+            try:
+                self._writer.setsockopt(socket.SOL_SOCKET, option, size)
+                break
+            except socket.error:
+                pass
+        self._writer.setblocking(False)
+
+    def put(self, item, block=True, timeout=None):
+        '''
+        Raises Full if the item does not fit in the socket buffer and block
+        is False or it still does not fit after timeout seconds
+        '''
+        data = cPickle.dumps(item, cPickle.HIGHEST_PROTOCOL)
+        deadline = None
+        if block and timeout is not None:
+            deadline = time.time() + timeout
+        while True:
+            try:
+                self._writer.send(data)
+                return
+            except socket.error, ex:
+                if ex.errno not in (errno.EAGAIN, errno.ENOBUFS):
+                    raise
+            if not block or (deadline and time.time() >= deadline):
+                raise Full()
+            time.sleep(0.01)
+
+    def get(self):
+        '''
+        Waits for the next item. Raises EOFError once the queue is closed.
+        '''
+        data = self._reader.recv(MAX_RECORD_SIZE * 2)
+        if not data:
+            raise EOFError()
+        return cPickle.loads(data)
+
+    def close(self):
+        self._writer.close()
+        self._reader.close()
+
+
+def _truncate(text, size):
+    if text and len(text) > size:
+        return text[:size] + "... (truncated)"
+    return text
+
+
+class QueueHandler(logging.Handler):
+    """Puts the records on a DatagramQueue for the QueueListener,
+    on behalf of the handler known to the listener as key. Never blocks:
+    when the queue is full the record is dropped and counted.
+    """
+    def __init__(self, queue, key, level=logging.NOTSET):
+        logging.Handler.__init__(self, level)
+        self.queue = queue
+        self.key = key
+        self.dropped = 0
+
+    def prepare(self, record):
+        '''
+        Returns a copy of record which can be pickled: the message is merged
+        with its arguments and the traceback turned into text.
+        '''
+        if record.exc_info and not record.exc_text:
+            record.exc_text = _exception_formatter.formatException( \
+                    record.exc_info)
+        record = copy.copy(record)
+        if isinstance(record.msg, basestring):
+            # what DuplicateFilter tells records apart by
+            record.template = record.msg
+        record.msg = _truncate(record.getMessage(), MAX_RECORD_SIZE / 2)
+        record.exc_text = _truncate(record.exc_text, MAX_RECORD_SIZE / 2)
+        record.args = None
+        record.exc_info = None
+        return record
+
+    def emit(self, record):
+        try:
+            if self.dropped:
+                self._put(self._dropped_record(record))
+                self.dropped = 0
+            self._put(self.prepare(record))
+        except Full:
+            self.dropped += 1
+        except (KeyboardInterrupt, SystemExit):
+            raise
+        except:
+            self.handleError(record)
+
+    def _put(self, record):
+        self.queue.put((self.key, record), False)
+
+    def _dropped_record(self, record):
+        return logging.LogRecord(record.name, logging.WARNING, __file__, 0, \
+                                 "Dropped %d log records, the log queue " \
+                                 "was full" % self.dropped, None, None)
+
+
+_exception_formatter = logging.Formatter()
+
+
+class QueueListener(object):
+    """Writer thread handing the records of the queue to the handlers they
+    are addressed to. handlers maps the key of a QueueHandler to the real
+    handler.
+    """
+    _sentinel = None
+
+    def __init__(self, queue, handlers):
+        self.queue = queue
+        self.handlers = handlers
+        self._pid = os.getpid()
+        self._thread = None
+
+    def owned(self):
+        '''
+        Returns True in the process the writer runs in
+        '''
+        return self._pid == os.getpid()
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name="log-writer")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _run(self):
+        while True:
+            try:
+                item = self.queue.get()
+            except (EOFError, IOError):
+                return
+            except Exception, ex:
+                # one bad record must not stop the writer for everyone
+                _report_error("Log writer: Dropped a record it could not " \
+                              "read: %s" % ex)
+                continue
+            if item is self._sentinel:
+                return
+            try:
+                key, record = item
+                handler = self.handlers.get(key)
+                if handler is None:
+                    # sent before a reload by a process which did not hear
+                    # of it yet; the handler is gone
+                    continue
+                try:
+                    handler.handle(record)
+                except Exception:
+                    handler.handleError(record)
+            except Exception, ex:
+                _report_error("Log writer: Failed to write a record: %s" % ex)
+
+    def stop(self):
+        '''
+        Write out what is queued and stop the writer thread
+        '''
+        if self._thread is None:
+            return
+        try:
+            self.queue.put(self._sentinel, timeout=5)
+        except Full:
+            # the writer is stuck, leave it to die with the process
+            self._thread = None
+            return
+        self._thread.join()
+        self._thread = None
+
+
+def _report_error(message):
+    '''
+    Tell about a failure of logging itself, which cannot be logged
+    '''
+    try:
+        sys.stderr.write("%s\n" % message)
+    except Exception:
+        pass
+
+
+# The writer of start_queue_logging(), None when logging directly
+_listener = None
+
+def _install_queue_handlers(queue):
+    '''
+    Replace every handler of every logger by a QueueHandler. Returns a dict
+    mapping the key of each QueueHandler to the handler it stands in for.
+    '''
+    handlers = {}
+    loggers = [logging.getLogger()]
+    loggers.extend(logger for logger in \
+                   logging.Logger.manager.loggerDict.values() \
+                   if isinstance(logger, logging.Logger))
+    for logger in loggers:
+        for index, handler in enumerate(list(logger.handlers)):
+            if isinstance(handler, QueueHandler):
+                continue
+            key = (logger.name, index)
+            logger.removeHandler(handler)
+            logger.addHandler(QueueHandler(queue, key, handler.level))
+            handlers[key] = handler
+    return handlers
+
+def start_queue_logging(queue_size=QUEUE_SIZE):
+    """Hand the configured handlers to a writer thread and make the loggers
+    queue their records for it. Only what exists at the time of the call is
+    affected, e.g. not the handlers of add_child_handler. Processes forked
+    afterwards log through the queue too, so this is to be called after
+    daemonizing and before starting the children.
+    """
+    global _listener
+    if _listener:
+        return _listener
+    queue = DatagramQueue(queue_size)
+    _listener = QueueListener(queue, _install_queue_handlers(queue))
+    _listener.start()
+    atexit.register(stop_queue_logging)
+    return _listener
+
+def stop_queue_logging():
+    """Write out the queued records and give the handlers back to the
+    loggers. Does nothing outside of the process which started it.
+    """
+    global _listener
+    if not _listener or not _listener.owned():
+        return
+    listener = _listener
+    _listener = None
+    listener.stop()
+    for (name, index), handler in sorted(listener.handlers.items()):
+        if name == 'root':
+            logger = logging.getLogger()
+        else:
+            logger = logging.getLogger(name)
+        for queue_handler in list(logger.handlers):
+            if isinstance(queue_handler, QueueHandler) and \
+               queue_handler.key == (name, index):
+                logger.removeHandler(queue_handler)
+        logger.addHandler(handler)
+    listener.queue.close()
 
 def set_logging_prefix(prefix):
     """Set the logging prefix
@@ -33,55 +374,506 @@ def set_logging_prefix(prefix):
     if _logging_prefix and not _logging_prefix.endswith("."):
         _logging_prefix += "."
 
+class ClusterFileHandler(logging.handlers.RotatingFileHandler):
+    """Writes the log of one cluster to
+    <logs_path>/<date>/cid_<id>/failover.<id>.<date><hour>, moving on to the
+    next file with the first record of a new hour. The file, and the
+    directory of the day, are only created when written to, and its manager
+    may close the file at any time to stay within its limit of open files;
+    it is opened again by the next record.
+    """
+    def __init__(self, cluster_id, manager, logs_path=CLUSTER_LOGS_PATH):
+        self.cluster_id = cluster_id
+        self.logs_path = logs_path
+        self._manager = manager
+        # records up to this time go to the current file
+        self._switch_at = 0
+        logging.handlers.RotatingFileHandler.__init__(self, \
+                self._switch_file(time.time()), 'a', 10465760, 10, \
+                delay=True)
+
+    def _switch_file(self, now):
+        '''
+        Point the handler at the file for the hour of now and return its
+        path
+        '''
+        # whole seconds, or the first fraction of a second of the next hour
+        # would still go to this hour's file
+        now = int(now)
+        hour = time.localtime(now)
+        path = '%s/%s/cid_%s' % (self.logs_path, \
+                                 time.strftime('%Y%m%d', hour), \
+                                 self.cluster_id)
+        self._switch_at = now - hour.tm_min * 60 - hour.tm_sec + 3600
+        self.baseFilename = os.path.abspath('%s/failover.%s.%s' \
+                % (path, self.cluster_id, time.strftime('%Y%m%d%H', hour)))
+        return self.baseFilename
+
+    def _open(self):
+        # within the error handling of emit(), like the open itself
+        try:
+            os.makedirs(os.path.dirname(self.baseFilename))
+        except OSError, ex:
+            if ex.errno != errno.EEXIST:
+                raise
+        stream = logging.handlers.RotatingFileHandler._open(self)
+        self._manager.opened(self)
+        return stream
+
+    def close_file(self):
+        '''
+        Close the file but not the handler, the next record opens it again
+        '''
+        if self.stream:
+            self.flush()
+            self.stream.close()
+            self.stream = None
+
+    def emit(self, record):
+        if record.created >= self._switch_at:
+            try:
+                self.close_file()
+                self._switch_file(record.created)
+            except (KeyboardInterrupt, SystemExit):
+                raise
+            except:
+                self.handleError(record)
+                return
+        if self.stream:
+            self._manager.used(self)
+        logging.handlers.RotatingFileHandler.emit(self, record)
+
+
+class ClusterHandlerManager(object):
+    """Cache of the ClusterFileHandler of each cluster. At most max_open of
+    them have their file open, the ones written to least recently are
+    closed to make room.
+    """
+    def __init__(self, max_open=MAX_OPEN_CLUSTER_LOGS, \
+                 logs_path=CLUSTER_LOGS_PATH):
+        self.max_open = max_open
+        self.logs_path = logs_path
+        self._handlers = {}
+        # handlers with an open file, least recently used first
+        self._open = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get_handler(self, cluster_id):
+        with self._lock:
+            handler = self._handlers.get(cluster_id)
+            if handler is None:
+                handler = ClusterFileHandler(cluster_id, self, self.logs_path)
+                handler.setFormatter(logging.Formatter( \
+                        fmt='%(asctime)s %(levelname)s %(message)s'))
+                handler.setLevel(logging.DEBUG)
+                self._handlers[cluster_id] = handler
+            return handler
+
+    def used(self, handler):
+        with self._lock:
+            if self._open.pop(handler, None):
+                self._open[handler] = True
+
+    def opened(self, handler):
+        '''
+        Called by handler, holding its lock, when it opened its file
+        '''
+        with self._lock:
+            self._open.pop(handler, None)
+            self._open[handler] = True
+            if len(self._open) <= self.max_open:
+                return
+            victims = []
+            for other in self._open.keys():
+                if len(self._open) - len(victims) <= self.max_open:
+                    break
+                # skip the ones busy writing, taking their lock could
+                # deadlock with a handler waiting for ours
+                if other is not handler and other.lock.acquire(False):
+                    victims.append(other)
+            for victim in victims:
+                del self._open[victim]
+        for victim in victims:
+            try:
+                victim.close_file()
+            finally:
+                victim.lock.release()
+
+    def remove(self, cluster_id):
+        '''
+        Close and forget the handler of cluster_id, e.g. once the cluster is
+        no longer monitored by this process. Returns the handler if any.
+        '''
+        with self._lock:
+            handler = self._handlers.pop(cluster_id, None)
+            if handler is not None:
+                self._open.pop(handler, None)
+        if handler is not None:
+            handler.close()
+        return handler
+
+    def close_all(self):
+        for cluster_id in list(self._handlers):
+            self.remove(cluster_id)
+
+
+_cluster_handlers = ClusterHandlerManager()
+
 def add_child_handler(logger, cluster_id, level=None):
     '''Function which will add handler to child logger.
     '''
+    logger = _unwrap(logger)
+    handler = _cluster_handlers.get_handler(cluster_id)
 
-    # If handlers already exists remove it first.
-    if len(logger.handlers) > 0:
-        h = logger.handlers[0]
-        logger.removeHandler(h)
-        h.close()
-
-    # Create path og log file by considering date, time and cluster id.
-    logs_path = '/logs'
-    from datetime import datetime
-    dateformat = datetime.now().strftime('%Y%m%d')
-    final_path = '%s/%s/cid_%s' %(logs_path, dateformat, cluster_id)
-
-    # If path we have created does not exist then create it.
-    if not os.path.exists(final_path):
-        os.makedirs(final_path)
-
-    # Create filename for logging
-    log_file_name = 'failover.%s.%s' % (cluster_id, datetime.now().strftime('%Y%m%d%H'))
-    logger_file_path = '%s/%s' % (final_path, log_file_name)
-    file_handler = logging.handlers.RotatingFileHandler(logger_file_path,
-                                        'a', 10465760, 10,)
-    file_handler.setFormatter(\
-            logging.Formatter(fmt='%(asctime)s %(levelname)s %(message)s'))
-    file_handler.setLevel(logging.DEBUG)
+    # If other handlers exist remove them first, the cached ones stay open
+    for h in list(logger.handlers):
+        if h is not handler:
+            logger.removeHandler(h)
+            if not isinstance(h, ClusterFileHandler):
+                h.close()
 
     # Add handler to given logger and set its level too.
     logger.propagate = 0
-    logger.setLevel(level)
-  
-    logger.addHandler(file_handler)
+    if level is not None:
+        logger.setLevel(level)
+    if handler not in logger.handlers:
+        logger.addHandler(handler)
+
+def remove_child_handler(logger, cluster_id):
+    '''Detach the handler of cluster_id from logger and close its file.
+    '''
+    handler = _cluster_handlers.remove(cluster_id)
+    if handler is not None:
+        _unwrap(logger).removeHandler(handler)
 
 def set_formatter(logger, format):
     """Set the logging formatter
     """
+    logger = _unwrap(logger)
     if logger.handlers and format:
         handler = logger.handlers[0]
         fmt = logging.Formatter(format)
         handler.setFormatter(fmt)
 
+class _Repeats(object):
+    def __init__(self, record, now):
+        # what the summaries need of the occurrence written in full
+        self.name = record.name
+        self.levelno = record.levelno
+        self.levelname = record.levelname
+        self.message = record.getMessage().split('\n', 1)[0]
+        self.window_start = now
+        self.last_seen = now
+        self.count = 0          # left out since window_start
+
+
+class DuplicateFilter(logging.Filter):
+    """Keeps handler from writing the same record over and over. Records
+    at level or above are told apart by logger, level, message template,
+    i.e. before the arguments are merged in, and by where their traceback
+    ends. The first occurrence is written in full. Repeats within window
+    seconds of the previous one are counted instead, and a summary of the
+    count is written once per window for as long as they keep coming and
+    once more after they stopped.
+
+    Any record through the handler, whatever its level, writes the
+    summaries of the windows which are over. Summaries of windows nothing
+    comes through the handler after are written by flush(), which runs at
+    exit at the latest.
+    """
+    def __init__(self, handler, window=SUPPRESS_WINDOW, level=SUPPRESS_LEVEL):
+        logging.Filter.__init__(self)
+        self.handler = handler
+        self.window = window
+        self.level = level
+        self._repeats = {}
+        self._next_sweep = 0
+        self._lock = threading.Lock()
+        self._pid = os.getpid()
+        _duplicate_filters.add(self)
+
+    def _fingerprint(self, record):
+        template = getattr(record, 'template', record.msg)
+        location = None
+        if record.exc_info and record.exc_info[2]:
+            tb = record.exc_info[2]
+            while tb.tb_next:
+                tb = tb.tb_next
+            location = (tb.tb_frame.f_code.co_filename, tb.tb_lineno)
+        elif record.exc_text:
+            # queued records only have the text, take its last frame
+            index = record.exc_text.rfind('  File "')
+            if index >= 0:
+                location = record.exc_text[index:].split('\n', 1)[0]
+        return (record.name, record.levelno, str(template), location)
+
+    def _summary(self, repeats, now):
+        summary = logging.makeLogRecord({
+            'name': repeats.name,
+            'levelno': repeats.levelno,
+            'levelname': repeats.levelname,
+            'msg': "Repeated %d times in %d seconds: %s" \
+                   % (repeats.count, int(now - repeats.window_start), \
+                      repeats.message),
+            'created': now,
+            'suppress_summary': True,
+        })
+        repeats.count = 0
+        repeats.window_start = now
+        return summary
+
+    def _sweep(self, now):
+        '''
+        Returns the summaries of the windows which are over, forgets the
+        records which stopped repeating
+        '''
+        summaries = []
+        for key, repeats in self._repeats.items():
+            if now - repeats.window_start >= self.window and repeats.count:
+                summaries.append(self._summary(repeats, now))
+            elif now - repeats.last_seen >= self.window:
+                del self._repeats[key]
+        self._next_sweep = now + self.window
+        return summaries
+
+    def _write_summaries(self, summaries):
+        for summary in summaries:
+            self.handler.handle(summary)
+
+    def filter(self, record):
+        if getattr(record, 'suppress_summary', False):
+            return True
+        now = record.created
+        if record.levelno < self.level:
+            # e.g. the INFO records of monitor.log close the windows of
+            # errors which stopped
+            if now >= self._next_sweep and self._repeats:
+                with self._lock:
+                    summaries = self._sweep(now)
+                self._write_summaries(summaries)
+            return True
+        key = self._fingerprint(record)
+        summaries = []
+        with self._lock:
+            if now >= self._next_sweep:
+                summaries = self._sweep(now)
+            repeats = self._repeats.get(key)
+            if repeats is None or now - repeats.last_seen >= self.window:
+                self._repeats[key] = _Repeats(record, now)
+                passed = True
+            else:
+                repeats.count += 1
+                repeats.last_seen = now
+                if now - repeats.window_start >= self.window:
+                    summaries.append(self._summary(repeats, now))
+                passed = False
+        self._write_summaries(summaries)
+        return passed
+
+    def flush(self):
+        '''
+        Write the summaries of every record left out so far. Forked
+        children leave that to the process they inherited the counts from.
+        '''
+        if self._pid != os.getpid():
+            return
+        now = time.time()
+        with self._lock:
+            summaries = [self._summary(repeats, now) \
+                         for repeats in self._repeats.values() \
+                         if repeats.count]
+        self._write_summaries(summaries)
+
+
+_duplicate_filters = weakref.WeakSet()
+
+def _close_handler(handler):
+    '''
+    Close a handler fileConfig() replaced, after the summaries of its
+    DuplicateFilter if it has one
+    '''
+    for handler_filter in handler.filters:
+        if isinstance(handler_filter, DuplicateFilter):
+            handler_filter.flush()
+            _duplicate_filters.discard(handler_filter)
+    handler.close()
+
+def flush_duplicate_filters():
+    for duplicate_filter in list(_duplicate_filters):
+        duplicate_filter.flush()
+
+atexit.register(flush_duplicate_filters)
+
+def _install_duplicate_filters(config_file):
+    '''
+    Give a DuplicateFilter to the handlers whose section in config_file has
+    a suppress_window option, in seconds, and optionally suppress_level
+    '''
+    config = ConfigParser.RawConfigParser()
+    config.read(config_file)
+    done = set()
+    for section in config.sections():
+        if not section.startswith('logger_') or \
+           not config.has_option(section, 'handlers'):
+            continue
+        if section == 'logger_root':
+            logger = logging.getLogger()
+        else:
+            logger = logging.getLogger(config.get(section, 'qualname'))
+        names = [name.strip() for name in \
+                 config.get(section, 'handlers').split(',') if name.strip()]
+        # fileConfig() adds them in the order they are listed
+        for name, handler in zip(names, logger.handlers):
+            options = 'handler_' + name
+            if handler in done or \
+               not config.has_option(options, 'suppress_window'):
+                continue
+            level = SUPPRESS_LEVEL
+            if config.has_option(options, 'suppress_level'):
+                level = logging.getLevelName( \
+                        config.get(options, 'suppress_level').strip())
+            handler.addFilter(DuplicateFilter(handler, \
+                    config.getfloat(options, 'suppress_window'), level))
+            done.add(handler)
+
+
+class TextFormatter(logging.Formatter):
+    """logging.Formatter which appends the fields of the record to the
+    message as key=value
+    """
+    def format(self, record):
+        fields = getattr(record, 'fields', None)
+        if fields:
+            record = copy.copy(record)
+            record.msg = "%s %s" % (record.getMessage(), \
+                                    " ".join("%s=%s" % (key, fields[key]) \
+                                             for key in sorted(fields)))
+            record.args = None
+        return logging.Formatter.format(self, record)
+
+
+class JsonFormatter(logging.Formatter):
+    """Formats a record as one line of JSON: the time as seconds since the
+    epoch and as formatted by datefmt, level, logger, process id, message,
+    the fields and the traceback if any. Fields named like one of those
+    are overridden.
+    """
+    def format(self, record):
+        data = OrderedDict()
+        data['ts'] = record.created
+        data['time'] = self.formatTime(record, self.datefmt)
+        data['level'] = record.levelname
+        data['logger'] = record.name
+        data['process'] = record.process
+        data['msg'] = record.getMessage()
+        fields = getattr(record, 'fields', None)
+        if fields:
+            for key in sorted(fields):
+                data.setdefault(key, fields[key])
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            data['exc'] = record.exc_text
+        return json.dumps(data, separators=(',', ':'), default=str)
+
+
+class StructuredLogger(object):
+    """Wraps a logging.Logger. A message is only formatted with its
+    arguments once a handler writes it, and below the level of the logger
+    nothing but the level check is done. Keyword arguments other than
+    exc_info become the fields of the record. Everything else is the
+    wrapped logger's, which is available as logger.
+
+    With a relative_name the wrapped logger is looked up under the current
+    logging prefix when it is used, so that a module may get its logger at
+    import time, before the application has set the prefix.
+    """
+    def __init__(self, logger, relative_name=None):
+        self._logger = logger
+        self._relative_name = relative_name
+
+    @property
+    def logger(self):
+        if self._relative_name is not None:
+            name = _logging_prefix + self._relative_name
+            if self._logger.name != name:
+                self._logger = logging.getLogger(name)
+        return self._logger
+
+    def __getattr__(self, name):
+        return getattr(self.logger, name)
+
+    def _log(self, level, msg, args, fields):
+        exc_info = fields.pop('exc_info', None)
+        if exc_info and not isinstance(exc_info, tuple):
+            exc_info = sys.exc_info()
+        # the caller of debug(), info(), ...; cheaper than findCaller()
+        # which would stop at this module
+        frame = sys._getframe(2)
+        extra = None
+        if fields:
+            extra = {'fields': fields}
+        logger = self.logger
+        record = logger.makeRecord(logger.name, level, \
+                                   frame.f_code.co_filename, frame.f_lineno, \
+                                   msg, args, exc_info, frame.f_code.co_name, \
+                                   extra)
+        logger.handle(record)
+
+    def debug(self, msg, *args, **fields):
+        if self.logger.isEnabledFor(logging.DEBUG):
+            self._log(logging.DEBUG, msg, args, fields)
+
+    def info(self, msg, *args, **fields):
+        if self.logger.isEnabledFor(logging.INFO):
+            self._log(logging.INFO, msg, args, fields)
+
+    def warning(self, msg, *args, **fields):
+        if self.logger.isEnabledFor(logging.WARNING):
+            self._log(logging.WARNING, msg, args, fields)
+
+    warn = warning
+
+    def error(self, msg, *args, **fields):
+        if self.logger.isEnabledFor(logging.ERROR):
+            self._log(logging.ERROR, msg, args, fields)
+
+    def exception(self, msg, *args, **fields):
+        if self.logger.isEnabledFor(logging.ERROR):
+            fields['exc_info'] = True
+            self._log(logging.ERROR, msg, args, fields)
+
+    def critical(self, msg, *args, **fields):
+        if self.logger.isEnabledFor(logging.CRITICAL):
+            self._log(logging.CRITICAL, msg, args, fields)
+
+    def log(self, level, msg, *args, **fields):
+        if self.logger.isEnabledFor(level):
+            self._log(level, msg, args, fields)
+
+
+def _unwrap(logger):
+    if isinstance(logger, StructuredLogger):
+        return logger.logger
+    return logger
+
+# (relative_name, logger_name) -> its StructuredLogger
+_structured_loggers = {}
+
 def get_logger(logger_name, relative_name=False):
     """Returns a logger; the full logger name consists of the logger_name
-    argument with any previously set logging prefix prepended to it.
+    argument with the logging prefix prepended to it. It is a
+    StructuredLogger wrapping the logging.Logger of that name. The prefix
+    is the one set when the logger is used, not when it is got.
     """
-    if relative_name:
-        full_logger_name = _logging_prefix + logger_name
-    else:
-        full_logger_name = logger_name
-    return logging.getLogger(full_logger_name)
+    key = (bool(relative_name), logger_name)
+    logger = _structured_loggers.get(key)
+    if logger is None:
+        if relative_name:
+            logger = StructuredLogger(logging.getLogger(_logging_prefix + \
+                                                        logger_name), \
+                                      logger_name)
+        else:
+            logger = StructuredLogger(logging.getLogger(logger_name))
+        _structured_loggers[key] = logger
+    return logger
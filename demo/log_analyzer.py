@@ -0,0 +1,609 @@
+#!/usr/bin/python
+# Summarizes monitor.log and error.log, rotated ones included, without
+# loading them into memory: spawns and stops per cluster, restart storms
+# and error fingerprints with their rates, optionally for a time range.
+#
+# The files are memory mapped and searched with regular expressions, so
+# only the lines of interest ever become Python objects. What a file holds
+# is kept in a sidecar index: the file is cut in chunks of CHUNK_SIZE bytes
+# at record boundaries, and for each chunk the index has its time range,
+# its aggregates and a timestamp every MARK_INTERVAL bytes. Chunks inside
+# the asked time range are taken from the index as they are, only the two
+# at its edges are read again, starting close to the edge. Rotated files do
+# not change, the live one is indexed further on the next run, so repeated
+# queries only read what was written since.
+#
+# Both the plain text format and the JSON lines of log.JsonFormatter are
+# understood.
+#
+import sys, os, re, time, json, mmap, glob, getopt, hashlib
+from bisect import bisect_right
+
+CHUNK_SIZE = 4 * 1024 * 1024
+MARK_INTERVAL = 64 * 1024
+INDEX_VERSION = 2
+# bytes at the head of a file telling it apart from another one which got
+# the same inode
+HEAD_SIZE = 256
+
+# A cluster spawned this many times within the window is in a restart storm
+STORM_SPAWNS = 5
+STORM_WINDOW = 60           # in seconds
+
+# Exception types and locations kept per error fingerprint
+MAX_LOCATIONS = 3
+
+_TS = r'\d{4}-\d\d-\d\d \d\d:\d\d:\d\d'
+# lines starting a record of the text format
+_RECORD_START = re.compile(r'^' + _TS, re.M)
+# records of the text format worth a look, errors with their traceback
+_TEXT_RECORD = re.compile(r'^(' + _TS + r')(?:,(\d{3}))? ' \
+        r'(?:(WARNING|ERROR|CRITICAL) ([^\n]*)((?:\n(?!\d{4}-\d\d-\d\d )' \
+        r'[^\n]*)*)|INFO (Parent: (?:Spawning|Stopping) [^\n]*))', re.M)
+# the same for JSON lines
+_JSON_RECORD = re.compile(r'^\{[^\n]*(?:"level":"(?:WARNING|ERROR|CRITICAL)"' \
+                          r'|"msg":"Parent: (?:Spawning|Stopping) )[^\n]*', \
+                          re.M)
+_JSON_TS = re.compile(r'"ts":([0-9.]+)')
+
+_SPAWN = re.compile(r'Spawning a new monitor process for cluster: (\d+)')
+_STOP = re.compile(r'Stopping monitor process for cluster: (\d+)')
+_EXIT = re.compile(r'Monitor process \d+ for cluster: (\d+) exited')
+_KILLED = re.compile(r'for cluster: (\d+) did not quit within')
+_REPEATED = re.compile(r'^Repeated (\d+) times in \d+ seconds: (.*)')
+# what varies between records of the same kind
+_VARIABLE = re.compile(r"'[^']*'|\"[^\"]*\"|0x[0-9a-fA-F]+|\d+(?:\.\d+)?")
+_LOCATION = re.compile(r'^\s+File "([^"]+)", line (\d+), in (\S+)', re.M)
+
+# 'YYYY-mm-dd HH' -> seconds since the epoch, local time like asctime
+_hour_cache = {}
+
+def parse_time(text):
+    '''
+    Seconds since the epoch of 'YYYY-mm-dd HH:MM:SS' in local time
+    '''
+    hour = text[:13]
+    start = _hour_cache.get(hour)
+    if start is None:
+        start = time.mktime(time.strptime(hour, '%Y-%m-%d %H'))
+        _hour_cache[hour] = start
+    return start + int(text[14:16]) * 60 + int(text[17:19])
+
+
+def fingerprint(level, message, details=''):
+    '''
+    Returns (key, location) of an error record: the key is the level and
+    the message with its numbers and quoted strings blanked out, the
+    location the type of the exception and where its traceback ends, if
+    it has one. The summaries of log.DuplicateFilter have no traceback, so
+    the key must not depend on it.
+    '''
+    template = _VARIABLE.sub('#', message.split('\n', 1)[0]).strip()
+    exc_type = ''
+    location = None
+    if details:
+        lines = [line for line in details.strip().split('\n') if line]
+        if lines and not lines[-1].startswith(' '):
+            exc_type = lines[-1].split(':', 1)[0].strip()
+        frames = _LOCATION.findall(details)
+        if frames:
+            location = "at %s:%s in %s" % frames[-1]
+        if exc_type:
+            location = "%s %s" % (exc_type, location or "")
+    return "%s %s" % (level, template), location and location.strip()
+
+
+class Aggregate(object):
+    '''
+    What a part of the logs says, can be merged with the aggregate of
+    another part
+    '''
+    def __init__(self):
+        self.first = None
+        self.last = None
+        self.spawns = {}        # cluster -> [time of each spawn]
+        self.stops = {}         # cluster -> count
+        self.exits = {}         # cluster -> unexpected exits
+        self.killed = {}        # cluster -> count
+        # key -> [count, first, last, [exception type and location]]
+        self.errors = {}
+
+    def _seen(self, ts):
+        if self.first is None or ts < self.first:
+            self.first = ts
+        if self.last is None or ts > self.last:
+            self.last = ts
+
+    def _error(self, key, location, ts, count=1):
+        entry = self.errors.get(key)
+        if entry is None:
+            entry = [0, ts, ts, []]
+            self.errors[key] = entry
+        entry[0] += count
+        entry[1] = min(entry[1], ts)
+        entry[2] = max(entry[2], ts)
+        if location and location not in entry[3] and \
+           len(entry[3]) < MAX_LOCATIONS:
+            entry[3].append(location)
+
+    def add(self, ts, level, message, details=''):
+        self._seen(ts)
+        if level == 'INFO':
+            match = _SPAWN.search(message)
+            if match:
+                self.spawns.setdefault(match.group(1), []).append(ts)
+                return
+            match = _STOP.search(message)
+            if match:
+                cid = match.group(1)
+                self.stops[cid] = self.stops.get(cid, 0) + 1
+            return
+        match = _EXIT.search(message)
+        if match:
+            cid = match.group(1)
+            self.exits[cid] = self.exits.get(cid, 0) + 1
+        match = _KILLED.search(message)
+        if match:
+            cid = match.group(1)
+            self.killed[cid] = self.killed.get(cid, 0) + 1
+        count = 1
+        match = _REPEATED.match(message)
+        if match:
+            # a summary of log.DuplicateFilter
+            count = int(match.group(1))
+            message = match.group(2)
+        key, location = fingerprint(level, message, details)
+        self._error(key, location, ts, count)
+
+    def merge(self, other):
+        if other.first is not None:
+            self._seen(other.first)
+            self._seen(other.last)
+        for cid, times in other.spawns.items():
+            self.spawns.setdefault(cid, []).extend(times)
+        for mine, theirs in ((self.stops, other.stops), \
+                             (self.exits, other.exits), \
+                             (self.killed, other.killed)):
+            for cid, count in theirs.items():
+                mine[cid] = mine.get(cid, 0) + count
+        for key, (count, first, last, locations) in other.errors.items():
+            self._error(key, None, first, count)
+            entry = self.errors[key]
+            entry[2] = max(entry[2], last)
+            for location in locations:
+                if location not in entry[3] and \
+                   len(entry[3]) < MAX_LOCATIONS:
+                    entry[3].append(location)
+
+    def to_json(self):
+        return {'first': self.first, 'last': self.last, \
+                'spawns': self.spawns, 'stops': self.stops, \
+                'exits': self.exits, 'killed': self.killed, \
+                'errors': self.errors}
+
+    @classmethod
+    def from_json(cls, data):
+        aggregate = cls()
+        aggregate.first = data['first']
+        aggregate.last = data['last']
+        aggregate.spawns = data['spawns']
+        aggregate.stops = data['stops']
+        aggregate.exits = data['exits']
+        aggregate.killed = data['killed']
+        aggregate.errors = data['errors']
+        return aggregate
+
+
+class LogFile(object):
+    '''
+    One memory mapped log file
+    '''
+    def __init__(self, path):
+        self.path = path
+        self._fp = open(path, 'rb')
+        stat = os.fstat(self._fp.fileno())
+        self.identity = (stat.st_dev, stat.st_ino)
+        self.size = stat.st_size
+        self.map = None
+        if self.size:
+            self.map = mmap.mmap(self._fp.fileno(), self.size, \
+                                 access=mmap.ACCESS_READ)
+        self.json = self.size > 0 and self.map[0] == '{'
+        self.head = hashlib.md5(self.map[:HEAD_SIZE] if self.map \
+                                else '').hexdigest()
+
+    def close(self):
+        if self.map is not None:
+            self.map.close()
+        self._fp.close()
+
+    def record_start(self, pos):
+        '''
+        Offset of the first record starting at or after pos, size if none
+        '''
+        if self.json:
+            if pos == 0:
+                return 0
+            index = self.map.find('\n', pos - 1)
+            return self.size if index < 0 else index + 1
+        match = _RECORD_START.search(self.map, pos)
+        return match.start() if match else self.size
+
+    def record_time(self, pos):
+        '''
+        Time of the record starting at pos
+        '''
+        if self.json:
+            end = self.map.find('\n', pos)
+            match = _JSON_TS.search(self.map, pos, \
+                                    self.size if end < 0 else end)
+            return float(match.group(1)) if match else None
+        return parse_time(self.map[pos:pos + 19])
+
+    def last_record_start(self):
+        '''
+        Offset of the last record; it may still be being written to
+        '''
+        end = self.size
+        while end > 0:
+            index = self.map.rfind('\n', 0, end - 1) + 1
+            if self.record_start(index) == index:
+                return index
+            end = index
+        return 0
+
+    def scan(self, start, end, aggregate, since=None, until=None):
+        '''
+        Add the records starting between start and end to aggregate,
+        the ones within [since, until) only if given
+        '''
+        if self.json:
+            for match in _JSON_RECORD.finditer(self.map, start, end):
+                try:
+                    data = json.loads(match.group(0))
+                except ValueError:
+                    continue
+                ts = data.get('ts')
+                if ts is None or (since is not None and ts < since) or \
+                   (until is not None and ts >= until):
+                    continue
+                aggregate.add(ts, data.get('level', ''), \
+                              data.get('msg', ''), data.get('exc', ''))
+            return
+        for match in _TEXT_RECORD.finditer(self.map, start, end):
+            ts = parse_time(match.group(1))
+            if match.group(2):
+                ts += int(match.group(2)) / 1000.0
+            if (since is not None and ts < since) or \
+               (until is not None and ts >= until):
+                continue
+            if match.group(3):
+                aggregate.add(ts, match.group(3), match.group(4), \
+                              match.group(5))
+            else:
+                aggregate.add(ts, 'INFO', match.group(6))
+
+    def build_chunk(self, start, limit):
+        '''
+        Returns the index entry of the chunk starting at start and ending
+        at the first record after start + CHUNK_SIZE, or limit
+        '''
+        end = min(self.record_start(start + CHUNK_SIZE), limit) \
+              if start + CHUNK_SIZE < limit else limit
+        aggregate = Aggregate()
+        self.scan(start, end, aggregate)
+        marks = []
+        pos = start
+        while pos < end:
+            ts = self.record_time(pos)
+            if ts is not None:
+                marks.append([ts, pos])
+                aggregate._seen(ts)
+            pos = self.record_start(pos + MARK_INTERVAL)
+        return {'start': start, 'end': end, 'marks': marks, \
+                'aggregate': aggregate.to_json()}
+
+
+class Index(object):
+    '''
+    The sidecar index of a LogFile, in index_dir under the device and
+    inode of the file so that it follows the file when it is rotated
+    '''
+    def __init__(self, log_file, index_dir):
+        self.log_file = log_file
+        self.path = None
+        if index_dir:
+            self.path = os.path.join(index_dir, "%d_%d.json" \
+                                     % log_file.identity)
+        self.chunks = []
+        self.indexed_to = 0
+        self.built = 0          # chunks built by this run
+        self._load()
+
+    def _load(self):
+        if not self.path or not os.path.exists(self.path):
+            return
+        try:
+            data = json.load(open(self.path))
+        except (IOError, ValueError):
+            return
+        if data.get('version') != INDEX_VERSION or \
+           data.get('head') != self.log_file.head or \
+           data.get('indexed_to', 0) > self.log_file.size:
+            # a different file under the same inode, or truncated
+            return
+        self.chunks = data['chunks']
+        self.indexed_to = data['indexed_to']
+
+    def update(self):
+        '''
+        Index what was written since the last time, up to the start of the
+        last record. Returns True if anything was added.
+        '''
+        log_file = self.log_file
+        if not log_file.size:
+            return False
+        limit = log_file.last_record_start()
+        if limit <= self.indexed_to:
+            return False
+        if self.chunks and \
+           self.chunks[-1]['end'] - self.chunks[-1]['start'] < CHUNK_SIZE:
+            # the last chunk was cut short by the end of the file, redo it
+            self.indexed_to = self.chunks.pop()['start']
+        while self.indexed_to < limit:
+            chunk = log_file.build_chunk(self.indexed_to, limit)
+            self.chunks.append(chunk)
+            self.indexed_to = chunk['end']
+            self.built += 1
+        return True
+
+    def save(self):
+        if not self.path:
+            return
+        data = {'version': INDEX_VERSION, 'head': self.log_file.head, \
+                'indexed_to': self.indexed_to, 'chunks': self.chunks}
+        tmp_path = "%s.%d.tmp" % (self.path, os.getpid())
+        try:
+            with open(tmp_path, 'w') as fp:
+                json.dump(data, fp, separators=(',', ':'))
+            os.rename(tmp_path, self.path)
+        except (IOError, OSError), ex:
+            print >> sys.stderr, "Warning: Failed to save the index of " \
+                                 "%s: %s" % (self.log_file.path, ex)
+
+    def query(self, aggregate, since=None, until=None):
+        '''
+        Add the records of the file within [since, until) to aggregate
+        '''
+        log_file = self.log_file
+        for chunk in self.chunks:
+            part = Aggregate.from_json(chunk['aggregate'])
+            if part.first is None:
+                continue
+            if (since is not None and part.last < since) or \
+               (until is not None and part.first >= until):
+                continue
+            if (since is None or part.first >= since) and \
+               (until is None or part.last < until):
+                aggregate.merge(part)
+                continue
+            # an edge of the range, read it from the last mark before since
+            start = chunk['start']
+            if since is not None and chunk['marks']:
+                times = [mark[0] for mark in chunk['marks']]
+                index = bisect_right(times, since) - 1
+                if index > 0:
+                    start = chunk['marks'][index][1]
+            log_file.scan(start, chunk['end'], aggregate, since, until)
+        # the end of the file is not indexed
+        log_file.scan(self.indexed_to, log_file.size, aggregate, since, until)
+
+
+def rotation_order(path):
+    '''
+    Sort key putting rotated files first, oldest (highest suffix) first
+    '''
+    base, ext = os.path.splitext(path)
+    if ext[1:].isdigit():
+        return (base, -int(ext[1:]))
+    return (path, 0)
+
+
+def restart_storms(spawns, count=STORM_SPAWNS, window=STORM_WINDOW):
+    '''
+    Returns [(cluster, storms, peak, first)] for the clusters spawned at
+    least count times within window seconds: the number of separate
+    storms, the most spawns within a window and when the first storm began
+    '''
+    storms = []
+    for cid, times in spawns.items():
+        times = sorted(times)
+        found = 0
+        peak = 0
+        first = None
+        in_storm = False
+        left = 0
+        for right in range(len(times)):
+            while times[right] - times[left] > window:
+                left += 1
+            spawned = right - left + 1
+            peak = max(peak, spawned)
+            # a storm lasts as long as the window stays full enough
+            if spawned >= count and not in_storm:
+                found += 1
+                if first is None:
+                    first = times[left]
+            in_storm = spawned >= count
+        if found:
+            storms.append((cid, found, peak, first))
+    storms.sort(key=lambda storm: (-storm[1], -storm[2]))
+    return storms
+
+
+def _cluster_key(cid):
+    return (0, int(cid)) if cid.isdigit() else (1, cid)
+
+
+def _format_time(ts):
+    if ts is None:
+        return "-"
+    return time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(ts))
+
+
+def print_report(aggregate, since, until, storm_count, storm_window, top):
+    first = since if since is not None else aggregate.first
+    last = until if until is not None else aggregate.last
+    print "Range: %s - %s" % (_format_time(first), _format_time(last))
+    span = max((last or 0) - (first or 0), 60)
+
+    clusters = set(aggregate.spawns) | set(aggregate.stops) | \
+               set(aggregate.exits) | set(aggregate.killed)
+    print
+    print "%-10s %8s %8s %8s %8s" \
+          % ("cluster", "spawns", "stops", "exits", "killed")
+    for cid in sorted(clusters, key=_cluster_key):
+        print "%-10s %8d %8d %8d %8d" \
+              % (cid, len(aggregate.spawns.get(cid, [])), \
+                 aggregate.stops.get(cid, 0), aggregate.exits.get(cid, 0), \
+                 aggregate.killed.get(cid, 0))
+
+    storms = restart_storms(aggregate.spawns, storm_count, storm_window)
+    print
+    print "Restart storms, %d spawns or more within %d seconds: %d clusters" \
+          % (storm_count, storm_window, len(storms))
+    if storms:
+        print "%-10s %7s %5s  %s" % ("cluster", "storms", "peak", "first")
+        for cid, found, peak, first_storm in storms:
+            print "%-10s %7d %5d  %s" \
+                  % (cid, found, peak, _format_time(first_storm))
+
+    errors = sorted(aggregate.errors.items(), key=lambda item: -item[1][0])
+    print
+    print "Error fingerprints: %d, top %d" % (len(errors), min(top, len(errors)))
+    if errors:
+        print "%8s %8s  %-19s  %-19s  %s" \
+              % ("count", "per min", "first", "last", "fingerprint")
+    for key, (count, first_seen, last_seen, locations) in errors[:top]:
+        print "%8d %8.2f  %s  %s  %s" \
+              % (count, count * 60.0 / span, _format_time(first_seen), \
+                 _format_time(last_seen), key)
+        for location in locations:
+            print "%58s %s" % ("", location)
+
+
+def analyze(paths, since=None, until=None, index_dir=None, use_index=True):
+    '''
+    Returns (aggregate of paths within [since, until), stats) where stats
+    has the number of files, bytes, chunks taken from the indexes and
+    chunks built by this call
+    '''
+    aggregate = Aggregate()
+    stats = {'files': 0, 'bytes': 0, 'chunks': 0, 'built': 0}
+    for path in sorted(paths, key=rotation_order):
+        log_file = LogFile(path)
+        try:
+            stats['files'] += 1
+            stats['bytes'] += log_file.size
+            if not use_index:
+                log_file.scan(0, log_file.size, aggregate, since, until)
+                continue
+            directory = index_dir or \
+                        os.path.join(os.path.dirname(path) or '.', \
+                                     '.log_index')
+            if not os.path.isdir(directory):
+                try:
+                    os.makedirs(directory)
+                except OSError:
+                    # read only, build the index but do not keep it
+                    directory = None
+            index = Index(log_file, directory)
+            if index.update():
+                index.save()
+            stats['chunks'] += len(index.chunks)
+            stats['built'] += index.built
+            index.query(aggregate, since, until)
+        finally:
+            log_file.close()
+    return aggregate, stats
+
+
+def _usage(msg=None):
+    if msg:
+        print >> sys.stderr, msg
+    print >> sys.stderr, """
+Usage: %s [options] LOGFILE...
+
+LOGFILE can be a glob, e.g. 'logs/monitor.log*'.
+
+Options:
+    -s, --since TIME      : Only records from TIME on, 'YYYY-mm-dd HH:MM[:SS]'
+    -u, --until TIME      : Only records before TIME
+    -n, --top N           : Error fingerprints to show (default 20)
+    --storm N/SECONDS     : Spawns of one cluster within SECONDS making a
+                            restart storm (default %d/%d)
+    --index-dir DIR       : Keep the indexes in DIR instead of .log_index
+                            next to the files
+    --no-index            : Read the files through, do not use an index
+    -h, --help            : Display help
+""" % (os.path.basename(sys.argv[0]), STORM_SPAWNS, STORM_WINDOW)
+    sys.exit(1)
+
+
+def _parse_time_option(value):
+    for fmt in ('%Y-%m-%d %H:%M:%S', '%Y-%m-%d %H:%M', '%Y-%m-%d'):
+        try:
+            return time.mktime(time.strptime(value, fmt))
+        except ValueError:
+            pass
+    _usage("Invalid time %r" % value)
+
+
+def main():
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], 'hs:u:n:', \
+                                   ["help", "since=", "until=", "top=", \
+                                    "storm=", "index-dir=", "no-index"])
+    except getopt.GetoptError, ex:
+        _usage("error parsing options: %s" % ex)
+    since = until = None
+    top = 20
+    storm_count = STORM_SPAWNS
+    storm_window = STORM_WINDOW
+    index_dir = None
+    use_index = True
+    for opt, value in opts:
+        if opt in ('-h', '--help'):
+            _usage()
+        elif opt in ('-s', '--since'):
+            since = _parse_time_option(value)
+        elif opt in ('-u', '--until'):
+            until = _parse_time_option(value)
+        elif opt in ('-n', '--top'):
+            top = int(value)
+        elif opt == '--storm':
+            try:
+                storm_count, storm_window = [int(v) for v in value.split('/')]
+            except ValueError:
+                _usage("Invalid --storm %r, expected N/SECONDS" % value)
+        elif opt == '--index-dir':
+            index_dir = value
+        elif opt == '--no-index':
+            use_index = False
+    paths = []
+    for arg in args:
+        matches = glob.glob(arg) if glob.has_magic(arg) else [arg]
+        paths.extend(path for path in matches \
+                     if not path.endswith('.tmp') and os.path.isfile(path))
+    if not paths:
+        _usage("No log files given")
+
+    start = time.time()
+    aggregate, stats = analyze(paths, since, until, index_dir, use_index)
+    print "Files: %d, %.1f MB in %.3f seconds, %d chunks indexed, %d of " \
+          "them just now" % (stats['files'], stats['bytes'] / 1048576.0, \
+                             time.time() - start, stats['chunks'], \
+                             stats['built'])
+    print_report(aggregate, since, until, storm_count, storm_window, top)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,286 @@
+#!/usr/bin/python
+"""In-process metrics of the monitor supervisor.
+
+Counters, gauges and latency histograms live in a registry and are rendered
+in the Prometheus text exposition format by MetricsServer, which answers on
+a local Unix socket, e.g.::
+
+    curl --unix-socket /var/run/monitor_metrics.sock http://localhost/metrics
+    socat - UNIX-CONNECT:/var/run/monitor_metrics.sock
+
+Recording a value is an addition or two, there is no lock and no I/O; all
+the formatting is done by the server thread when somebody scrapes. As the
+recording side does not lock, a scrape racing with an update may see a
+histogram whose count is one observation ahead of its sum.
+
+Libraries create their metrics at import time::
+
+    _query_seconds = metrics.histogram("monitor_sqlite_query_seconds",
+                                       "Time to run a sqlite query")
+    with _query_seconds.time():
+        cursor.execute(query)
+"""
+
+import os, time, errno, socket, threading, bisect
+
+import log
+
+_logger = log.get_logger("lib.metrics", relative_name=True)
+
+# Upper bounds of the histogram buckets, in seconds. Sqlite queries take
+# well under a millisecond, stopping a stubborn monitor up to a minute.
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, \
+                   0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+# How long the server waits for a client to send its request. Clients
+# which send nothing, like socat, get the bare metrics after that.
+REQUEST_TIMEOUT = 0.5       # in seconds
+
+CONTENT_TYPE = "text/plain; version=0.0.4"
+
+
+def _format_value(value):
+    if isinstance(value, float):
+        if value == float('inf'):
+            return "+Inf"
+        return repr(value)
+    return str(value)
+
+
+class Counter(object):
+    """A value which only goes up
+    """
+    type_name = 'counter'
+
+    def __init__(self, name, help_text):
+        self.name = name
+        self.help = help_text
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def samples(self):
+        return [(self.name, self.value)]
+
+
+class Gauge(object):
+    """A value which goes up and down. If func is given the value is
+    func(), called only when the metrics are scraped.
+    """
+    type_name = 'gauge'
+
+    def __init__(self, name, help_text, func=None):
+        self.name = name
+        self.help = help_text
+        self.value = 0
+        self._func = func
+
+    def set(self, value):
+        self.value = value
+
+    def set_function(self, func):
+        self._func = func
+
+    def samples(self):
+        value = self.value
+        if self._func:
+            try:
+                value = self._func()
+            except Exception, ex:
+                _logger.debug("Failed to read gauge %s: %s", self.name, ex)
+        return [(self.name, value)]
+
+
+class _Timer(object):
+    def __init__(self, histogram):
+        self._histogram = histogram
+
+    def __enter__(self):
+        self._start = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self._histogram.observe(time.time() - self._start)
+        return False
+
+
+class Histogram(object):
+    """Counts observations, e.g. latencies, into buckets
+    """
+    type_name = 'histogram'
+
+    def __init__(self, name, help_text, buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help_text
+        self._bounds = sorted(buckets)
+        # one more for the observations above the last bound
+        self._counts = [0] * (len(self._bounds) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self._counts[bisect.bisect_left(self._bounds, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def time(self):
+        '''
+        Returns a context manager which observes the time spent in its body
+        '''
+        return _Timer(self)
+
+    def samples(self):
+        samples = []
+        cumulative = 0
+        for bound, count in zip(self._bounds + [float('inf')], self._counts):
+            cumulative += count
+            samples.append(('%s_bucket{le="%s"}' \
+                            % (self.name, _format_value(float(bound))), \
+                            cumulative))
+        samples.append((self.name + '_sum', self.sum))
+        samples.append((self.name + '_count', self.count))
+        return samples
+
+
+class MetricsRegistry(object):
+    """The set of metrics rendered together
+    """
+    def __init__(self):
+        self._metrics = []
+        self._by_name = {}
+
+    def register(self, metric):
+        '''
+        Add metric, returns the one already registered under its name if any
+        '''
+        existing = self._by_name.get(metric.name)
+        if existing:
+            if existing.type_name != metric.type_name:
+                raise ValueError("Metric %s is already registered as a %s" \
+                                 % (metric.name, existing.type_name))
+            return existing
+        self._by_name[metric.name] = metric
+        self._metrics.append(metric)
+        return metric
+
+    def get(self, name):
+        return self._by_name.get(name)
+
+    def render(self):
+        '''
+        Returns all the metrics in the Prometheus text format
+        '''
+        lines = []
+        for metric in list(self._metrics):
+            lines.append("# HELP %s %s" % (metric.name, metric.help))
+            lines.append("# TYPE %s %s" % (metric.name, metric.type_name))
+            for name, value in metric.samples():
+                lines.append("%s %s" % (name, _format_value(value)))
+        return "\n".join(lines) + "\n"
+
+
+# The registry used unless told otherwise
+REGISTRY = MetricsRegistry()
+
+def counter(name, help_text, registry=REGISTRY):
+    return registry.register(Counter(name, help_text))
+
+def gauge(name, help_text, func=None, registry=REGISTRY):
+    return registry.register(Gauge(name, help_text, func))
+
+def histogram(name, help_text, buckets=LATENCY_BUCKETS, registry=REGISTRY):
+    return registry.register(Histogram(name, help_text, buckets))
+
+
+class MetricsServer(object):
+    """Serves the metrics of registry on the Unix socket path from a
+    daemon thread. A client sending an HTTP GET gets an HTTP response,
+    any other client the bare text.
+    """
+    def __init__(self, path, registry=REGISTRY):
+        self.path = path
+        self.registry = registry
+        self._sock = None
+        self._pid = None
+        self._thread = None
+
+    def start(self):
+        if os.path.exists(self.path):
+            # left behind by a previous instance
+            os.remove(self.path)
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            sock.bind(self.path)
+            os.chmod(self.path, 0600)
+            sock.listen(16)
+        except:
+            sock.close()
+            raise
+        self._sock = sock
+        self._pid = os.getpid()
+        self._thread = threading.Thread(target=self._serve, \
+                                        name="metrics-server")
+        self._thread.daemon = True
+        self._thread.start()
+        _logger.info("Serving metrics on %s" % self.path)
+
+    def _serve(self):
+        while True:
+            sock = self._sock
+            if sock is None:
+                return
+            try:
+                client, _addr = sock.accept()
+            except socket.error, ex:
+                if ex.args[0] == errno.EINTR:
+                    continue
+                # closed underneath us
+                return
+            try:
+                self._handle(client)
+            except Exception, ex:
+                _logger.debug("Failed to serve metrics: %s", ex)
+            finally:
+                client.close()
+
+    def _handle(self, client):
+        client.settimeout(REQUEST_TIMEOUT)
+        try:
+            request = client.recv(4096)
+        except socket.timeout:
+            request = ''
+        body = self.registry.render()
+        if request.startswith('GET ') or request.startswith('HEAD '):
+            header = "HTTP/1.0 200 OK\r\n" \
+                     "Content-Type: %s\r\n" \
+                     "Content-Length: %d\r\n\r\n" % (CONTENT_TYPE, len(body))
+            if request.startswith('HEAD '):
+                body = ''
+            body = header + body
+        client.sendall(body)
+
+    def close_in_child(self):
+        '''
+        To be called in a forked child: let go of the inherited listening
+        socket without removing the parent's socket file.
+        '''
+        if self._sock is not None and self._pid != os.getpid():
+            self._sock.close()
+            self._sock = None
+
+    def close(self):
+        if self._sock is None:
+            return
+        try:
+            # wakes up the accept() of the server thread
+            self._sock.shutdown(socket.SHUT_RDWR)
+        except socket.error:
+            pass
+        self._sock.close()
+        self._sock = None
+        if self._pid == os.getpid():
+            try:
+                os.remove(self.path)
+            except OSError:
+                pass
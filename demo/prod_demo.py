@@ -7,28 +7,102 @@
 import sys, socket, time
 import log
 import daemon
+import watcher
+import sqlite_cache
+import children
+import workers
+import metrics
 import os
 import getopt
 import ConfigParser
 import multiprocessing
 import sqlite3
-import traceback
 import signal
+import glob
+import select
+import errno
 
 _debug = False
+_watch = False
+
+# In worker mode the clusters are monitored by threads of a few worker
+# processes instead of a process each, see workers.py
+_worker_mode = False
+_num_workers = 0 # 0 means one per core
+
+# Number of monitor processes kept forked ahead of time, 0 to fork on demand
+_prefork_pool_size = 0
+
+# Unix socket the metrics are served on, None to not serve them
+_metrics_socket = None
+_metrics_server = None
+# Write the log files from a thread of the supervisor, see log.py
+_queue_logging = False
 CWD = os.getcwd()
 SCRIPT_VERSION = 1.0
 GLOBAL_LB_SQLITE_FILE = CWD+'/'+'lb.sqlite'
 LB_SQLITE_FILE = CWD+'/'+'lb_%s.sqlite'
+# lb.sqlite, lb_<id>.sqlite and their rollback/write ahead journals
+LB_SQLITE_PATTERN = r'^lb(_\d+)?\.sqlite(-journal|-wal)?$'
 SLEEP_INTERVAL = 5
+# In watch mode we only reconcile on changes, but still do a full scan this
+# often in case an event was missed.
+WATCH_RESCAN_INTERVAL = 60
+# A monitor that dies sooner than this after its start is not respawned
+# right away but on the next scan, so a crashing monitor cannot spin.
+RESPAWN_MIN_UPTIME = SLEEP_INTERVAL
 MAX_RETRY = 10
-gMonitoredClusters = {}
+# cluster id -> monitor process, kept up to date through SIGCHLD
+gMonitoredClusters = children.ChildRegistry()
+metrics.gauge("monitor_children", "Live monitor and worker processes", \
+              lambda: len(gMonitoredClusters))
+
+# Handles to lb.sqlite and lb_<id>.sqlite, kept open across cycles
+SQLITE_MAX_HANDLES = 512
+SQLITE_IDLE_TIMEOUT = 300 # in seconds
+_sqlite_handles = sqlite_cache.SqliteHandleCache(SQLITE_MAX_HANDLES, \
+                                                 SQLITE_IDLE_TIMEOUT)
+# alwayson status of the clusters, valid while lb_<id>.sqlite is unchanged
+_status_cache = sqlite_cache.StatusCache()
 
 TIME_TO_WAIT_FOR_CHILD_JOIN = 60 # in seconds
 
+# A monitor blocks on the parent death pipe, waking up this often to check
+# the monitor pid file and its quit flag.
+PARENT_CHECK_INTERVAL = 1 # in seconds
+
+# Set by the SIGTERM handler of a monitor process
+gSignalChildToQuit = False
+
+# Read end and write end of the parent death pipe. Only the supervisor keeps
+# the write end open, so the monitors see EOF the moment it goes away.
+gParentDeathPipe = (-1, -1)
+
 STATUS_UP = 1
 STATUS_DOWN = 0
 
+# Metrics of the supervisor, see metrics.py
+_cycle_seconds = metrics.histogram("monitor_cycle_seconds", \
+        "Time to reconcile the monitors with the sqlite files")
+_sqlite_query_seconds = metrics.histogram("monitor_sqlite_query_seconds", \
+        "Time to run a sqlite query, per attempt")
+_sqlite_retries = metrics.counter("monitor_sqlite_query_retries_total", \
+        "Sqlite queries retried after a failure")
+_sqlite_failures = metrics.counter("monitor_sqlite_query_failures_total", \
+        "Sqlite queries given up on after MAX_RETRY attempts")
+_spawn_seconds = metrics.histogram("monitor_spawn_seconds", \
+        "Time to start a monitor process")
+_stop_seconds = metrics.histogram("monitor_stop_seconds", \
+        "Time from SIGTERM to the exit of a monitor process")
+_stop_killed = metrics.counter("monitor_stop_killed_total", \
+        "Monitor processes killed after not quitting in time")
+_unexpected_exits = metrics.counter("monitor_unexpected_exits_total", \
+        "Monitor processes which exited without being asked to")
+_config_reloads = metrics.counter("monitor_config_reloads_total", \
+        "Configuration reloads which changed something")
+_prefork_idle = metrics.gauge("monitor_prefork_idle", \
+        "Idle pre-forked monitor processes")
+
 # Initialize logging
 log.set_logging_prefix("monitor")
 _logger = log.get_logger("monitor")
@@ -50,8 +124,10 @@ Usage: %s [options] [stop|restart]
 Options:
     -v, --version         : Report version and exit
     -d, --debug           : Run the program in debug mode
+    -w, --watch           : Reconcile on changes to the sqlite files instead
+                            of every %d seconds
     -h, --help            : Display help
-""" % (os.path.basename(sys.argv[0]))
+""" % (os.path.basename(sys.argv[0]), SLEEP_INTERVAL)
     sys.exit(1)
 
 #
@@ -98,6 +174,95 @@ def get_config_parser(config_file, options={}):
     config.read(config_file)
     return config
 
+def read_worker_config(config, section='default'):
+    '''
+    Pick up worker_mode, monitor_workers and prefork_pool_size from the
+    configuration
+    '''
+    global _worker_mode, _num_workers, _prefork_pool_size
+    if config.has_option(section, 'worker_mode'):
+        _worker_mode = config.getboolean(section, 'worker_mode')
+    if config.has_option(section, 'monitor_workers'):
+        _num_workers = config.getint(section, 'monitor_workers')
+    if config.has_option(section, 'prefork_pool_size'):
+        _prefork_pool_size = config.getint(section, 'prefork_pool_size')
+
+def diff_config(old, new):
+    '''
+    Returns what changed from config old to config new as
+    {section: {option: value}}, a value of None meaning the option is gone
+    '''
+    changes = {}
+    sections = set(new.sections())
+    if old:
+        sections.update(old.sections())
+    for section in sections:
+        old_items = {}
+        if old and old.has_section(section):
+            old_items = dict(old.items(section, raw=True))
+        new_items = {}
+        if new.has_section(section):
+            new_items = dict(new.items(section, raw=True))
+        for option in set(old_items) | set(new_items):
+            if old_items.get(option) != new_items.get(option):
+                changes.setdefault(section, {})[option] = \
+                        new_items.get(option)
+    return changes
+
+def update_config(config, changes):
+    '''
+    Apply changes as returned by diff_config() to config
+    '''
+    for section, options in changes.items():
+        if not config.has_section(section):
+            config.add_section(section)
+        for option, value in options.items():
+            if value is None:
+                config.remove_option(section, option)
+            else:
+                config.set(section, option, value)
+
+def _changed_options(changes):
+    return sorted("%s.%s" % (section, option) \
+                  for section, options in changes.items() \
+                  for option in options)
+
+def apply_control_message(message):
+    '''
+    Act on a message the supervisor sent over the control pipe of a monitor
+    or worker process
+    '''
+    global _config
+    command = message[0]
+    if command == 'reload':
+        _command, changes, logging_changed = message
+        if _config is None:
+            _config = ConfigParser.SafeConfigParser()
+        update_config(_config, changes)
+        if logging_changed:
+            log.reload_logging()
+        _logger.info("Monitor(pid %d): Reloaded configuration, changed: %s", \
+                     os.getpid(), _changed_options(changes))
+    else:
+        _logger.warn("Monitor(pid %d): Unknown command %r from parent" \
+                     % (os.getpid(), command))
+
+def read_metrics_config(config, section='default'):
+    '''
+    Pick up metrics_socket from the configuration, empty disables it
+    '''
+    global _metrics_socket
+    if config.has_option(section, 'metrics_socket'):
+        _metrics_socket = config.get(section, 'metrics_socket').strip() or None
+
+def read_logging_config(config, section='default'):
+    '''
+    Pick up queue_logging from the configuration
+    '''
+    global _queue_logging
+    if config.has_option(section, 'queue_logging'):
+        _queue_logging = config.getboolean(section, 'queue_logging')
+
 def read_pid(pidfile):
     '''
     Check if the pid file is existing and read the pid
@@ -120,10 +285,14 @@ def read_pid(pidfile):
 # The class that will actually maonitor the changes
 # This is where we will implement the monitoring logic
 #
-def MonitorUtils(object):
-    def __init__(self, clusterid, parent_pid):
+class MonitorUtils(object):
+    def __init__(self, clusterid, parent_pid, parent_death_fd=-1, \
+                 control_conn=None):
         self._cluster_id = clusterid
         self._parent_pid = parent_pid
+        self._parent_death_fd = parent_death_fd
+        # the parent sends configuration changes over it
+        self._control_conn = control_conn
         _logger.info("Monitor Utlity initialized")
 
     def _is_parent_alive(self):
@@ -133,10 +302,42 @@ def MonitorUtils(object):
         if not os.path.exists("/var/run/monitor.pid"):
             return False
 
-        pid_file = "/proc/" + str(self._parent_pid)
-        if os.path.exists(pid_file):
-            return True
-        return False
+        # once our parent is gone we get reparented
+        return os.getppid() == self._parent_pid
+
+    def _wait_for_parent(self, timeout):
+        '''
+        Sleep up to timeout seconds. Returns early when the parent dies,
+        as the parent death pipe then reads EOF, or when a signal arrives.
+        Messages from the parent are handled as they come in.
+        '''
+        fds = []
+        if self._parent_death_fd >= 0:
+            fds.append(self._parent_death_fd)
+        if self._control_conn:
+            fds.append(self._control_conn.fileno())
+        if not fds:
+            time.sleep(timeout)
+            return
+        try:
+            readable = select.select(fds, [], [], timeout)[0]
+        except select.error, ex:
+            # interrupted by a signal, our caller looks at the quit flag
+            if ex.args[0] != errno.EINTR:
+                raise
+            return
+        if self._control_conn and self._control_conn.fileno() in readable:
+            self._handle_control_message()
+
+    def _handle_control_message(self):
+        try:
+            message = self._control_conn.recv()
+        except (EOFError, IOError):
+            # the parent closed it, the death pipe tells us if it is gone
+            self._control_conn.close()
+            self._control_conn = None
+            return
+        apply_control_message(message)
 
     def startMonitor(self):
         while True:
@@ -144,8 +345,17 @@ def MonitorUtils(object):
                 sys.exit()
             if not self._is_parent_alive():
                 _logger.info("Monitor(%d): Parent is gone away.. " \
-                             "Exiting now" % self._cluster_id)
+                             "Exiting now", self._cluster_id, \
+                             cid=self._cluster_id)
                 return
+            self._wait_for_parent(PARENT_CHECK_INTERVAL)
+
+    def run(self, stop_event):
+        '''
+        Monitor the cluster from a thread of a worker process until
+        stop_event is set. The worker process looks after the parent.
+        '''
+        stop_event.wait()
 
 def cleanup_monitor_process(signum, frame):
     '''
@@ -162,12 +372,100 @@ def cleanup_monitor_process(signum, frame):
     except Exception, ex:
         _logger.error('Failed to remove marker file: %s' % gMonitorProcessMarkerFile)
 
-        
-def monitor_routine(cluster_id, parent_pid):
+
+def quit_worker_process(signum, frame):
+    '''
+    Ask the worker process to stop its monitors and exit
+    '''
+    global gSignalChildToQuit
+    gSignalChildToQuit = True
+
+def _setup_child_process():
+    '''
+    First thing to do in a forked monitor or worker process. Returns the
+    read end of the parent death pipe.
+    '''
+    # the parent's children and SIGCHLD handling are none of our business
+    gMonitoredClusters.reset_in_child()
+    _sqlite_handles.close_in_child()
+    if _metrics_server:
+        _metrics_server.close_in_child()
+
+    # we must not hold the write end, or we would never see EOF on it
+    parent_death_fd, parent_death_w = gParentDeathPipe
+    if parent_death_w >= 0:
+        os.close(parent_death_w)
+    return parent_death_fd
+
+def worker_routine(index, parent_pid, conn):
+    '''
+    The Main Function of a worker process, monitors the clusters the parent
+    assigns to it over conn, each from its own thread.
+    '''
+    parent_death_fd = _setup_child_process()
+
+    signal.signal(signal.SIGTERM, quit_worker_process)
+    # configuration changes come over conn, see apply_control_message()
+    signal.signal(signal.SIGHUP, signal.SIG_IGN)
+
+    # get a SIGTERM as soon as the parent dies, it might already have
+    children.set_parent_death_signal(signal.SIGTERM)
+    if os.getppid() != parent_pid:
+        sys.exit(0)
+
+    worker = workers.ShardWorker(index, conn, \
+                                 lambda cid: MonitorUtils(cid, parent_pid), \
+                                 parent_death_fd, apply_control_message)
+    # like the monitors, quit once the pid file of the supervisor is gone;
+    # it waits for us before exiting
+    should_quit = lambda: gSignalChildToQuit or \
+                          not os.path.exists("/var/run/monitor.pid")
+    try:
+        worker.run(should_quit)
+    except Exception, ex:
+        _logger.exception("Worker(%d): Instance failed: %s", index, ex)
+        sys.exit(1)
+    sys.exit(0)
+
+def pooled_monitor_routine(parent_pid, conn):
+    '''
+    The Main Function of a pre-forked monitor process. Does everything which
+    does not depend on the cluster up front, then waits for the parent to
+    hand it a cluster over conn.
+    '''
+    parent_death_fd = _setup_child_process()
+
+    # until we have a cluster there is nothing to clean up on the way out
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    signal.signal(signal.SIGHUP, signal.SIG_IGN)
+    children.set_parent_death_signal(signal.SIGTERM)
+    if os.getppid() != parent_pid:
+        sys.exit(0)
+
+    try:
+        message = conn.recv()
+    except (EOFError, IOError):
+        # the parent is gone or does not need us any more
+        sys.exit(0)
+    command, cluster_id = message
+    if command != 'monitor':
+        _logger.error("Monitor: Unknown command %r from parent" % (command,))
+        sys.exit(1)
+    # from now on conn carries configuration changes
+    _monitor_cluster(cluster_id, parent_pid, parent_death_fd, conn)
+
+def monitor_routine(cluster_id, parent_pid, conn=None):
     '''
     The Main Function which does the monitoring of the server role change over
     the VNN
     '''
+    parent_death_fd = _setup_child_process()
+    _monitor_cluster(cluster_id, parent_pid, parent_death_fd, conn)
+
+def _monitor_cluster(cluster_id, parent_pid, parent_death_fd, conn=None):
+    '''
+    Monitor cluster_id until told to quit or the parent goes away, then exit
+    '''
     # set the marker file
     global gMonitorProcessMarkerFile
     gMonitorProcessMarkerFile = "/var/run/monitor_%d.file" % cluster_id
@@ -187,18 +485,22 @@ def monitor_routine(cluster_id, parent_pid):
                      "Exiting now" % cluster_id)
         sys.exit(0)
 
-    # resgister to handle SIGTERM & SIGHUP
-    signals = [signal.SIGTERM, signal.SIGHUP]
-    for s in signals:
-        signal.signal(s, cleanup_monitor_process)
+    # resgister to handle SIGTERM, configuration changes come over conn
+    signal.signal(signal.SIGTERM, cleanup_monitor_process)
+    signal.signal(signal.SIGHUP, signal.SIG_IGN)
 
-    mon_object = MonitorUtils(cluster_id, parent_pid)
+    # get a SIGTERM as soon as the parent dies, it might already have
+    children.set_parent_death_signal(signal.SIGTERM)
+    if os.getppid() != parent_pid:
+        cleanup_monitor_process(signal.SIGTERM, None)
+        sys.exit(0)
+
+    mon_object = MonitorUtils(cluster_id, parent_pid, parent_death_fd, conn)
     try:
         mon_object.startMonitor()
     except Exception, ex:
-        _logger.error("Monitor(%d): Instance failed: %s" \
-                      % (cluster_id, ex))
-        _logger.error("%s" % (traceback.format_exc(),))
+        _logger.exception("Monitor(%d): Instance failed: %s", \
+                          cluster_id, ex, cid=cluster_id)
 
     # if we are here then we need to exit, probably because parent is gone away.
     try:
@@ -216,21 +518,32 @@ def monitor_routine(cluster_id, parent_pid):
 class MonitorDaemon(daemon.Daemon):
     """This class runs Monitor as a daemon
     """
+    # clusters which should have a monitor as of the last reconcile
+    _wanted_cids = frozenset()
+    # the worker processes in worker mode
+    _workers = None
+    # idle monitor processes waiting for a cluster
+    _pool = None
+    # set by the SIGHUP handler, the main loop does the actual reload
+    _reload_requested = False
+
     def get_list_of_cluster_ids(self):
         '''
         Return list of active as well as stopped cluster ids.
         '''
         running_cluster_ids = []
         stopped_cluster_ids = []
-        sqlite_handle = get_sqlite_handle(GLOBAL_LB_SQLITE_FILE)
+        sqlite_handle = _sqlite_handles.get(GLOBAL_LB_SQLITE_FILE)
         if sqlite_handle:
             db_cursor = sqlite_handle.cursor()
             query = "select status,id from lb_summary where status<>9;"
             retry = 0
             while retry < MAX_RETRY:
                 try:
-                    db_cursor.execute(query)
-                    for row in db_cursor.fetchall():
+                    with _sqlite_query_seconds.time():
+                        db_cursor.execute(query)
+                        rows = db_cursor.fetchall()
+                    for row in rows:
                         if int(row['status']) == STATUS_UP:
                             running_cluster_ids.append(int(row['id']))
                         else:
@@ -239,11 +552,15 @@ class MonitorDaemon(daemon.Daemon):
                 except Exception, ex:
                     retry = retry + 1
                     if retry >= MAX_RETRY:
+                        _sqlite_failures.inc()
                         _logger.error("Failed to find list of all clusters: %s" % ex)
+                        _sqlite_handles.invalidate(GLOBAL_LB_SQLITE_FILE)
                     else:
+                        _sqlite_retries.inc()
                         time.sleep(0.1)
 
-            close_sqlite_resources(sqlite_handle, db_cursor)
+            # the handle stays cached for the next cycle
+            close_sqlite_resources(None, db_cursor)
         return running_cluster_ids, stopped_cluster_ids
 
     def _read_status(self, clusterid):
@@ -254,26 +571,37 @@ class MonitorDaemon(daemon.Daemon):
         status = False
         query = "select alwayson from lb_clusters"
 
-        sqlite_handle = get_sqlite_handle(LB_SQLITE_FILE % clusterid)
+        db_name = LB_SQLITE_FILE % clusterid
+        hit, cached_status, signature = _status_cache.lookup(db_name)
+        if hit:
+            return cached_status
+
+        sqlite_handle = _sqlite_handles.get(db_name)
         if sqlite_handle:
             db_cursor = sqlite_handle.cursor()
             retry = 0
             while retry < MAX_RETRY:
                 try:
-                    db_cursor.execute(query)
-                    row = db_cursor.fetchone()
+                    with _sqlite_query_seconds.time():
+                        db_cursor.execute(query)
+                        row = db_cursor.fetchone()
                     if row:
                         status = True if int(row['alwayson']) else False
+                    _status_cache.store(db_name, signature, status)
                     break
                 except Exception, ex:
                     retry = retry + 1
                     if retry >= MAX_RETRY:
+                        _sqlite_failures.inc()
                         _logger.error("Failed to read always_on status of" \
                                       " clusters: %s" % ex)
+                        _sqlite_handles.invalidate(db_name)
                     else:
+                        _sqlite_retries.inc()
                         time.sleep(0.1)
 
-            close_sqlite_resources(sqlite_handle, db_cursor)
+            # the handle stays cached for the next cycle
+            close_sqlite_resources(None, db_cursor)
         return status
 
     def _cleanup_marker_files(self):
@@ -285,40 +613,57 @@ class MonitorDaemon(daemon.Daemon):
             if os.path.exists(_file):
                 os.remove(_file)
 
-    def _stop_monitor_process_for_cluster(self, cid):
+    def _log_stop_results(self, results, elapsed):
         '''
-        Send a SIGTERM to the monitor process for cluster <cid> .
+        Report how long each monitor took to exit after SIGTERM
         '''
-        phandle = gMonitoredClusters[cid]
-        if phandle.is_alive():
-            _logger.info("Parent: Cluster %d is marked down" % cid)
-            _logger.info("Parent: Stopping monitor process for " \
-                         "cluster: %d" % int(cid))
-            phandle.terminate()
-            #
-            # After issuing SIGTERM we wait for 60 seconds at max for this process
-            # to join. If it does not then we send a SIGKILL and remove its
-            # marker file.
-            # A possible race condition can reach here. Consider a case where
-            # after SIGTERM child has removed its marker file but has not yet
-            # joined in. 
-            phandle.join(TIME_TO_WAIT_FOR_CHILD_JOIN)
-            # check if process is still alive
-            try:
-                os.kill(phandle.pid, 0)
-                # if still here this process is taking too much time, we kill it
-                _logger.warn("Parent: Monitor process for cluster:" \
-                             "%d is taking too long (> %d seconds) to quit, " \
-                             "killing it now " % (cid, TIME_TO_WAIT_FOR_CHILD_JOIN))
-                os.kill(phandle.pid, 9)
-
-                # now join it so as to collect resources
-                phandle.join()
-            except Exception, ex:
-                # process has stopped
-                pass
-            _logger.info("Parent: Successfully Stopped monitor " \
-                         "process for cluster: %d" % int(cid))
+        for res in sorted(results, key=lambda r: r.latency):
+            _stop_seconds.observe(res.latency)
+            if res.killed:
+                _stop_killed.inc()
+                _logger.warn("Parent: Monitor process %d for cluster: %s " \
+                             "did not quit within %d seconds, killed it " \
+                             "after %.3f seconds" % (res.pid, res.key, \
+                             TIME_TO_WAIT_FOR_CHILD_JOIN, res.latency))
+            else:
+                _logger.info("Parent: Successfully Stopped monitor " \
+                             "process %d for cluster: %s in %.3f seconds", \
+                             res.pid, res.key, res.latency, cid=res.key, \
+                             pid=res.pid)
+        if results:
+            killed = len([res for res in results if res.killed])
+            _logger.info("Parent: Stopped %d monitor processes in %.3f " \
+                         "seconds, %d had to be killed", \
+                         len(results), elapsed, killed)
+
+    def _stop_monitor_processes_for_clusters(self, cids):
+        '''
+        Send a SIGTERM to the monitor processes of all the clusters in <cids>
+        at once and wait for them to quit.
+        '''
+        targets = {}
+        for cid in cids:
+            phandle = gMonitoredClusters.get(cid)
+            if phandle and phandle.is_alive():
+                _logger.info("Parent: Cluster %d is marked down", cid, \
+                             cid=cid)
+                _logger.info("Parent: Stopping monitor process for " \
+                             "cluster: %d", cid, cid=cid, pid=phandle.pid)
+                targets[cid] = phandle
+        if not targets:
+            return
+        #
+        # All of them share one deadline of TIME_TO_WAIT_FOR_CHILD_JOIN
+        # seconds, whatever is still alive then gets a SIGKILL.
+        # A possible race condition can reach here. Consider a case where
+        # after SIGTERM child has removed its marker file but has not yet
+        # joined in.
+        #
+        start = time.time()
+        results = children.stop_processes(targets, TIME_TO_WAIT_FOR_CHILD_JOIN)
+        self._log_stop_results(results, time.time() - start)
+        for cid in targets:
+            gMonitoredClusters.remove(cid)
 
     def _signal_handler(self, signum, frame):
         '''
@@ -332,111 +677,335 @@ class MonitorDaemon(daemon.Daemon):
         if len(plist) > 0:
             _logger.info("Parent: Found %d monitor children. Sending" \
                          " termination signal. " % (len(plist), ))
-
-            for phandle in plist:
-                if phandle.is_alive():
-                    #
-                    # p.terminate() issues SIGTERM to the child.
-                    #
-                    _logger.info("Parent: Terminating the process whose id: %d" % int(phandle.pid))
-                    phandle.terminate()
-            for phandle in plist:
-                if phandle.is_alive():
-                    phandle.join(TIME_TO_WAIT_FOR_CHILD_JOIN)
-
-                    try:
-                        os.kill(phandle.pid, 0)
-                        # if still here this process is taking too much time, we kill it
-                        os.kill(phandle.pid, 9)
-                        # now join it so as to collect resources
-                        phandle.join()
-                    except Exception, ex:
-                        # process has stopped
-                        pass
+            #
+            # p.terminate() issues SIGTERM to the child, all of them are
+            # signalled at once and share one deadline.
+            #
+            cids = dict((phandle.pid, cid) for cid, phandle \
+                        in gMonitoredClusters.items())
+            targets = dict((cids.get(phandle.pid, "pid %d" % phandle.pid), \
+                            phandle) for phandle in plist)
+            start = time.time()
+            results = children.stop_processes(targets, \
+                                              TIME_TO_WAIT_FOR_CHILD_JOIN)
+            self._log_stop_results(results, time.time() - start)
 
         self._cleanup_marker_files()
+        if _metrics_server:
+            _metrics_server.close()
         _logger.info("Monitor: Finished cleaning up.")
 
         # now we exit. since pid file is cleanedup by the calling instance's call
         # of stop() method, we donot have anything to cleanup as such.
         sys.exit()
 
+    def _sighup_handler(self, signum, frame):
+        '''
+        Ask the main loop to reload the configuration. The signal also wakes
+        it up through the SIGCHLD wakeup fd.
+        '''
+        self._reload_requested = True
+
     def _register_signal_handler(self):
         '''
         Registers a set of signals to catch.
         '''
-        signals = [signal.SIGTERM, signal.SIGHUP]
-        for s in signals:
-            signal.signal(s, self._signal_handler)
+        signal.signal(signal.SIGTERM, self._signal_handler)
+        signal.signal(signal.SIGHUP, self._sighup_handler)
+        # do not fail the syscall we happen to be in, e.g. a sqlite read
+        signal.siginterrupt(signal.SIGHUP, False)
+
+    def _resize_pool(self, changes):
+        '''
+        Apply a changed prefork_pool_size. The idle processes were forked
+        with the old configuration, so they are replaced in any case.
+        '''
+        global _prefork_pool_size
+        if self._workers:
+            return
+        if 'prefork_pool_size' in changes.get('default', {}):
+            try:
+                _prefork_pool_size = _config.getint('default', \
+                                                    'prefork_pool_size')
+            except (ConfigParser.Error, ValueError), ex:
+                _logger.error("Parent: Invalid prefork_pool_size, " \
+                              "keeping %d: %s" % (_prefork_pool_size, ex))
+        if self._pool is not None:
+            targets = dict((('idle', phandle.pid), phandle) \
+                           for phandle in self._pool.drain())
+            # they exit as soon as their pipe is closed
+            children.stop_processes(targets, TIME_TO_WAIT_FOR_CHILD_JOIN)
+        if _prefork_pool_size > 0:
+            if self._pool is not None:
+                self._pool.size = _prefork_pool_size
+            else:
+                self._pool = children.PreforkPool(pooled_monitor_routine, \
+                                                  _prefork_pool_size)
+        else:
+            self._pool = None
+
+    def _reload_configuration(self):
+        '''
+        Read monitor.conf and logging.conf again and push whatever changed
+        to the running monitors over their control pipes. Nothing is
+        restarted.
+        '''
+        global _config
+        start = time.time()
+        try:
+            new_config = get_config_parser(MONITOR_CONF)
+        except Exception, ex:
+            _logger.error("Parent: Failed to reload %s, keeping the " \
+                          "current configuration: %s" % (MONITOR_CONF, ex))
+            return
+        changes = diff_config(_config, new_config)
+        try:
+            logging_changed = log.reload_logging()
+        except Exception, ex:
+            _logger.error("Parent: Failed to reload the logging " \
+                          "configuration: %s" % ex)
+            logging_changed = False
+        if not changes and not logging_changed:
+            _logger.info("Parent: Got SIGHUP, configuration is unchanged")
+            return
+
+        _config = new_config
+        _config_reloads.inc()
+        for option in ('worker_mode', 'monitor_workers', 'metrics_socket', \
+                       'queue_logging'):
+            if option in changes.get('default', {}):
+                _logger.warn("Parent: %s changed, it takes effect on the " \
+                             "next restart" % option)
+        message = ('reload', changes, logging_changed)
+        notified = gMonitoredClusters.send_all(message)
+        if self._workers:
+            notified += self._workers.send_all(message)
+        self._resize_pool(changes)
+        _logger.info("Parent: Reloaded configuration in %.3f ms, " \
+                     "changed: %s, logging changed: %s, notified %d " \
+                     "processes" % ((time.time() - start) * 1000, \
+                     _changed_options(changes), logging_changed, notified))
+
+    def _spawn_monitor(self, cid):
+        '''
+        Start a monitor process for cluster <cid>. A marker file left
+        behind by a monitor which we do not know about, e.g. from before
+        a crash of the supervisor, is honoured if its process still lives
+        and removed otherwise.
+        '''
+        marker_file = "/var/run/monitor_%d.file" % cid
+        if os.path.exists(marker_file):
+            marker_pid = read_pid(marker_file)
+            if not marker_pid:
+                return
+            path = "/proc/%s" % marker_pid
+            if os.path.exists(path):
+                return
+            #
+            # The monitor died without cleaning up. Remove its marker
+            # and respawn it right away, in watch mode there might not
+            # be another cycle any time soon.
+            #
+            try:
+                os.remove(marker_file)
+            except:
+                _logger.error("Parent: Error on deleting marker file")
+                return
+        _logger.info("Parent: Spawning a new monitor " \
+                      "process for cluster: %d", cid, cid=cid)
+        start = time.time()
+        p = conn = None
+        if self._pool is not None:
+            # the pipe it got the cluster over becomes its control pipe
+            p, conn = self._pool.handoff(('monitor', cid))
+        if p is None:
+            reader, conn = multiprocessing.Pipe(duplex=False)
+            p = multiprocessing.Process(target=\
+                                        monitor_routine, \
+                                        args=(cid, os.getpid(), reader))
+            p.start()
+            reader.close()
+        gMonitoredClusters.add(cid, p, conn)
+        _spawn_seconds.observe(time.time() - start)
+
+    def _respawn_monitors(self, exited):
+        '''
+        Called with the (cluster id, process, uptime) of monitors which
+        exited on their own. Those whose cluster is still up are respawned
+        right away unless they did not even live RESPAWN_MIN_UPTIME seconds.
+        '''
+        for cid, phandle, uptime in exited:
+            if self._workers and self._workers.owns(cid):
+                self._workers.handle_exit(cid, phandle, uptime)
+                continue
+            _unexpected_exits.inc()
+            _logger.warn("Parent: Monitor process %d for cluster: %d " \
+                         "exited with code %s after %.1f seconds" \
+                         % (phandle.pid, cid, phandle.exitcode, uptime))
+            if cid in self._wanted_cids and uptime >= RESPAWN_MIN_UPTIME:
+                self._spawn_monitor(cid)
 
     def spwan_monitor_children(self):
         running_cluster_ids, stopped_cluster_ids = self.get_list_of_cluster_ids()
-        _logger.debug("Parent: Active clusters :%s, Stopped Clusters :%s"\
-                        % (running_cluster_ids, stopped_cluster_ids))
+        _logger.debug("Parent: Active clusters :%s, Stopped Clusters :%s", \
+                      running_cluster_ids, stopped_cluster_ids)
 
-        for cid in stopped_cluster_ids:
-            marker_file = "/var/run/monitor_%d.file" % cid
-            if os.path.exists(marker_file):
-                self._stop_monitor_process_for_cluster(cid)
+        stop_cids = [cid for cid in stopped_cluster_ids \
+                     if cid in gMonitoredClusters]
+        self._stop_monitor_processes_for_clusters(stop_cids)
 
+        _status_cache.prune([LB_SQLITE_FILE % cid \
+                             for cid in running_cluster_ids])
         running_cluster_ids = [cid for cid in \
                 running_cluster_ids if self._read_status(cid)]
+        self._wanted_cids = set(running_cluster_ids)
+
+        if self._workers:
+            # the workers start and stop the monitors themselves
+            self._workers.assign(running_cluster_ids)
+            _sqlite_handles.evict_idle()
+            return
 
         for cid in running_cluster_ids:
-            marker_file = "/var/run/monitor_%d.file" % cid
-            if os.path.exists(marker_file) == False:
-                _logger.info("Parent: Spawning a new monitor " \
-                              "process for cluster: %d" % cid)
-                p = multiprocessing.Process(target=\
-                                            monitor_routine, \
-                                            args=(cid, os.getpid()))
-                p.start()
-                gMonitoredClusters[cid] = p
-            else:
-                marker_pid = read_pid(marker_file)
-                if marker_pid:
-                    path = "/proc/%s" % marker_pid
-                    check_path = os.path.exists(path)
-                    if check_path == False:
-                        try:
-                            os.remove(marker_file)
-                        except:
-                            _logger.error("Parent: Error on deleting marker file")
-    
+            # the registry knows whether our own monitor is alive
+            if cid not in gMonitoredClusters:
+                self._spawn_monitor(cid)
+
+        _sqlite_handles.evict_idle()
+
+    def _get_watcher(self):
+        '''
+        Returns a watcher for the sqlite files if running in watch mode,
+        None otherwise.
+        '''
+        if not _watch:
+            return None
+        try:
+            return watcher.get_watcher(CWD, LB_SQLITE_PATTERN)
+        except Exception, ex:
+            _logger.error("Parent: Failed to watch %s, falling back to " \
+                          "polling every %d seconds: %s" \
+                          % (CWD, SLEEP_INTERVAL, ex))
+        return None
+
     def run(self):
         try:
             self._register_signal_handler()
         except Exception, ex:
-            _logger.error("Parent: Failed to install signal handler: %s" % ex)
-            _logger.error("%s" % (traceback.format_exc(),))
+            _logger.exception("Parent: Failed to install signal handler: %s", \
+                              ex)
             sys.exit()
 
+        if _queue_logging:
+            # before any monitor is forked, they inherit the queue
+            try:
+                log.start_queue_logging()
+            except Exception, ex:
+                _logger.error("Parent: Failed to start the log writer, " \
+                              "logging directly: %s" % ex)
+
         while not os.path.exists(CWD+'/'+'lb.sqlite'):
             _logger.warn("Parent(%d): 'lb.sqlite' "\
                             "does not exist " % (os.getpid(),))
             time.sleep(1)
 
+        global gParentDeathPipe
+        gParentDeathPipe = os.pipe()
+
+        global _metrics_server
+        if _metrics_socket:
+            try:
+                _metrics_server = metrics.MetricsServer(_metrics_socket)
+                _metrics_server.start()
+            except Exception, ex:
+                _metrics_server = None
+                _logger.error("Parent: Failed to serve metrics on %s: %s" \
+                              % (_metrics_socket, ex))
+
+        try:
+            wakeup_fd = gMonitoredClusters.install()
+        except Exception, ex:
+            _logger.exception("Parent: Failed to install SIGCHLD handler: %s", \
+                              ex)
+            sys.exit()
+
+        if _worker_mode:
+            num_workers = _num_workers or workers.default_num_workers()
+            _logger.info("Parent: Monitoring clusters with %d worker " \
+                         "processes" % num_workers)
+            self._workers = workers.ShardedWorkers(worker_routine, \
+                                                   num_workers, \
+                                                   gMonitoredClusters, \
+                                                   RESPAWN_MIN_UPTIME)
+
+        elif _prefork_pool_size > 0:
+            self._pool = children.PreforkPool(pooled_monitor_routine, \
+                                              _prefork_pool_size)
+
+        lb_watcher = self._get_watcher()
+        if lb_watcher:
+            scan_interval = WATCH_RESCAN_INTERVAL
+        else:
+            scan_interval = SLEEP_INTERVAL
+        reconcile = True
+        last_scan = 0
         while True:
             try:
-                # cleanup any finished children
-                multiprocessing.active_children()
+                if self._reload_requested:
+                    self._reload_requested = False
+                    self._reload_configuration()
+
+                # respawn the monitors which went away since last time
+                exited = gMonitoredClusters.reap()
+                if exited:
+                    self._respawn_monitors(exited)
+                if time.time() - last_scan >= scan_interval:
+                    reconcile = True
                 #
                 # see if a new cluster has been added and that we need any
                 # monitor process for it.
                 #
-                self.spwan_monitor_children()
+                if reconcile:
+                    reconcile = False
+                    last_scan = time.time()
+                    with _cycle_seconds.time():
+                        self.spwan_monitor_children()
                 
+                # replace the idle monitors handed out above
+                if self._pool is not None:
+                    self._pool.refill()
+                    _prefork_idle.set(len(self._pool))
+
                 if not os.path.exists("/var/run/monitor.pid"):
                     _logger.warn("Monitor PID file is not Present Exiting Now")
+                    if _metrics_server:
+                        _metrics_server.close()
+                    if self._pool is not None:
+                        # the idle monitors exit once their pipe is closed,
+                        # otherwise exiting would wait for them forever
+                        self._pool.drain()
                     break
 
             except Exception, ex:
-                _logger.error("MonitorDaemon run failed: %s" % ex)
-                _logger.error("%s" % (traceback.format_exc(),))
+                reconcile = True
+                # logged in full once, then summarized, see DuplicateFilter
+                _logger.exception("MonitorDaemon run failed: %s", ex)
             finally:
-                _logger.debug("Parent: Sleeping for %f seconds" \
-                              % (SLEEP_INTERVAL))
-                time.sleep(SLEEP_INTERVAL)
+                # a child exiting or SIGHUP wakes us up early through
+                # wakeup_fd
+                timeout = min(SLEEP_INTERVAL, \
+                              max(last_scan + scan_interval - time.time(), 0))
+                if lb_watcher:
+                    changed = lb_watcher.wait(timeout, wakeup_fd)
+                    if changed:
+                        _logger.debug("Parent: Changed files: %s", \
+                                      sorted(changed))
+                        reconcile = True
+                else:
+                    _logger.debug("Parent: Sleeping for %f seconds", \
+                                  timeout)
+                    watcher.wait_readable([wakeup_fd], timeout)
+
 def main():
     '''
     Can only be execute as root, since we need to log in /var/run
@@ -449,8 +1018,8 @@ def main():
     # Parse the command line options
     try:
         opts, args = getopt.getopt(sys.argv[1:], \
-                            'hdv', \
-                            ["help", "debug", "version"])
+                            'hdvw', \
+                            ["help", "debug", "version", "watch"])
     except:
         _usage("error parsing options")
     for opt in opts:
@@ -463,13 +1032,19 @@ def main():
         elif opt[0] == '-d' or opt[0] == '--debug':
             global _debug
             _debug = True
+        elif opt[0] == '-w' or opt[0] == '--watch':
+            global _watch
+            _watch = True
     if len(args) > 2:
         _usage('Invalid args %s %d' % args, len(args))
 
-    # Initialize the logger
-    log.config_logging()
+    # Initialize the logger; the libraries got theirs when imported
+    log.config_logging(disable_existing_loggers=False)
     global _config
     _config = get_config_parser(MONITOR_CONF)
+    read_worker_config(_config)
+    read_metrics_config(_config)
+    read_logging_config(_config)
     
     monitor_daemon = MonitorDaemon('/var/run/monitor.pid')
     if args:
@@ -0,0 +1,148 @@
+#!/usr/bin/python
+# Compares starting monitor processes by forking on demand with handing the
+# cluster to a pre-forked process (prefork_pool_size in monitor.conf).
+# For each mode it reports how long _spawn_monitor takes to return, how long
+# until the monitor has written its marker file, and the memory of the
+# monitors.
+#
+# Has to run as root, the monitors write their marker files to /var/run.
+# Uses cluster ids from 900000 up so as not to collide with real ones.
+#
+import sys, os, time, getopt, logging
+
+import prod_demo
+import children
+import watcher
+
+FIRST_CLUSTER_ID = 900000
+PID_FILE = "/var/run/monitor.pid"
+
+
+def _usage(msg=None):
+    if msg:
+        print >> sys.stderr, msg
+    print >> sys.stderr, """
+Usage: %s [options]
+
+Options:
+    -n, --count N         : Number of monitors to start per mode (default 50)
+    -p, --pool-size N     : Size of the pre-forked pool (default 4)
+    -h, --help            : Display help
+""" % (os.path.basename(sys.argv[0]))
+    sys.exit(1)
+
+
+def _memory(pid):
+    '''
+    Returns (rss, pss, private) of pid in kB
+    '''
+    values = {'Rss': 0, 'Pss': 0, 'Private_Clean': 0, 'Private_Dirty': 0}
+    path = "/proc/%d/smaps_rollup" % pid
+    if not os.path.exists(path):
+        path = "/proc/%d/smaps" % pid
+    for line in open(path):
+        fields = line.split()
+        name = fields[0].rstrip(':')
+        if name in values:
+            values[name] += int(fields[1])
+    return (values['Rss'], values['Pss'], \
+            values['Private_Clean'] + values['Private_Dirty'])
+
+
+def _percentile(values, pct):
+    values = sorted(values)
+    return values[min(int(len(values) * pct / 100.0), len(values) - 1)]
+
+
+def _wait_for_marker(marker_watcher, cid, timeout=10):
+    # do not spin, on a small box we would steal the cpu from the monitor
+    marker_file = "/var/run/monitor_%d.file" % cid
+    deadline = time.time() + timeout
+    while not os.path.exists(marker_file):
+        if time.time() > deadline:
+            raise Exception("Monitor for %d did not start" % cid)
+        marker_watcher.wait(deadline - time.time())
+
+
+def run_mode(name, pool_size, count):
+    monitor_daemon = prod_demo.MonitorDaemon(PID_FILE)
+    if pool_size:
+        monitor_daemon._pool = children.PreforkPool( \
+                prod_demo.pooled_monitor_routine, pool_size)
+        monitor_daemon._pool.refill()
+        # let the pool settle, as it would have in a running supervisor
+        time.sleep(1)
+
+    marker_watcher = watcher.get_watcher("/var/run", r'^monitor_\d+\.file$', \
+                                         debounce=0)
+    calls = []
+    ready = []
+    for i in range(count):
+        cid = FIRST_CLUSTER_ID + i
+        start = time.time()
+        monitor_daemon._spawn_monitor(cid)
+        calls.append(time.time() - start)
+        _wait_for_marker(marker_watcher, cid)
+        ready.append(time.time() - start)
+        # the supervisor refills the pool once the cycle is done
+        if monitor_daemon._pool is not None:
+            monitor_daemon._pool.refill()
+
+    marker_watcher.close()
+    memory = [_memory(phandle.pid) for _cid, phandle \
+              in prod_demo.gMonitoredClusters.items()]
+
+    targets = dict(prod_demo.gMonitoredClusters.items())
+    if monitor_daemon._pool is not None:
+        for phandle in monitor_daemon._pool.drain():
+            targets[('idle', phandle.pid)] = phandle
+    children.stop_processes(targets, 10)
+    for cid, _phandle in prod_demo.gMonitoredClusters.items():
+        prod_demo.gMonitoredClusters.remove(cid)
+
+    print "%-8s spawn call p50 %8.3f ms  max %8.3f ms | " \
+          "monitor ready p50 %8.3f ms  p99 %8.3f ms" \
+          % (name, _percentile(calls, 50) * 1000, max(calls) * 1000, \
+             _percentile(ready, 50) * 1000, _percentile(ready, 99) * 1000)
+    print "%-8s per child RSS %6d kB  PSS %6d kB  private %6d kB (average)" \
+          % (name, sum(m[0] for m in memory) / len(memory), \
+             sum(m[1] for m in memory) / len(memory), \
+             sum(m[2] for m in memory) / len(memory))
+
+
+def main():
+    if not os.geteuid() == 0:
+        sys.exit("spawn_bench: You must be root to run this script\n")
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], 'hn:p:', \
+                                   ["help", "count=", "pool-size="])
+    except getopt.GetoptError, ex:
+        _usage("error parsing options: %s" % ex)
+    count = 50
+    pool_size = 4
+    for opt, value in opts:
+        if opt in ('-h', '--help'):
+            _usage()
+        elif opt in ('-n', '--count'):
+            count = int(value)
+        elif opt in ('-p', '--pool-size'):
+            pool_size = int(value)
+
+    logging.basicConfig(level=logging.WARN)
+    created_pid_file = False
+    if not os.path.exists(PID_FILE):
+        # the monitors quit as soon as they do not find it
+        open(PID_FILE, 'w').write("%d\n" % os.getpid())
+        created_pid_file = True
+
+    prod_demo.gParentDeathPipe = os.pipe()
+    prod_demo.gMonitoredClusters.install()
+    try:
+        run_mode("fork", 0, count)
+        run_mode("prefork", pool_size, count)
+    finally:
+        if created_pid_file:
+            os.remove(PID_FILE)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,237 @@
+#!/usr/bin/python
+"""Long lived sqlite handles for the monitor supervisor.
+
+Opening a sqlite database is not free: every connect() costs a handful of
+syscalls and the schema is parsed again on the first query. The supervisor
+reads the same databases over and over, so instead of opening and closing
+them every cycle it keeps the handles in a bounded LRU cache keyed by the
+database path.
+
+A cached handle is dropped when
+    - the cache is full and the handle is the least recently used one,
+    - it has not been used for idle_timeout seconds,
+    - the file it points to was deleted or replaced (different inode),
+    - the caller invalidates it, e.g. after a query failed.
+
+StatusCache goes one step further and remembers the result of a query for
+as long as the database file is unchanged, so only modified databases have
+to be queried at all.
+"""
+
+import os, time, sqlite3
+from collections import OrderedDict
+
+import log
+import metrics
+from watcher import file_signature
+
+_logger = log.get_logger("lib.sqlite_cache", relative_name=True)
+
+_open_seconds = metrics.histogram("monitor_sqlite_open_seconds", \
+                                  "Time to open a sqlite database")
+_handle_hits = metrics.counter("monitor_sqlite_handle_hits_total", \
+                               "Sqlite handles reused from the cache")
+_status_hits = metrics.counter("monitor_status_cache_hits_total", \
+                               "Cluster status answered without a query")
+_status_misses = metrics.counter("monitor_status_cache_misses_total", \
+                                 "Cluster status which had to be queried")
+
+DEFAULT_MAX_HANDLES = 512
+DEFAULT_IDLE_TIMEOUT = 300  # in seconds
+
+# A file modified this recently may be modified again without its mtime
+# changing, so results read from it are not trusted yet.
+RACY_WINDOW = 2             # in seconds
+
+
+def _file_identity(path):
+    '''
+    Returns (device, inode) of path or None if it does not exist
+    '''
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return (st.st_dev, st.st_ino)
+
+
+class SqliteHandleCache(object):
+    """A bounded LRU cache of sqlite connections keyed by database path.
+
+    A forked child must not use the connections of its parent. It calls
+    close_in_child() first thing, or the inherited connections are closed
+    the first time it uses the cache.
+    """
+    def __init__(self, max_handles=DEFAULT_MAX_HANDLES, \
+                 idle_timeout=DEFAULT_IDLE_TIMEOUT, timeout=30):
+        self.max_handles = max_handles
+        self.idle_timeout = idle_timeout
+        self.timeout = timeout
+        self._pid = os.getpid()
+        # db_name -> [connection, file identity, last used]
+        self._handles = OrderedDict()
+
+    def __len__(self):
+        return len(self._handles)
+
+    def _check_owner(self):
+        if self._pid != os.getpid():
+            self.close_in_child()
+
+    def close_in_child(self):
+        '''
+        To be called in a forked child: close the connections inherited
+        from the parent, which would otherwise keep their files open for
+        as long as the child lives. The parent's connections stay usable.
+        '''
+        if self._pid == os.getpid():
+            return
+        handles = self._handles
+        self._handles = OrderedDict()
+        self._pid = os.getpid()
+        for entry in handles.values():
+            self._close(entry[0])
+
+    def _close(self, conn):
+        try:
+            conn.close()
+        except Exception, ex:
+            _logger.debug("Failed to close sqlite handle: %s", ex)
+
+    def _open(self, db_name):
+        try:
+            with _open_seconds.time():
+                conn = sqlite3.connect(db_name, timeout=self.timeout)
+            # obtain all results as python dictionaries
+            conn.row_factory = sqlite3.Row
+            return conn
+        except Exception, ex:
+            _logger.error("Failed to open %s: %s" % (db_name, ex))
+            return None
+
+    def get(self, db_name):
+        '''
+        Returns a sqlite handle to db_name, reusing a cached one if the file
+        has not been replaced since. Returns None if the database does not
+        exist or cannot be opened. The handle stays owned by the cache, the
+        caller must only close its cursors.
+        '''
+        self._check_owner()
+        identity = _file_identity(db_name)
+        entry = self._handles.pop(db_name, None)
+        if entry:
+            if entry[1] == identity:
+                entry[2] = time.time()
+                self._handles[db_name] = entry
+                _handle_hits.inc()
+                return entry[0]
+            _logger.debug("%s was replaced or deleted, dropping its " \
+                          "handle", db_name)
+            self._close(entry[0])
+
+        # do not let sqlite create an empty database in place of a missing one
+        if identity is None:
+            return None
+
+        conn = self._open(db_name)
+        if conn is None:
+            return None
+        while len(self._handles) >= self.max_handles:
+            _name, old = self._handles.popitem(last=False)
+            self._close(old[0])
+        self._handles[db_name] = [conn, identity, time.time()]
+        return conn
+
+    def invalidate(self, db_name):
+        '''
+        Close and forget the cached handle of db_name, if any
+        '''
+        self._check_owner()
+        entry = self._handles.pop(db_name, None)
+        if entry:
+            self._close(entry[0])
+
+    def evict_idle(self):
+        '''
+        Close the handles that were not used for idle_timeout seconds.
+        Returns the number of handles closed.
+        '''
+        self._check_owner()
+        expired = time.time() - self.idle_timeout
+        evicted = 0
+        # the least recently used handles are at the front
+        for db_name, entry in self._handles.items():
+            if entry[2] > expired:
+                break
+            del self._handles[db_name]
+            self._close(entry[0])
+            evicted += 1
+        return evicted
+
+    def close_all(self):
+        '''
+        Close every cached handle
+        '''
+        self._check_owner()
+        while self._handles:
+            _name, entry = self._handles.popitem()
+            self._close(entry[0])
+
+
+class StatusCache(object):
+    """Remembers a value read from a sqlite database together with the
+    signature (inode, mtime, size) of the database and of its write ahead
+    log at the time it was read. As long as the signature is unchanged the
+    cached value is answered without touching the database.
+
+    Like git's racy-clean check, a value read from a file that was modified
+    less than RACY_WINDOW seconds earlier is not trusted, as a second write
+    within the same timestamp tick could go unnoticed.
+    """
+    def __init__(self):
+        # db_name -> (signature, value)
+        self._entries = {}
+
+    def __len__(self):
+        return len(self._entries)
+
+    def signature(self, db_name):
+        return (file_signature(db_name), file_signature(db_name + '-wal'))
+
+    def lookup(self, db_name):
+        '''
+        Returns (hit, value, signature). On a miss the caller reads the
+        database and hands the returned signature back to store(); it is
+        taken before the read so that a concurrent write causes another
+        miss next time instead of a stale hit.
+        '''
+        signature = self.signature(db_name)
+        entry = self._entries.get(db_name)
+        if entry and entry[0] == signature:
+            _status_hits.inc()
+            return True, entry[1], signature
+        _status_misses.inc()
+        return False, None, signature
+
+    def store(self, db_name, signature, value):
+        '''
+        Cache value read from db_name whose signature was signature
+        '''
+        now = time.time()
+        for sig in signature:
+            if sig and now - sig[2] < RACY_WINDOW:
+                signature = None
+                break
+        self._entries[db_name] = (signature, value)
+
+    def discard(self, db_name):
+        self._entries.pop(db_name, None)
+
+    def prune(self, db_names):
+        '''
+        Forget every database not in db_names
+        '''
+        keep = set(db_names)
+        for db_name in self._entries.keys():
+            if db_name not in keep:
+                del self._entries[db_name]
@@ -0,0 +1,258 @@
+#!/usr/bin/python
+"""Watch the load balancer sqlite files for changes.
+
+On Linux the watcher uses inotify (through ctypes) on the directory which
+holds the sqlite files, everywhere else it falls back to polling the files
+with stat(). Bursts of writes are debounced so that one configuration change,
+which usually touches the database and its journal several times, wakes the
+caller up only once.
+
+Typical usage::
+
+    watcher = get_watcher(directory, r'^lb(_\d+)?\.sqlite$')
+    while True:
+        changed = watcher.wait(timeout)
+        if changed:
+            reconcile()
+"""
+
+import os, re, time, select, errno, struct
+import ctypes, ctypes.util
+
+import log
+
+_logger = log.get_logger("lib.watcher", relative_name=True)
+
+# Returned by wait() when we know that something changed but not what, e.g.
+# when the kernel event queue overflowed.
+ALL_CHANGED = '*'
+
+DEFAULT_DEBOUNCE = 0.25     # quiet time that ends a burst, in seconds
+DEFAULT_MAX_DELAY = 1.0     # never hold back a change longer than this
+DEFAULT_POLL_INTERVAL = 1.0
+
+# inotify constants, see <sys/inotify.h>
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_Q_OVERFLOW = 0x00004000
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = 02000000
+
+_WATCH_MASK = IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | \
+              IN_CREATE | IN_DELETE
+_EVENT_HEADER = struct.Struct('iIII')
+
+
+def wait_readable(fds, timeout):
+    '''
+    Wait up to timeout seconds for any of fds to become readable and return
+    the readable ones. Signals do not cut the wait short unless they write
+    to one of fds (see signal.set_wakeup_fd).
+    '''
+    end = time.time() + timeout
+    while True:
+        remaining = end - time.time()
+        if remaining <= 0:
+            return []
+        try:
+            return select.select(fds, [], [], remaining)[0]
+        except select.error, ex:
+            if ex.args[0] != errno.EINTR:
+                raise
+
+
+def file_signature(path):
+    '''
+    Returns a tuple identifying the current version of a file, or None if the
+    file does not exist. A replaced file changes its inode, a modified one
+    its mtime and/or size.
+    '''
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return (st.st_dev, st.st_ino, st.st_mtime, st.st_size)
+
+
+class _BaseWatcher(object):
+    """Common part of the watchers. Subclasses implement _wait_event() which
+    blocks for at most timeout seconds and returns the set of changed names
+    and whether the wait was cut short by the wakeup fd.
+    """
+    def __init__(self, directory, pattern, debounce=DEFAULT_DEBOUNCE, \
+                 max_delay=DEFAULT_MAX_DELAY):
+        self.directory = directory
+        self._pattern = re.compile(pattern)
+        self.debounce = debounce
+        self.max_delay = max_delay
+
+    def _matches(self, name):
+        return self._pattern.match(name) is not None
+
+    def _wait_event(self, timeout, wakeup_fds):
+        raise NotImplementedError
+
+    def wait(self, timeout, wakeup_fd=None):
+        '''
+        Wait up to timeout seconds for a change to one of the watched files.
+        Returns the set of changed file names, an empty set on timeout.
+        Once a change is seen we keep collecting until the files have been
+        quiet for self.debounce seconds, but at most self.max_delay seconds.
+        If wakeup_fd becomes readable we return right away with whatever
+        was collected so far; draining it is up to the caller.
+        '''
+        wakeup_fds = [wakeup_fd] if wakeup_fd is not None else []
+        deadline = time.time() + timeout
+        changed = set()
+        burst_deadline = None
+        while True:
+            now = time.time()
+            if changed:
+                wait_for = min(self.debounce, burst_deadline - now)
+            else:
+                wait_for = deadline - now
+            if wait_for <= 0:
+                break
+            names, woken = self._wait_event(wait_for, wakeup_fds)
+            if not changed and names:
+                burst_deadline = time.time() + self.max_delay
+            changed |= names
+            if woken or not names:
+                # woken up, timed out or the burst has settled
+                break
+        return changed
+
+    def close(self):
+        pass
+
+
+class InotifyWatcher(_BaseWatcher):
+    """Watcher based on Linux inotify
+    """
+    def __init__(self, directory, pattern, **kwargs):
+        _BaseWatcher.__init__(self, directory, pattern, **kwargs)
+        libc_name = ctypes.util.find_library('c')
+        if not libc_name:
+            raise OSError(errno.ENOSYS, "libc not found")
+        libc = ctypes.CDLL(libc_name, use_errno=True)
+        if not hasattr(libc, 'inotify_init1'):
+            raise OSError(errno.ENOSYS, "inotify is not supported")
+        self._fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self._fd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err))
+        wd = libc.inotify_add_watch(self._fd, directory, _WATCH_MASK)
+        if wd < 0:
+            err = ctypes.get_errno()
+            os.close(self._fd)
+            raise OSError(err, "%s: %s" % (directory, os.strerror(err)))
+
+    def fileno(self):
+        return self._fd
+
+    def _read_events(self):
+        changed = set()
+        while True:
+            try:
+                buf = os.read(self._fd, 64 * 1024)
+            except OSError, ex:
+                if ex.errno in (errno.EAGAIN, errno.EINTR):
+                    break
+                raise
+            if not buf:
+                break
+            offset = 0
+            while offset < len(buf):
+                _wd, mask, _cookie, length = \
+                        _EVENT_HEADER.unpack_from(buf, offset)
+                offset += _EVENT_HEADER.size
+                name = buf[offset:offset + length].rstrip('\0')
+                offset += length
+                if mask & IN_Q_OVERFLOW:
+                    changed.add(ALL_CHANGED)
+                elif name and self._matches(name):
+                    changed.add(name)
+        return changed
+
+    def _wait_event(self, timeout, wakeup_fds):
+        end = time.time() + timeout
+        while True:
+            readable = wait_readable([self._fd] + wakeup_fds, \
+                                     end - time.time())
+            if not readable:
+                return set(), False
+            changed = set()
+            if self._fd in readable:
+                changed = self._read_events()
+            if len(readable) > 1 or self._fd not in readable:
+                return changed, True
+            # events for files we do not care about do not count
+            if changed:
+                return changed, False
+
+    def close(self):
+        if self._fd >= 0:
+            os.close(self._fd)
+            self._fd = -1
+
+
+class PollingWatcher(_BaseWatcher):
+    """Portable watcher which compares stat() signatures of the files
+    """
+    def __init__(self, directory, pattern, interval=DEFAULT_POLL_INTERVAL, \
+                 **kwargs):
+        _BaseWatcher.__init__(self, directory, pattern, **kwargs)
+        self.interval = interval
+        self._snapshot = {}
+        self._snapshot = self._take_snapshot()
+
+    def _take_snapshot(self):
+        snapshot = {}
+        try:
+            names = os.listdir(self.directory)
+        except OSError, ex:
+            _logger.error("Failed to list %s: %s" % (self.directory, ex))
+            return self._snapshot
+        for name in names:
+            if self._matches(name):
+                sig = file_signature(os.path.join(self.directory, name))
+                if sig:
+                    snapshot[name] = sig
+        return snapshot
+
+    def _wait_event(self, timeout, wakeup_fds):
+        end = time.time() + timeout
+        while True:
+            remaining = end - time.time()
+            if remaining <= 0:
+                return set(), False
+            woken = False
+            if wakeup_fds:
+                woken = bool(wait_readable(wakeup_fds, \
+                                           min(self.interval, remaining)))
+            else:
+                time.sleep(min(self.interval, remaining))
+            snapshot = self._take_snapshot()
+            changed = set(name for name in \
+                          set(snapshot) | set(self._snapshot) \
+                          if snapshot.get(name) != self._snapshot.get(name))
+            self._snapshot = snapshot
+            if changed or woken:
+                return changed, woken
+
+
+def get_watcher(directory, pattern, **kwargs):
+    '''
+    Returns the best watcher available on this platform for the files in
+    directory whose names match the regular expression pattern.
+    '''
+    try:
+        return InotifyWatcher(directory, pattern, **kwargs)
+    except (OSError, AttributeError), ex:
+        _logger.warn("inotify not available (%s), falling back to " \
+                     "polling %s" % (ex, directory))
+    return PollingWatcher(directory, pattern, **kwargs)
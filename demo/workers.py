@@ -0,0 +1,305 @@
+#!/usr/bin/python
+"""Monitor many clusters per process.
+
+Instead of one process per cluster, a small number of worker processes is
+started and the clusters are spread over them. Each worker runs one thread
+per cluster it owns.
+
+ShardedWorkers is the supervisor side. It decides which worker (shard) owns
+which cluster, keeping assignments sticky and the shards within one cluster
+of each other, and sends every worker the list of clusters it owns over a
+pipe whenever that list changes.
+
+ShardWorker is the worker side. It starts and stops the per-cluster monitor
+threads as its assignment changes and restarts a monitor that failed, with
+an increasing delay, without disturbing the other clusters of the shard.
+"""
+
+import os, time, select, errno, threading
+import multiprocessing
+
+import log
+
+_logger = log.get_logger("lib.workers", relative_name=True)
+
+# A failed monitor is restarted after this delay, doubling up to the max
+MIN_RESTART_DELAY = 1       # in seconds
+MAX_RESTART_DELAY = 60      # in seconds
+
+# How long a worker waits for a monitor thread to notice it has to stop
+THREAD_STOP_TIMEOUT = 5     # in seconds
+
+# How often a worker looks after its threads when nothing else happens
+WORKER_TICK = 1             # in seconds
+
+
+def default_num_workers():
+    try:
+        return multiprocessing.cpu_count()
+    except NotImplementedError:
+        return 1
+
+
+class ShardedWorkers(object):
+    """Supervisor side of the worker processes.
+
+    target is called in each worker process as
+    target(index, parent_pid, conn) where conn is the receiving end of the
+    control pipe. The processes are kept in registry under the key
+    ('worker', index).
+    """
+    def __init__(self, target, num_workers, registry, min_uptime=0):
+        self.target = target
+        self.num_workers = max(int(num_workers), 1)
+        self.registry = registry
+        self.min_uptime = min_uptime
+        self._conns = {}        # index -> sending end of the control pipe
+        self._owner = {}        # key -> index
+        self._sent = {}         # index -> keys last sent to the worker
+
+    def reset_in_child(self):
+        '''
+        To be called in a forked child: close the sending ends of the
+        control pipes inherited from the supervisor
+        '''
+        for conn in self._conns.values():
+            conn.close()
+        self._conns.clear()
+        self._owner.clear()
+        self._sent.clear()
+
+    def _child_main(self, index, parent_pid, conn, writer):
+        # the sending ends inherited from the parent, our own included,
+        # would keep us from seeing EOF once the parent lets go of us
+        writer.close()
+        self.reset_in_child()
+        self.target(index, parent_pid, conn)
+
+    def _start_worker(self, index):
+        reader, writer = multiprocessing.Pipe(duplex=False)
+        phandle = multiprocessing.Process(target=self._child_main, \
+                                          args=(index, os.getpid(), reader, \
+                                                writer))
+        phandle.start()
+        reader.close()
+        old = self._conns.pop(index, None)
+        if old:
+            old.close()
+        self._conns[index] = writer
+        self._sent[index] = None
+        self.registry.add(('worker', index), phandle)
+        _logger.info("Parent: Started monitor worker %d, pid %d" \
+                     % (index, phandle.pid))
+
+    def _send(self, index, keys):
+        conn = self._conns.get(index)
+        if conn is None:
+            return
+        try:
+            conn.send(('assign', keys))
+            self._sent[index] = keys
+        except (IOError, OSError), ex:
+            # the worker died, it gets its assignment again once respawned
+            _logger.warn("Parent: Failed to send assignment to worker %d: " \
+                         "%s" % (index, ex))
+
+    def send_all(self, message):
+        '''
+        Send message to every worker. Returns the number of workers it was
+        sent to.
+        '''
+        sent = 0
+        for index, conn in self._conns.items():
+            try:
+                conn.send(message)
+                sent += 1
+            except (IOError, OSError), ex:
+                _logger.warn("Parent: Failed to send %s to worker %d: %s" \
+                             % (message[0], index, ex))
+        return sent
+
+    def owns(self, key):
+        return isinstance(key, tuple) and key[0] == 'worker'
+
+    def loads(self):
+        loads = [0] * self.num_workers
+        for index in self._owner.values():
+            loads[index] += 1
+        return loads
+
+    def assign(self, keys):
+        '''
+        Make the workers monitor exactly the given keys. Keys keep their
+        worker while they exist, new keys go to the least loaded worker and
+        keys are moved off the most loaded workers until no worker has more
+        than one key above any other. Only the workers whose set changed
+        hear about it.
+        '''
+        for index in range(self.num_workers):
+            if ('worker', index) not in self.registry:
+                self._start_worker(index)
+
+        keys = set(keys)
+        for key in self._owner.keys():
+            if key not in keys:
+                del self._owner[key]
+        loads = self.loads()
+        for key in sorted(keys - set(self._owner)):
+            index = loads.index(min(loads))
+            self._owner[key] = index
+            loads[index] += 1
+        while max(loads) - min(loads) > 1:
+            src = loads.index(max(loads))
+            dst = loads.index(min(loads))
+            key = max(k for k, i in self._owner.items() if i == src)
+            self._owner[key] = dst
+            loads[src] -= 1
+            loads[dst] += 1
+
+        shards = dict((index, []) for index in range(self.num_workers))
+        for key, index in self._owner.items():
+            shards[index].append(key)
+        for index, shard_keys in shards.items():
+            shard_keys.sort()
+            if self._sent.get(index) != shard_keys:
+                self._send(index, shard_keys)
+
+    def handle_exit(self, key, phandle, uptime):
+        '''
+        Called for a worker process which exited. It is respawned and gets
+        its clusters back, unless it died too young, in which case the next
+        assign() brings it back.
+        '''
+        index = key[1]
+        _logger.warn("Parent: Monitor worker %d, pid %d exited with code " \
+                     "%s after %.1f seconds" \
+                     % (index, phandle.pid, phandle.exitcode, uptime))
+        conn = self._conns.pop(index, None)
+        if conn:
+            conn.close()
+        self._sent[index] = None
+        if uptime >= self.min_uptime:
+            self._start_worker(index)
+            self._send(index, sorted(k for k, i in self._owner.items() \
+                                     if i == index))
+
+
+class ShardWorker(object):
+    """Worker side: runs one monitor thread per assigned key.
+
+    monitor_factory(key) returns an object whose run(stop_event) method
+    monitors key until stop_event is set. Messages from the supervisor other
+    than 'assign' are passed to control_handler.
+    """
+    def __init__(self, index, conn, monitor_factory, parent_death_fd=-1, \
+                 control_handler=None):
+        self.index = index
+        self._conn = conn
+        self._factory = monitor_factory
+        self._parent_death_fd = parent_death_fd
+        self._control_handler = control_handler
+        # key -> [thread, stop event, failures, restart at]
+        self._monitors = {}
+
+    def _run_monitor(self, key, stop_event):
+        try:
+            self._factory(key).run(stop_event)
+        except Exception, ex:
+            _logger.exception("Worker(%d): Monitor for %s failed: %s", \
+                              self.index, key, ex)
+
+    def _start_monitor(self, key):
+        entry = self._monitors.get(key)
+        if entry is None:
+            entry = [None, None, 0, 0]
+            self._monitors[key] = entry
+        stop_event = threading.Event()
+        thread = threading.Thread(target=self._run_monitor, \
+                                  args=(key, stop_event), \
+                                  name="monitor-%s" % (key,))
+        thread.daemon = True
+        thread.start()
+        entry[0] = thread
+        entry[1] = stop_event
+
+    def _stop_monitors(self, keys):
+        entries = [self._monitors.pop(key) for key in keys]
+        for entry in entries:
+            if entry[1]:
+                entry[1].set()
+        deadline = time.time() + THREAD_STOP_TIMEOUT
+        for entry in entries:
+            if entry[0]:
+                entry[0].join(max(deadline - time.time(), 0))
+
+    def assign(self, keys):
+        keys = set(keys)
+        current = set(self._monitors)
+        self._stop_monitors(current - keys)
+        for key in sorted(keys - current):
+            self._start_monitor(key)
+        _logger.info("Worker(%d): Monitoring %d clusters" \
+                     % (self.index, len(self._monitors)))
+
+    def _check_monitors(self):
+        '''
+        Restart the monitors whose thread ended while it was not asked to
+        '''
+        now = time.time()
+        for key, entry in self._monitors.items():
+            thread, stop_event, failures, restart_at = entry
+            if thread is None:
+                if now >= restart_at:
+                    self._start_monitor(key)
+            elif not thread.is_alive() and not stop_event.is_set():
+                delay = min(MIN_RESTART_DELAY * 2 ** failures, \
+                            MAX_RESTART_DELAY)
+                _logger.warn("Worker(%d): Monitor for %s stopped, " \
+                             "restarting it in %.1f seconds" \
+                             % (self.index, key, delay))
+                entry[0] = None
+                entry[2] = failures + 1
+                entry[3] = now + delay
+
+    def handle(self, message):
+        '''
+        Process one message from the supervisor
+        '''
+        command = message[0]
+        if command == 'assign':
+            self.assign(message[1])
+        elif self._control_handler:
+            self._control_handler(message)
+        else:
+            _logger.warn("Worker(%d): Unknown command %r" \
+                         % (self.index, command))
+
+    def run(self, should_quit):
+        '''
+        Serve the supervisor until should_quit() returns True, the control
+        pipe is closed or the parent death pipe reads EOF.
+        '''
+        fds = [self._conn.fileno()]
+        if self._parent_death_fd >= 0:
+            fds.append(self._parent_death_fd)
+        try:
+            while not should_quit():
+                try:
+                    readable = select.select(fds, [], [], WORKER_TICK)[0]
+                except select.error, ex:
+                    if ex.args[0] != errno.EINTR:
+                        raise
+                    continue
+                if self._parent_death_fd in readable:
+                    _logger.info("Worker(%d): Parent is gone away.. " \
+                                 "Exiting now" % self.index)
+                    break
+                if self._conn.fileno() in readable:
+                    try:
+                        message = self._conn.recv()
+                    except EOFError:
+                        break
+                    self.handle(message)
+                self._check_monitors()
+        finally:
+            self._stop_monitors(self._monitors.keys())
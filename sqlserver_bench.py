@@ -0,0 +1,323 @@
+#!/usr/bin/python
+#Load generator and latency benchmark for sqlserver_connect.
+#N worker threads fire the same query for a number of iterations or
+#seconds, after a warm-up which is not measured, and the latency of the
+#connect, execute and fetch phases is reported separately with the QPS.
+#
+#The driver is pluggable: 'pyodbc' talks to a real SQL Server, 'pool' does
+#the same through sqlserver_connect.ConnectionPool and 'fake' is an
+#in-process stand-in with configurable latencies, to try the benchmark on
+#a machine without SQL Server. Any object with a
+#connect(server_ip, port, username, password) method returning a DB API
+#connection can be passed to run_benchmark().
+import sys
+import os
+import time
+import getopt
+import threading
+
+import sqlserver_connect
+
+PHASES = ('connect', 'execute', 'fetch')
+
+#a DB API connection whose queries only take time
+class FakeCursor(object):
+    def __init__(self, conn):
+        self._conn = conn
+        self.arraysize = 1
+
+    def execute(self, query):
+        time.sleep(self._conn.execute_latency)
+
+    def fetchall(self):
+        time.sleep(self._conn.fetch_latency)
+        return [(i,) for i in range(self._conn.rows)]
+
+    def close(self):
+        pass
+
+class FakeConnection(object):
+    def __init__(self, execute_latency, fetch_latency, rows):
+        self.execute_latency = execute_latency
+        self.fetch_latency = fetch_latency
+        self.rows = rows
+
+    def cursor(self):
+        return FakeCursor(self)
+
+    def rollback(self):
+        pass
+
+    def close(self):
+        pass
+
+#latencies are in seconds
+class FakeDriver(object):
+    def __init__(self, connect_latency=0.005, execute_latency=0.001, \
+                 fetch_latency=0.0005, rows=1):
+        self.connect_latency = connect_latency
+        self.execute_latency = execute_latency
+        self.fetch_latency = fetch_latency
+        self.rows = rows
+
+    def connect(self, server_ip, port, username, password):
+        time.sleep(self.connect_latency)
+        return FakeConnection(self.execute_latency, self.fetch_latency, \
+                              self.rows)
+
+#a fresh connection every time, without the preflight of get_connection
+#so that connect measures the TCP and TDS login only
+class PyodbcDriver(object):
+    def connect(self, server_ip, port, username, password):
+        if sqlserver_connect.pyodbc is None:
+            raise ImportError("pyodbc is required for the pyodbc driver")
+        conn_str = sqlserver_connect.get_connection_string(server_ip, port, \
+                                                           username, password)
+        return sqlserver_connect.pyodbc.connect(conn_str, timeout=5)
+
+#connections from a ConnectionPool, close() hands them back
+class PoolDriver(object):
+    def __init__(self, pool=None):
+        self.pool = pool or sqlserver_connect.ConnectionPool()
+
+    def connect(self, server_ip, port, username, password):
+        conn = self.pool.get_connection(server_ip, port, username, password)
+        if conn is None:
+            raise Exception("Failed to connect to %s:%s" % (server_ip, port))
+        return conn
+
+DRIVERS = {
+    'fake': FakeDriver,
+    'pyodbc': PyodbcDriver,
+    'pool': PoolDriver,
+}
+
+def percentile(values, pct):
+    values = sorted(values)
+    return values[min(int(len(values) * pct / 100.0), len(values) - 1)]
+
+#what one worker measured
+class _WorkerStats(object):
+    def __init__(self):
+        self.latencies = dict((phase, []) for phase in PHASES)
+        self.errors = dict((phase, 0) for phase in PHASES)
+        self.queries = 0
+        self.measure_start = None
+        self.end = None
+
+#the duration, if any, starts once the warm-up is over. Without reconnect
+#the connects happen during the warm-up, usually only the first one, and
+#are measured all the same, so that connect has its latency too.
+def _worker(driver, target, query, iterations, duration, warmup, reconnect, \
+            stats):
+    conn = None
+    done = 0
+    deadline = None
+    measuring = warmup <= 0
+    if measuring:
+        stats.measure_start = time.time()
+        if duration is not None:
+            deadline = stats.measure_start + duration
+    try:
+        while True:
+            if measuring:
+                if iterations is not None and done >= iterations:
+                    break
+                if deadline is not None and time.time() >= deadline:
+                    break
+            phase = 'connect'
+            ok = False
+            try:
+                if conn is None:
+                    start = time.time()
+                    conn = driver.connect(*target)
+                    if measuring or not reconnect:
+                        stats.latencies['connect'].append(time.time() - start)
+                phase = 'execute'
+                cursor = conn.cursor()
+                start = time.time()
+                cursor.execute(query)
+                if measuring:
+                    stats.latencies['execute'].append(time.time() - start)
+                phase = 'fetch'
+                start = time.time()
+                cursor.fetchall()
+                if measuring:
+                    stats.latencies['fetch'].append(time.time() - start)
+                cursor.close()
+                ok = True
+            except Exception, ex:
+                if measuring:
+                    stats.errors[phase] += 1
+                    if stats.errors[phase] == 1:
+                        print "ERROR: %s failed: %s" % (phase, ex)
+            if conn is not None and (reconnect or not ok):
+                try:
+                    conn.close()
+                except Exception:
+                    pass
+                conn = None
+            #failed queries count as iterations too
+            if measuring:
+                done += 1
+                if ok:
+                    stats.queries += 1
+            else:
+                warmup -= 1
+                if warmup <= 0:
+                    measuring = True
+                    stats.measure_start = time.time()
+                    if duration is not None:
+                        deadline = stats.measure_start + duration
+    finally:
+        stats.end = time.time()
+        if conn is not None:
+            conn.close()
+
+#run the benchmark and return a dict with 'qps', 'elapsed', 'queries' and,
+#per phase, a dict with count, errors, p50, p95, p99 and max in seconds.
+#iterations is per worker, duration is in seconds; give one of them.
+#warmup iterations per worker are run first and not measured, but for
+#the connects when not reconnecting for every query.
+def run_benchmark(driver, target, query, workers=1, iterations=None, \
+                  duration=None, warmup=0, reconnect=False):
+    if iterations is None and duration is None:
+        raise ValueError("either iterations or duration is needed")
+    all_stats = [_WorkerStats() for i in range(workers)]
+    threads = [threading.Thread(target=_worker, \
+                                args=(driver, target, query, iterations, \
+                                      duration, warmup, reconnect, stats)) \
+               for stats in all_stats]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    starts = [stats.measure_start for stats in all_stats \
+              if stats.measure_start is not None]
+    elapsed = 0
+    if starts:
+        elapsed = max(stats.end for stats in all_stats) - min(starts)
+    queries = sum(stats.queries for stats in all_stats)
+    report = {
+        'elapsed': elapsed,
+        'queries': queries,
+        'qps': queries / elapsed if elapsed > 0 else 0,
+    }
+    for phase in PHASES:
+        values = []
+        for stats in all_stats:
+            values.extend(stats.latencies[phase])
+        summary = {
+            'count': len(values),
+            'errors': sum(stats.errors[phase] for stats in all_stats),
+        }
+        if values:
+            summary['p50'] = percentile(values, 50)
+            summary['p95'] = percentile(values, 95)
+            summary['p99'] = percentile(values, 99)
+            summary['max'] = max(values)
+        report[phase] = summary
+    return report
+
+def print_report(report):
+    print "Queries: %d in %.3f seconds, %.1f QPS" \
+          % (report['queries'], report['elapsed'], report['qps'])
+    print "%-8s %8s %7s %10s %10s %10s %10s" \
+          % ("phase", "count", "errors", "p50 ms", "p95 ms", "p99 ms", \
+             "max ms")
+    for phase in PHASES:
+        summary = report[phase]
+        if summary['count']:
+            print "%-8s %8d %7d %10.3f %10.3f %10.3f %10.3f" \
+                  % (phase, summary['count'], summary['errors'], \
+                     summary['p50'] * 1000, summary['p95'] * 1000, \
+                     summary['p99'] * 1000, summary['max'] * 1000)
+        else:
+            print "%-8s %8d %7d" % (phase, 0, summary['errors'])
+
+def usage():
+    print "Usage: python %s [options] DB_IP DB_PORT Username \
+'Password' \"QUERY\"" % os.path.basename(sys.argv[0])
+    print """
+Options:
+    -w, --workers N       : Concurrent workers (default 1)
+    -n, --iterations N    : Queries per worker (default 100)
+    -d, --duration SECS   : Run for this long instead of -n
+    --warmup N            : Unmeasured queries per worker first (default 10)
+    -r, --reconnect       : Connect for every query instead of once per
+                            worker
+    --driver NAME         : pyodbc, pool or fake (default pyodbc)
+    --fake-latency C,E,F  : Connect, execute and fetch latency of the fake
+                            driver in ms (default 5,1,0.5)
+    --fake-rows N         : Rows the fake driver returns (default 1)
+    -h, --help            : Display help"""
+
+def main():
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], 'hw:n:d:r', \
+                                   ["help", "workers=", "iterations=", \
+                                    "duration=", "warmup=", "reconnect", \
+                                    "driver=", "fake-latency=", \
+                                    "fake-rows="])
+    except getopt.GetoptError, ex:
+        print "Error: %s" % ex
+        usage()
+        return
+    workers = 1
+    iterations = 100
+    duration = None
+    warmup = 10
+    reconnect = False
+    driver_name = 'pyodbc'
+    fake_latency = (5, 1, 0.5)
+    fake_rows = 1
+    for opt, value in opts:
+        if opt in ('-h', '--help'):
+            usage()
+            return
+        elif opt in ('-w', '--workers'):
+            workers = int(value)
+        elif opt in ('-n', '--iterations'):
+            iterations = int(value)
+        elif opt in ('-d', '--duration'):
+            duration = float(value)
+            iterations = None
+        elif opt == '--warmup':
+            warmup = int(value)
+        elif opt in ('-r', '--reconnect'):
+            reconnect = True
+        elif opt == '--driver':
+            driver_name = value
+        elif opt == '--fake-latency':
+            fake_latency = [float(v) for v in value.split(',')]
+        elif opt == '--fake-rows':
+            fake_rows = int(value)
+    if driver_name not in DRIVERS:
+        print "Error: Unknown driver %s, use one of %s" \
+              % (driver_name, ", ".join(sorted(DRIVERS)))
+        return
+    if len(args) <> 5:
+        print "Error(%d): Please use the script as follows" % len(args)
+        usage()
+        return
+    target = (args[0], int(args[1]), args[2], args[3])
+    query = args[4]
+
+    if driver_name == 'fake':
+        connect_ms, execute_ms, fetch_ms = fake_latency
+        driver = FakeDriver(connect_ms / 1000.0, execute_ms / 1000.0, \
+                            fetch_ms / 1000.0, fake_rows)
+    else:
+        driver = DRIVERS[driver_name]()
+    print "INFO: %d workers, %s, warm-up %d, driver %s%s" \
+          % (workers, "%s seconds" % duration if duration is not None \
+             else "%d iterations each" % iterations, warmup, driver_name, \
+             ", reconnecting for every query" if reconnect else "")
+    report = run_benchmark(driver, target, query, workers, iterations, \
+                           duration, warmup, reconnect)
+    print_report(report)
+
+if __name__ == '__main__':
+    main()
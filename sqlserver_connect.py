@@ -2,10 +2,77 @@
 #Author: Tapas Sharma
 #Simple script to test connection to a SQL Server
 #TODO: Add the field to take dbname as a parameter
-import pyodbc
 import socket
 import sys
+import time
+import getopt
+import select
+import errno
+import glob
+import sqlite3
+import re
+import os
+import array
+import mmap
+import struct
+import decimal
+import tempfile
+import threading
+import csv
+import json
+import random
+import ctypes
+import ctypes.util
+from itertools import izip, islice, count
+from collections import deque, OrderedDict
 from datetime import datetime
+try:
+    import pyodbc
+except ImportError:
+    # only needed once we actually connect
+    pyodbc = None
+try:
+    import numpy
+except ImportError:
+    # columnar results fall back to array.array
+    numpy = None
+
+#defaults of the connection pool, times are in seconds
+POOL_MIN_SIZE = 0
+POOL_MAX_SIZE = 10
+POOL_IDLE_TIMEOUT = 300
+POOL_MAX_LIFETIME = 3600
+POOL_CHECKOUT_TIMEOUT = 30
+#a connection returned to the pool less than this long ago is not validated
+POOL_VALIDATION_INTERVAL = 1
+VALIDATION_QUERY = "SELECT 1"
+#how often returning a connection also looks for idle ones to close
+POOL_EVICTION_INTERVAL = 1
+
+#rows fetched per round trip when streaming results
+DEFAULT_BATCH_SIZE = 1000
+
+#rows sent per executemany() and committed at once by bulk_insert
+INSERT_BATCH_SIZE = 1000
+INSERT_COMMIT_EVERY = 10000
+
+#defaults of the query result cache
+CACHE_MAX_ENTRIES = 1024
+CACHE_TTL = 10
+
+#retries of get_connection wait base * 2^n seconds, up to the max, minus
+#a random part of up to jitter of that so that callers do not retry in step
+RETRY_BASE_DELAY = 0.5
+RETRY_MAX_DELAY = 10
+RETRY_JITTER = 0.5
+#an endpoint which failed this many get_connection calls in a row is not
+#tried again before the reset timeout, then by a single caller only
+BREAKER_FAILURE_THRESHOLD = 3
+BREAKER_RESET_TIMEOUT = 30
+
+#defaults of the reachability probe
+PROBE_TIMEOUT = 1
+PROBE_CONCURRENCY = 256
 
 #creates a connection string that we can use to connect to the db server
 #using FreeTDS and UnixODBC is supposed to installed
@@ -14,75 +81,1626 @@ def get_connection_string(server_ip, server_port, username, password):
     return "DRIVER={FreeTDS};SERVER=%s;PORT=%s;UID=%s;PWD=%s;TDS_VERSION=7.2;" \
                % (server_ip, str(server_port), username, password)
 
-#returns a connection object to use to fire queries
-def get_connection(server_ip, port, username, password, max_retry=3):
+#see <linux/time.h>
+CLOCK_MONOTONIC = 1
+
+class _timespec(ctypes.Structure):
+    _fields_ = [('tv_sec', ctypes.c_long), ('tv_nsec', ctypes.c_long)]
+
+#returns a function giving seconds since an arbitrary point which, unlike
+#time.time(), does not jump with the wall clock. Falls back to time.time
+#where clock_gettime is not available
+def _monotonic_clock():
+    for name in ('rt', 'c'):
+        lib_name = ctypes.util.find_library(name)
+        if not lib_name:
+            continue
+        try:
+            clock_gettime = ctypes.CDLL(lib_name).clock_gettime
+        except (OSError, AttributeError):
+            continue
+        clock_gettime.argtypes = [ctypes.c_int, ctypes.POINTER(_timespec)]
+        def monotonic():
+            ts = _timespec()
+            if clock_gettime(CLOCK_MONOTONIC, ctypes.byref(ts)) != 0:
+                return time.time()
+            return ts.tv_sec + ts.tv_nsec * 1e-9
+        return monotonic
+    return time.time
+
+monotonic = _monotonic_clock()
+
+#one phase of a traced call, e.g. the TCP preflight of the second attempt
+#of a get_connection. Exceptions raised in its body are recorded, not caught
+class _TraceSpan(object):
+    def __init__(self, call, phase, attempt):
+        self._call = call
+        self._phase = phase
+        self._attempt = attempt
+
+    def __enter__(self):
+        self._start = monotonic()
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        error = None
+        if exc_type is not None:
+            error = "%s: %s" % (exc_type.__name__, exc_value)
+        self._call.record(self._phase, self._start, monotonic(), \
+                          self._attempt, error)
+        return False
+
+#the records of one get_connection or execute_query call share its id
+class _TraceCall(object):
+    def __init__(self, tracer, operation, fields):
+        self._tracer = tracer
+        self.operation = operation
+        self.id = tracer.next_id()
+        self.fields = fields
+        self.start = monotonic()
+
+    def phase(self, phase, attempt=None):
+        return _TraceSpan(self, phase, attempt)
+
+    def record(self, phase, start, end, attempt=None, error=None):
+        record = {
+            'call': self.id,
+            'op': self.operation,
+            'phase': phase,
+            'start': start,
+            'end': end,
+            'duration': end - start,
+        }
+        if attempt is not None:
+            record['attempt'] = attempt
+        if error is not None:
+            record['error'] = error
+        record.update(self.fields)
+        self._tracer.emit(record)
+
+    #the closing 'total' record, from the creation of the call until now
+    def finish(self, error=None):
+        self.record('total', self.start, monotonic(), None, error)
+
+class _NullSpan(object):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        return False
+
+#stands in for _TraceCall when there is no tracer, so that untraced calls
+#only pay for a method call per phase
+class _NullCall(object):
+    _span = _NullSpan()
+
+    def phase(self, phase, attempt=None):
+        return self._span
+
+    def record(self, phase, start, end, attempt=None, error=None):
+        pass
+
+    def finish(self, error=None):
+        pass
+
+_NULL_CALL = _NullCall()
+
+#records the phases of get_connection (dns, tcp, login, backoff and breaker)
+#and of execute_query (execute and fetch, or cache) as dicts with the
+#monotonic start and end, the duration in seconds, the attempt number of
+#retried phases and the error if the phase failed. Every record is passed
+#to each of the sinks, callables such as JsonLinesSink or TraceSummary.
+class Tracer(object):
+    def __init__(self, *sinks):
+        self.sinks = list(sinks)
+        self._ids = count(1)
+
+    def next_id(self):
+        return next(self._ids)
+
+    def call(self, operation, **fields):
+        return _TraceCall(self, operation, fields)
+
+    def emit(self, record):
+        for sink in self.sinks:
+            sink(record)
+
+def _trace_call(tracer, operation, **fields):
+    if tracer is None:
+        return _NULL_CALL
+    return tracer.call(operation, **fields)
+
+#writes trace records to out, one JSON object per line
+class JsonLinesSink(object):
+    def __init__(self, out):
+        self.out = out
+        self._lock = threading.Lock()
+
+    def __call__(self, record):
+        line = json.dumps(record, sort_keys=True) + "\n"
+        with self._lock:
+            self.out.write(line)
+
+#aggregates the durations of trace records per operation and phase
+class TraceSummary(object):
+    def __init__(self):
+        self.durations = {}
+        self.errors = {}
+        self._lock = threading.Lock()
+
+    def __call__(self, record):
+        key = (record['op'], record['phase'])
+        with self._lock:
+            self.durations.setdefault(key, []).append(record['duration'])
+            if 'error' in record:
+                self.errors[key] = self.errors.get(key, 0) + 1
+
+    #rows of (op, phase, count, errors, p50, p95, p99, max), in seconds
+    def rows(self):
+        rows = []
+        with self._lock:
+            for key in sorted(self.durations):
+                values = sorted(self.durations[key])
+                pick = lambda pct: \
+                    values[min(int(len(values) * pct / 100.0), len(values) - 1)]
+                rows.append(key + (len(values), self.errors.get(key, 0), \
+                                   pick(50), pick(95), pick(99), values[-1]))
+        return rows
+
+def print_trace_summary(summary, out=sys.stdout):
+    out.write("%-14s %-8s %7s %7s %10s %10s %10s %10s\n" \
+              % ("call", "phase", "count", "errors", "p50 ms", "p95 ms", \
+                 "p99 ms", "max ms"))
+    for row in summary.rows():
+        out.write("%-14s %-8s %7d %7d %10.3f %10.3f %10.3f %10.3f\n" \
+                  % (row[:4] + tuple(value * 1000 for value in row[4:])))
+
+#how long to wait before the retries of a connection attempt
+class RetryPolicy(object):
+    def __init__(self, max_retry=3, base_delay=RETRY_BASE_DELAY, \
+                 max_delay=RETRY_MAX_DELAY, jitter=RETRY_JITTER):
+        self.max_retry = max_retry
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.jitter = jitter
+
+    #seconds to wait before retry number retry, counting from 1
+    def delay(self, retry):
+        delay = min(self.base_delay * 2 ** (retry - 1), self.max_delay)
+        return delay * (1 - self.jitter * random.random())
+
+#the state of one endpoint as seen by all the callers of a process.
+#closed: connect as usual. open: the endpoint failed threshold times in a
+#row, fail without connecting until reset_timeout has passed. half-open:
+#after that, one caller gets to try again while the others keep failing
+#fast; its success closes the breaker and its failure opens it again. A
+#trial which never reports back is replaced after another reset_timeout.
+class CircuitBreaker(object):
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half-open'
+
+    def __init__(self, threshold=BREAKER_FAILURE_THRESHOLD, \
+                 reset_timeout=BREAKER_RESET_TIMEOUT):
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = 0
+        self._lock = threading.Lock()
+
+    #True if the caller may connect. In half-open it is True once, for the
+    #caller doing the trial
+    def allow(self):
+        with self._lock:
+            if self.state == self.CLOSED:
+                return True
+            now = time.time()
+            if now - self.opened_at >= self.reset_timeout:
+                self.state = self.HALF_OPEN
+                self.opened_at = now
+                return True
+            return False
+
+    def is_trial(self):
+        return self.state == self.HALF_OPEN
+
+    def record_success(self):
+        with self._lock:
+            self.state = self.CLOSED
+            self.failures = 0
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.state == self.HALF_OPEN or \
+               self.failures >= self.threshold:
+                self.state = self.OPEN
+                self.opened_at = time.time()
+
+_breakers = {}
+_breakers_lock = threading.Lock()
+
+#the circuit breaker of an endpoint, shared by the whole process
+def get_breaker(server_ip, port):
+    key = (server_ip, int(port))
+    with _breakers_lock:
+        breaker = _breakers.get(key)
+        if breaker is None:
+            breaker = CircuitBreaker()
+            _breakers[key] = breaker
+        return breaker
+
+#returns a connection object to use to fire queries, None if the server is
+#not reachable. Attempts are spaced out by retry_policy and the endpoint's
+#circuit breaker keeps a server that is down from being tried by everyone;
+#pass breaker=None to always try. The phases are recorded on tracer if any.
+def get_connection(server_ip, port, username, password, max_retry=3, \
+                   retry_policy=None, breaker=True, tracer=None):
+    if pyodbc is None:
+        raise ImportError("pyodbc is required to connect to SQL Server")
+    trace = _trace_call(tracer, 'get_connection', \
+                        server="%s:%s" % (server_ip, port))
+    if retry_policy is None:
+        retry_policy = RetryPolicy(max_retry)
+    if breaker is True:
+        breaker = get_breaker(server_ip, port)
+    attempts = retry_policy.max_retry
+    if breaker is not None:
+        with trace.phase('breaker'):
+            allowed = breaker.allow()
+        if not allowed:
+            print "ERROR: %s:%s failed %d times, not trying again for now" \
+                  % (server_ip, port, breaker.failures)
+            trace.finish("circuit open")
+            return None
+        if breaker.is_trial():
+            #a single cheap check while the server is believed to be down
+            attempts = 1
     conn_str = get_connection_string(server_ip, port, username, password)
     retry = 0
     conn = None
-    while retry < max_retry:
+    while retry < attempts:
+        if retry:
+            delay = retry_policy.delay(retry)
+            print "LOG: Retrying in %.2f seconds" % delay
+            with trace.phase('backoff', retry):
+                time.sleep(delay)
+        retry = retry + 1
+        test_socket = None
         try:
             print "LOG: Checking with socket call to see if the socket is \
             open and reachable"
             #done to not stick in the tcp timeout of 15 mins
             #which is a limitation in pyodbc
             #check with socket to connect with mssql server
+            with trace.phase('dns', retry):
+                address = socket.getaddrinfo(server_ip, port, socket.AF_INET, \
+                                             socket.SOCK_STREAM)[0][4]
             test_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
             test_socket.settimeout(1)
-            test_socket.connect((server_ip, port))
+            with trace.phase('tcp', retry):
+                test_socket.connect(address)
             print "INFO: Socket connection sucessful..."
-        except socket.error:
-            # get the error number and error string from sys.exc_info()
-            errno, errstr = sys.exc_info()[:2]
-            if errno == socket.timeout:
-                print "ERROR: Timeout has occured...", errstr
-            return conn
+        except socket.timeout, ex:
+            print "ERROR: Timeout has occured...", ex
+            continue
+        except socket.error, ex:
+            print "ERROR: Socket connection failed", ex
+            continue
         except Exception, ex:
             print ex
-            return conn
+            if breaker is not None:
+                #or a failed trial would leave the breaker half open
+                breaker.record_failure()
+            trace.finish(str(ex))
+            return None
         finally:
             if test_socket:
                 test_socket.close()
         print "LOG: Checking with pyodbc"
         try:
-            conn = pyodbc.connect(conn_str, timeout=5)
+            with trace.phase('login', retry):
+                conn = pyodbc.connect(conn_str, timeout=5)
             break
         except Exception, ex:
-            retry = retry + 1
             print "ERROR: Was Not Able To Connect  ", ex
+    if conn is None:
+        if breaker is not None:
+            breaker.record_failure()
+        trace.finish("not connected after %d attempts" % retry)
+        return None
+    if breaker is not None:
+        breaker.record_success()
+    trace.finish()
     print "INFO: Connected to Server", server_ip, "Successfully"
     #Set the default query timeout on the connection
-    if conn:
-        conn.timeout = 5
+    conn.timeout = 5
     return conn
 
-#open a cursor and then execute the supplied query
-def execute_query(conn, query):
+class PoolTimeout(Exception):
+    pass
+
+#a connection of the pool: the pyodbc connection and its bookkeeping
+class _PoolEntry(object):
+    def __init__(self, conn):
+        self.conn = conn
+        self.created = time.time()
+        self.last_used = self.created
+
+#the connections of one (server, port, user)
+class _Endpoint(object):
+    def __init__(self):
+        self.idle = deque()     #most recently returned on the right
+        self.size = 0           #idle and checked out connections
+        self.password = None
+
+#what a caller gets from the pool, behaves like the pyodbc connection
+#but close() hands it back to the pool instead of closing it
+class PooledConnection(object):
+    def __init__(self, pool, key, entry):
+        self._pool = pool
+        self._key = key
+        self._entry = entry
+
+    def __getattr__(self, name):
+        if self._entry is None:
+            raise AttributeError("connection was returned to the pool")
+        return getattr(self._entry.conn, name)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.close()
+        return False
+
+    #return the connection to the pool
+    def close(self):
+        if self._entry is not None:
+            entry, self._entry = self._entry, None
+            self._pool._release(self._key, entry)
+
+    #close the connection for good, e.g. after a network error
+    def discard(self):
+        if self._entry is not None:
+            entry, self._entry = self._entry, None
+            self._pool._release(self._key, entry, broken=True)
+
+#A thread safe pool of connections keyed by (server, port, user).
+#A checkout reuses an idle connection after a cheap validation query and
+#only opens a new one, preflight included, when none is idle and the
+#endpoint has less than max_size connections. Idle connections are closed
+#after idle_timeout seconds, down to min_size, and every connection is
+#recycled after max_lifetime seconds.
+class ConnectionPool(object):
+    def __init__(self, min_size=POOL_MIN_SIZE, max_size=POOL_MAX_SIZE, \
+                 idle_timeout=POOL_IDLE_TIMEOUT, \
+                 max_lifetime=POOL_MAX_LIFETIME, \
+                 checkout_timeout=POOL_CHECKOUT_TIMEOUT, \
+                 validation_query=VALIDATION_QUERY, \
+                 validation_interval=POOL_VALIDATION_INTERVAL, \
+                 connect=None):
+        self.min_size = min_size
+        self.max_size = max(max_size, 1)
+        self.idle_timeout = idle_timeout
+        self.max_lifetime = max_lifetime
+        self.checkout_timeout = checkout_timeout
+        self.validation_query = validation_query
+        self.validation_interval = validation_interval
+        #how new connections are opened, get_connection unless told otherwise
+        self._connect = connect or get_connection
+        self._cond = threading.Condition()
+        self._endpoints = {}
+        self._closed = False
+        self._next_eviction = 0
+
+    def _close_conn(self, entry):
+        try:
+            entry.conn.close()
+        except Exception, ex:
+            print "LOG: Failed to close pooled connection: ", ex
+
+    def _expired(self, entry, now):
+        return now - entry.created >= self.max_lifetime
+
+    def _is_valid(self, entry, now):
+        if now - entry.last_used < self.validation_interval:
+            return True
+        cursor = None
+        try:
+            cursor = entry.conn.cursor()
+            cursor.execute(self.validation_query)
+            cursor.fetchall()
+            return True
+        except Exception, ex:
+            print "LOG: Pooled connection failed validation: ", ex
+            return False
+        finally:
+            if cursor:
+                try:
+                    cursor.close()
+                except Exception:
+                    pass
+
+    #returns a PooledConnection to server_ip:port, or None if no
+    #connection could be opened, like get_connection
+    def get_connection(self, server_ip, port, username, password, \
+                       max_retry=3):
+        key = (server_ip, int(port), username)
+        deadline = time.time() + self.checkout_timeout
+        while True:
+            entry = None
+            with self._cond:
+                if self._closed:
+                    raise PoolTimeout("connection pool is closed")
+                endpoint = self._endpoints.get(key)
+                if endpoint is None:
+                    endpoint = self._endpoints[key] = _Endpoint()
+                endpoint.password = password
+                while True:
+                    if endpoint.idle:
+                        entry = endpoint.idle.pop()
+                        break
+                    if endpoint.size < self.max_size:
+                        #reserve the slot, the connect happens unlocked
+                        endpoint.size += 1
+                        break
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        raise PoolTimeout("no connection to %s:%s available " \
+                                          "within %s seconds" \
+                                          % (server_ip, port, \
+                                             self.checkout_timeout))
+                    self._cond.wait(remaining)
+
+            if entry is None:
+                return self._grow(key, server_ip, port, username, password, \
+                                  max_retry)
+            now = time.time()
+            if not self._expired(entry, now) and self._is_valid(entry, now):
+                return PooledConnection(self, key, entry)
+            self._drop(key, entry)
+
+    def _grow(self, key, server_ip, port, username, password, max_retry):
+        conn = None
+        try:
+            conn = self._connect(server_ip, port, username, password, \
+                                 max_retry)
+        finally:
+            if conn is None:
+                with self._cond:
+                    self._endpoints[key].size -= 1
+                    self._cond.notify()
+        if conn is None:
+            return None
+        return PooledConnection(self, key, _PoolEntry(conn))
+
+    #forget a connection which is not usable any more
+    def _drop(self, key, entry):
+        self._close_conn(entry)
+        with self._cond:
+            self._endpoints[key].size -= 1
+            self._cond.notify()
+
+    def _release(self, key, entry, broken=False):
+        now = time.time()
+        if not broken:
+            try:
+                #do not hand a half done transaction to the next caller
+                entry.conn.rollback()
+            except Exception, ex:
+                print "LOG: Dropping pooled connection: ", ex
+                broken = True
+        if broken or self._closed or self._expired(entry, now):
+            self._drop(key, entry)
+        else:
+            entry.last_used = now
+            with self._cond:
+                self._endpoints[key].idle.append(entry)
+                self._cond.notify()
+        if now >= self._next_eviction:
+            self.evict_idle()
+
+    #close the connections idle for longer than idle_timeout, keeping
+    #min_size per endpoint, and those older than max_lifetime.
+    #Returns the number of connections closed.
+    def evict_idle(self):
+        now = time.time()
+        self._next_eviction = now + POOL_EVICTION_INTERVAL
+        evicted = []
+        with self._cond:
+            for key, endpoint in self._endpoints.items():
+                keep = deque()
+                #the least recently used are on the left
+                while endpoint.idle:
+                    entry = endpoint.idle.popleft()
+                    if self._expired(entry, now) or \
+                       (now - entry.last_used >= self.idle_timeout and \
+                        endpoint.size > self.min_size):
+                        endpoint.size -= 1
+                        evicted.append(entry)
+                    else:
+                        keep.append(entry)
+                endpoint.idle = keep
+            if evicted:
+                self._cond.notify_all()
+        for entry in evicted:
+            self._close_conn(entry)
+        return len(evicted)
+
+    #open connections to server_ip:port until it has min_size of them
+    def fill(self, server_ip, port, username, password, max_retry=3):
+        conns = []
+        try:
+            while True:
+                with self._cond:
+                    endpoint = self._endpoints.get((server_ip, int(port), \
+                                                    username))
+                    if endpoint and endpoint.size >= \
+                       min(self.min_size, self.max_size):
+                        break
+                conn = self.get_connection(server_ip, port, username, \
+                                           password, max_retry)
+                if conn is None:
+                    break
+                conns.append(conn)
+        finally:
+            for conn in conns:
+                conn.close()
+
+    #returns {(server, port, user): (idle, total)}
+    def stats(self):
+        with self._cond:
+            return dict((key, (len(endpoint.idle), endpoint.size)) \
+                        for key, endpoint in self._endpoints.items())
+
+    #close every idle connection, checked out ones are closed when returned
+    def close_all(self):
+        with self._cond:
+            self._closed = True
+            entries = []
+            for endpoint in self._endpoints.values():
+                entries.extend(endpoint.idle)
+                endpoint.size -= len(endpoint.idle)
+                endpoint.idle.clear()
+            self._cond.notify_all()
+        for entry in entries:
+            self._close_conn(entry)
+
+#the pool used by get_pooled_connection
+_default_pool = None
+_default_pool_lock = threading.Lock()
+
+#like get_connection, but the connection comes from and goes back to a
+#process wide pool: call close() on it when done
+def get_pooled_connection(server_ip, port, username, password, max_retry=3):
+    global _default_pool
+    with _default_pool_lock:
+        if _default_pool is None:
+            _default_pool = ConnectionPool()
+    return _default_pool.get_connection(server_ip, port, username, password, \
+                                        max_retry)
+
+#string literals, which must be left alone when normalizing a query
+#what normalize_query leaves alone: string literals, quoted and bracketed
+#identifiers and comments, a -- comment with the line break ending it
+_SQL_PROTECTED = re.compile(r"('(?:[^']|'')*'|\"(?:[^\"]|\"\")*\"" \
+                            r"|\[(?:[^\]]|\]\])*\]|--[^\n]*(?:\n|$)" \
+                            r"|/\*.*?\*/)", re.S)
+
+#collapse the white space of query outside of literals, identifiers and
+#comments and drop a trailing semicolon, so that the same query written
+#differently is cached once
+def normalize_query(query):
+    parts = _SQL_PROTECTED.split(query)
+    for i in range(0, len(parts), 2):
+        parts[i] = re.sub(r"\s+", " ", parts[i])
+    return "".join(parts).strip().rstrip(';').strip()
+
+#a query being executed on behalf of all the callers asking for it
+class _Flight(object):
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+        self.stale = False
+
+#A bounded LRU cache of query results keyed by (server, normalized query,
+#parameters), each entry valid for ttl seconds. Concurrent misses for the
+#same key are coalesced: one caller runs the query, the others wait for
+#its result. Errors are handed to the waiters but never cached. Rows are
+#kept as tuples, so that no caller can change what the others get.
+class QueryCache(object):
+    def __init__(self, max_entries=CACHE_MAX_ENTRIES, ttl=CACHE_TTL):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()   #key -> (expires at, rows)
+        self._flights = {}              #key -> _Flight
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def make_key(self, server, query, params=None):
+        return (server, normalize_query(query), tuple(params or ()))
+
+    #returns the rows of query on server, from the cache if they are
+    #recent enough, otherwise from loader() which runs the query
+    def get(self, server, query, params, loader, ttl=None):
+        if server is None:
+            raise ValueError("the server is part of the cache key")
+        key = self.make_key(server, query, params)
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry and entry[0] > time.time():
+                self._entries[key] = entry
+                self.hits += 1
+                return list(entry[1])
+            flight = self._flights.get(key)
+            if flight:
+                self.coalesced += 1
+                owner = False
+            else:
+                self.misses += 1
+                flight = self._flights[key] = _Flight()
+                owner = True
+
+        if not owner:
+            flight.done.wait()
+            if flight.error:
+                raise flight.error
+            return list(flight.result)
+
+        try:
+            flight.result = [tuple(row) for row in loader()]
+        except Exception, ex:
+            flight.error = ex
+        with self._lock:
+            del self._flights[key]
+            if flight.error is None and not flight.stale:
+                if ttl is None:
+                    ttl = self.ttl
+                self._entries[key] = (time.time() + ttl, flight.result)
+                while len(self._entries) > self.max_entries:
+                    self._entries.popitem(last=False)
+        flight.done.set()
+        if flight.error:
+            raise flight.error
+        return list(flight.result)
+
+    #run query with params over conn unless its result for server is
+    #cached
+    def execute(self, conn, server, query, params=None, ttl=None):
+        def loader():
+            cursor = conn.cursor()
+            try:
+                if params:
+                    cursor.execute(query, params)
+                else:
+                    cursor.execute(query)
+                return cursor.fetchall()
+            finally:
+                cursor.close()
+        return self.get(server, query, params, loader, ttl)
+
+    #forget the cached result of one query, of every query of a server,
+    #or everything. Queries running right now are not cached either.
+    def invalidate(self, server=None, query=None, params=None):
+        with self._lock:
+            if query is not None:
+                key = self.make_key(server, query, params)
+                match = lambda k: k == key
+            elif server is not None:
+                match = lambda k: k[0] == server
+            else:
+                match = lambda k: True
+            for key in [k for k in self._entries if match(k)]:
+                del self._entries[key]
+            for key, flight in self._flights.items():
+                if match(key):
+                    flight.stale = True
+
+#open a cursor and then execute the supplied query. With a QueryCache the
+#result may come from the cache, server (e.g. "ip:port") is then required
+#as part of the key, and the rows are tuples. The execute and fetch phases
+#are recorded on tracer if any.
+def execute_query(conn, query, params=None, cache=None, server=None, \
+                  tracer=None):
+    if cache is not None and server is None:
+        raise ValueError("execute_query with a cache needs the server")
+    fields = {}
+    if server is not None:
+        fields['server'] = server
+    trace = _trace_call(tracer, 'execute_query', **fields)
     try:
+        if cache is not None:
+            with trace.phase('cache'):
+                results = cache.execute(conn, server, query, params)
+            trace.finish()
+            return results
         cursor = conn.cursor()
-        cursor.execute(query)
-        results = cursor.fetchall()
+        with trace.phase('execute'):
+            if params:
+                cursor.execute(query, params)
+            else:
+                cursor.execute(query)
+        with trace.phase('fetch'):
+            results = cursor.fetchall()
+        trace.finish()
         return results
     except Exception, ex:
+        trace.finish(str(ex))
         return ex
 
+#execute the supplied query and yield its rows as they are fetched,
+#batch_size at a time, so that only one batch is held in memory.
+#Unlike execute_query errors are raised.
+def iter_query(conn, query, batch_size=DEFAULT_BATCH_SIZE):
+    cursor = conn.cursor()
+    try:
+        cursor.arraysize = batch_size
+        cursor.execute(query)
+        while True:
+            rows = cursor.fetchmany(batch_size)
+            if not rows:
+                break
+            for row in rows:
+                yield row
+    finally:
+        cursor.close()
+
+#write the rows of query to out as they arrive, returns
+#(number of rows, seconds until the first row)
+def stream_query(conn, query, out=sys.stdout, batch_size=DEFAULT_BATCH_SIZE):
+    start = time.time()
+    first_row = None
+    count = 0
+    for row in iter_query(conn, query, batch_size):
+        if first_row is None:
+            first_row = time.time() - start
+        out.write("%s\n" % (tuple(row),))
+        count += 1
+        if count % batch_size == 0:
+            out.flush()
+    out.flush()
+    return count, first_row
+
+#the array typecode of a 64 bit integer, if this platform has one
+def _int64_typecode():
+    for typecode in ('q', 'l'):
+        try:
+            if array.array(typecode).itemsize == 8:
+                return typecode
+        except ValueError:
+            pass
+    #doubles hold integers exactly up to 2**53
+    return 'd'
+
+#typecodes of the buffers of numeric columns, both 8 bytes wide
+INT_TYPECODE = _int64_typecode()
+FLOAT_TYPECODE = 'd'
+
+def _column_typecode(type_code, sample):
+    if type_code in (int, long, bool):
+        return INT_TYPECODE
+    if type_code in (float, decimal.Decimal):
+        return FLOAT_TYPECODE
+    if type_code is None and sample is not None:
+        #no type from the driver, e.g. sqlite, go by the first value
+        return _column_typecode(type(sample), None)
+    return None
+
+#a read only sequence over the packed values of a memory mapped file,
+#used for spilled columns when NumPy is not available
+class MappedArray(object):
+    def __init__(self, mapped, typecode):
+        self._mmap = mapped
+        self.typecode = typecode
+        self.itemsize = struct.calcsize(typecode)
+        self._format = struct.Struct('=' + typecode)
+
+    def __len__(self):
+        return len(self._mmap) // self.itemsize
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError("MappedArray index out of range")
+        return self._format.unpack_from(self._mmap, index * self.itemsize)[0]
+
+    def __iter__(self):
+        for i in xrange(len(self)):
+            yield self._format.unpack_from(self._mmap, i * self.itemsize)[0]
+
+#One column of a columnar result. values is a NumPy array if NumPy is
+#available and an array.array (or a MappedArray when spilled) otherwise;
+#columns which are not numeric are plain lists. mask has a 1 for every NULL,
+#whose slot in values holds 0.
+class Column(object):
+    def __init__(self, name, typecode, values, mask):
+        self.name = name
+        self.typecode = typecode
+        self.values = values
+        self.mask = mask
+
+    def __len__(self):
+        return len(self.values)
+
+    def is_numeric(self):
+        return self.typecode is not None
+
+    def null_count(self):
+        if numpy is not None and self.is_numeric():
+            return int(numpy.count_nonzero(self.mask))
+        return sum(1 for null in self.mask if null)
+
+    #the values which are not NULL
+    def valid(self):
+        if numpy is not None and self.is_numeric():
+            return self.values[~self.mask]
+        return [value for value, null in izip(self.values, self.mask) \
+                if not null]
+
+    def sum(self):
+        valid = self.valid()
+        return valid.sum() if numpy is not None else sum(valid)
+
+    def min(self):
+        valid = self.valid()
+        if not len(valid):
+            return None
+        return valid.min() if numpy is not None else min(valid)
+
+    def max(self):
+        valid = self.valid()
+        if not len(valid):
+            return None
+        return valid.max() if numpy is not None else max(valid)
+
+    def mean(self):
+        valid = self.valid()
+        if not len(valid):
+            return None
+        return float(self.sum()) / len(valid)
+
+class ColumnarResult(object):
+    def __init__(self, columns, num_rows, spill_files=()):
+        self.columns = columns
+        self.num_rows = num_rows
+        self._by_name = dict((column.name, column) for column in columns)
+        self._spill_files = list(spill_files)
+
+    def __getitem__(self, name):
+        return self._by_name[name]
+
+    def names(self):
+        return [column.name for column in self.columns]
+
+    #release the memory maps of a spilled result
+    def close(self):
+        for mapped in self._spill_files:
+            mapped.close()
+        self._spill_files = []
+
+#accumulates one column batch by batch, in memory or in a spill file
+class _ColumnBuilder(object):
+    def __init__(self, name, typecode, spill_dir):
+        self.name = name
+        self.typecode = typecode
+        self.objects = []
+        self._spill = None
+        if typecode is None:
+            return
+        self.values = array.array(typecode)
+        self.mask = array.array('B')
+        if spill_dir:
+            self._spill = [tempfile.TemporaryFile(dir=spill_dir), \
+                           tempfile.TemporaryFile(dir=spill_dir)]
+
+    def extend(self, values):
+        if self.typecode is None:
+            self.objects.extend(values)
+            return
+        convert = float if self.typecode == FLOAT_TYPECODE else int
+        self.mask.extend([value is None for value in values])
+        self.values.extend([0 if value is None else convert(value) \
+                            for value in values])
+        if self._spill:
+            #only one batch is ever held in memory
+            self.values.tofile(self._spill[0])
+            self.mask.tofile(self._spill[1])
+            self.values = array.array(self.typecode)
+            self.mask = array.array('B')
+
+    def _map(self, spill_file, typecode, dtype, mapped_files):
+        spill_file.flush()
+        size = os.fstat(spill_file.fileno()).st_size
+        if size == 0:
+            spill_file.close()
+            if numpy is not None:
+                return numpy.zeros(0, dtype=dtype)
+            return array.array(typecode)
+        mapped = mmap.mmap(spill_file.fileno(), size, access=mmap.ACCESS_READ)
+        #the mapping keeps the data, the file is already unlinked
+        spill_file.close()
+        mapped_files.append(mapped)
+        if numpy is not None:
+            return numpy.frombuffer(mapped, dtype=dtype)
+        return MappedArray(mapped, typecode)
+
+    def build(self, mapped_files):
+        if self.typecode is None:
+            return Column(self.name, None, self.objects, \
+                          [value is None for value in self.objects])
+        if self._spill:
+            values = self._map(self._spill[0], self.typecode, \
+                               self.typecode, mapped_files)
+            mask = self._map(self._spill[1], 'B', 'bool', mapped_files)
+        elif numpy is not None:
+            values = numpy.frombuffer(self.values, dtype=self.typecode)
+            mask = numpy.frombuffer(self.mask, dtype='bool')
+        else:
+            values = self.values
+            mask = self.mask
+        return Column(self.name, self.typecode, values, mask)
+
+#execute query and return its result as a ColumnarResult: numeric
+#columns are filled into typed buffers straight from the fetchmany()
+#batches instead of keeping a Row object per row. With spill_dir the
+#numeric columns go to files in it and come back memory mapped, so the
+#result does not have to fit in memory. Decimals become floats.
+def fetch_columns(conn, query, params=None, batch_size=DEFAULT_BATCH_SIZE, \
+                  spill_dir=None):
+    cursor = conn.cursor()
+    builders = None
+    num_rows = 0
+    try:
+        cursor.arraysize = batch_size
+        if params:
+            cursor.execute(query, params)
+        else:
+            cursor.execute(query)
+        description = cursor.description or []
+        while True:
+            rows = cursor.fetchmany(batch_size)
+            if not rows:
+                break
+            columns = zip(*rows)
+            if builders is None:
+                builders = []
+                for i, desc in enumerate(description):
+                    sample = None
+                    for value in columns[i]:
+                        if value is not None:
+                            sample = value
+                            break
+                    builders.append(_ColumnBuilder( \
+                            desc[0], _column_typecode(desc[1], sample), \
+                            spill_dir))
+            for builder, values in zip(builders, columns):
+                builder.extend(values)
+            num_rows += len(rows)
+        if builders is None:
+            builders = [_ColumnBuilder(desc[0], \
+                                       _column_typecode(desc[1], None), None) \
+                        for desc in description]
+    finally:
+        cursor.close()
+    mapped_files = []
+    columns = [builder.build(mapped_files) for builder in builders]
+    return ColumnarResult(columns, num_rows, mapped_files)
+
+#print a summary of every column of a columnar result
+def print_columns(result):
+    print "Rows: ", result.num_rows
+    for column in result.columns:
+        if column.is_numeric():
+            print "%-30s %-6s nulls %-8d sum %-14s min %-12s max %s" \
+                  % (column.name, column.typecode, column.null_count(), \
+                     column.sum(), column.min(), column.max())
+        else:
+            print "%-30s %-6s nulls %d" \
+                  % (column.name, "object", column.null_count())
+
+#split SQL text into the batches a line with only GO ends, outside of
+#literals, identifiers and comments, the way sqlcmd does. A batch is sent
+#as it is, so it may hold anything the server takes in one batch,
+#BEGIN ... END blocks and CREATE PROCEDURE included. Batches with nothing
+#but comments and white space are dropped. Returns a list of batch texts.
+def split_batches(text):
+    batches = []
+    current = []
+    has_code = [False]
+    i = 0
+    n = len(text)
+    def end_batch():
+        batch = "".join(current).strip()
+        del current[:]
+        if batch and has_code[0]:
+            batches.append(batch)
+        has_code[0] = False
+    while i < n:
+        ch = text[i]
+        if ch in "'\"[":
+            close = ']' if ch == '[' else ch
+            j = i + 1
+            while j < n:
+                if text[j] == close:
+                    #a doubled quote is an escaped one
+                    if j + 1 < n and text[j + 1] == close:
+                        j += 2
+                        continue
+                    break
+                j += 1
+            current.append(text[i:j + 1])
+            has_code[0] = True
+            i = j + 1
+        elif text.startswith('--', i):
+            j = text.find('\n', i)
+            j = n if j < 0 else j
+            current.append(text[i:j])
+            i = j
+        elif text.startswith('/*', i):
+            j = text.find('*/', i + 2)
+            j = n if j < 0 else j + 2
+            current.append(text[i:j])
+            i = j
+        elif ch == '\n' or i == 0:
+            #is the next line a GO?
+            start = i + 1 if ch == '\n' else i
+            j = text.find('\n', start)
+            j = n if j < 0 else j
+            if text[start:j].strip().upper() == 'GO':
+                end_batch()
+                i = j
+            else:
+                current.append(ch)
+                if not ch.isspace():
+                    has_code[0] = True
+                i += 1
+        else:
+            current.append(ch)
+            if not ch.isspace():
+                has_code[0] = True
+            i += 1
+    end_batch()
+    return batches
+
+#what one batch returned: entries has, in the order of the statements
+#of the batch, a (columns, rows) pair per result set and the row count
+#(an int) of each statement without one. Also the seconds it took and
+#the error, if it failed
+class BatchResult(object):
+    def __init__(self, index, batch):
+        self.index = index
+        self.batch = batch
+        self.entries = []
+        self.elapsed = None
+        self.error = None
+
+    def __repr__(self):
+        return "BatchResult(%d, %d entries, %s)" \
+               % (self.index, len(self.entries), \
+                  "error" if self.error else "ok")
+
+#the result set the cursor is on, or the row count of a statement
+#without one
+def _collect(cursor, result):
+    if cursor.description:
+        result.entries.append(([d[0] for d in cursor.description], \
+                               cursor.fetchall()))
+    elif cursor.rowcount >= 0:
+        result.entries.append(cursor.rowcount)
+
+#send a batch in one round trip and walk all its result sets. A runtime
+#error is recorded, the first one only, and the walk goes on with the rest
+#of the batch if the server did.
+def _run_batch(cursor, result):
+    start = time.time()
+    try:
+        cursor.execute(result.batch)
+        more = True
+    except Exception, ex:
+        result.error = ex
+        more = False
+    while more:
+        try:
+            _collect(cursor, result)
+            more = cursor.nextset()
+        except Exception, ex:
+            result.error = result.error or ex
+            try:
+                more = cursor.nextset()
+            except Exception:
+                more = False
+    result.elapsed = time.time() - start
+
+#run batches as returned by split_batches(), one round trip each, and
+#return a BatchResult per batch, in order. As with GO in sqlcmd, a batch
+#which fails does not stop the ones after it.
+def execute_batches(conn, batches):
+    results = []
+    cursor = conn.cursor()
+    try:
+        for index, batch in enumerate(batches):
+            result = BatchResult(index, batch)
+            results.append(result)
+            _run_batch(cursor, result)
+    finally:
+        cursor.close()
+    return results
+
+def print_batch_results(results):
+    for result in results:
+        print "Batch %d: %s" % (result.index + 1, \
+                                result.batch.splitlines()[0][:60])
+        if result.elapsed is not None:
+            print "Elapsed: %.3f ms" % (result.elapsed * 1000)
+        if result.error:
+            print "ERROR: ", result.error
+        for entry in result.entries:
+            if isinstance(entry, tuple):
+                print "Columns: ", entry[0]
+                print "Results:\n", entry[1]
+            else:
+                print "Rows affected: ", entry
+
+#quote a possibly schema qualified name, dbo.samples -> [dbo].[samples]
+def quote_name(name):
+    parts = []
+    for part in name.split('.'):
+        if part.startswith('[') and part.endswith(']'):
+            parts.append(part)
+        else:
+            parts.append('[%s]' % part.replace(']', ']]'))
+    return '.'.join(parts)
+
+#is the SQL_DRIVER_NAME driver the Microsoft ODBC driver? It is
+#libmsodbcsql-17.10.so.5.1 on Linux and msodbcsql17.dll on Windows
+def is_msodbcsql_driver(driver):
+    return 'msodbcsql' in (driver or '').lower()
+
+#fast_executemany binds a whole batch as parameter arrays, which only the
+#Microsoft ODBC driver does reliably, FreeTDS does not
+def supports_fast_executemany(conn, cursor):
+    if not hasattr(cursor, 'fast_executemany') or pyodbc is None:
+        return False
+    try:
+        driver = conn.getinfo(pyodbc.SQL_DRIVER_NAME)
+    except Exception:
+        return False
+    return is_msodbcsql_driver(driver)
+
+#insert rows, an iterable of sequences in the order of columns, into table
+#with a parameterized executemany() per batch_size rows, committing every
+#commit_every rows and at the end. fast_executemany is used if fast is
+#True, or if it is None and the driver supports it. Only one batch is held
+#in memory. Returns (number of rows, seconds).
+def bulk_insert(conn, table, columns, rows, batch_size=INSERT_BATCH_SIZE, \
+                commit_every=INSERT_COMMIT_EVERY, fast=None):
+    query = "INSERT INTO %s (%s) VALUES (%s)" \
+            % (quote_name(table), ", ".join(quote_name(c) for c in columns), \
+               ", ".join("?" * len(columns)))
+    cursor = conn.cursor()
+    start = time.time()
+    count = 0
+    uncommitted = 0
+    try:
+        if fast is None:
+            fast = supports_fast_executemany(conn, cursor)
+        if fast:
+            cursor.fast_executemany = True
+        rows = iter(rows)
+        while True:
+            batch = list(islice(rows, batch_size))
+            if not batch:
+                break
+            cursor.executemany(query, batch)
+            count += len(batch)
+            uncommitted += len(batch)
+            if uncommitted >= commit_every:
+                conn.commit()
+                uncommitted = 0
+        if uncommitted:
+            conn.commit()
+    except:
+        #whatever was committed stays, the rest is rolled back
+        conn.rollback()
+        raise
+    finally:
+        cursor.close()
+    return count, time.time() - start
+
+#returns (columns, rows) of a CSV file whose first line has the column
+#names. Empty fields are NULL unless empty_is_null is False.
+def read_csv_rows(path, empty_is_null=True):
+    handle = open(path, 'rb')
+    reader = csv.reader(handle)
+    try:
+        columns = reader.next()
+    except StopIteration:
+        handle.close()
+        return [], iter([])
+    def rows():
+        try:
+            for row in reader:
+                if empty_is_null:
+                    row = [None if value == '' else value for value in row]
+                yield row
+        finally:
+            handle.close()
+    return columns, rows()
+
+#returns (columns, rows) of a file with a JSON object per line. The
+#columns are those of the first object unless given, missing keys are NULL.
+def read_jsonl_rows(path, columns=None):
+    handle = open(path)
+    lines = (line for line in handle if line.strip())
+    try:
+        first = json.loads(lines.next(), object_pairs_hook=OrderedDict)
+    except StopIteration:
+        handle.close()
+        return columns or [], iter([])
+    if columns is None:
+        columns = first.keys()
+    def rows():
+        try:
+            yield [first.get(column) for column in columns]
+            for line in lines:
+                record = json.loads(line)
+                yield [record.get(column) for column in columns]
+        finally:
+            handle.close()
+    return columns, rows()
+
+#outcome of probing one target, status is one of
+#'ok', 'refused', 'timeout' or 'error'
+class ProbeResult(object):
+    def __init__(self, ip, port, status, latency, error=None):
+        self.ip = ip
+        self.port = port
+        self.status = status
+        self.latency = latency
+        self.error = error
+
+    def __repr__(self):
+        return "ProbeResult(%s:%s, %s, %.3f)" \
+               % (self.ip, self.port, self.status, self.latency)
+
+def _connect_status(err):
+    if err == 0:
+        return 'ok'
+    if err == errno.ECONNREFUSED:
+        return 'refused'
+    if err == errno.ETIMEDOUT:
+        return 'timeout'
+    return 'error'
+
+#start a non blocking connect, returns (socket, error) where error is
+#None while the connect is in progress
+def _start_connect(ip, port):
+    sock = None
+    try:
+        family, socktype, proto, _name, sockaddr = \
+                socket.getaddrinfo(ip, port, 0, socket.SOCK_STREAM)[0]
+        sock = socket.socket(family, socktype, proto)
+        sock.setblocking(0)
+        err = sock.connect_ex(sockaddr)
+    except (socket.error, socket.gaierror), ex:
+        if sock:
+            sock.close()
+        return None, ex.args[0] if ex.args else errno.EINVAL
+    if err in (errno.EINPROGRESS, errno.EWOULDBLOCK, errno.EALREADY):
+        return sock, None
+    return sock, err
+
+#check whether a TCP connect to each (ip, port) of targets succeeds, with
+#at most concurrency connects in flight and timeout seconds per target.
+#Returns a ProbeResult per target, in the order of targets.
+def probe_endpoints(targets, timeout=PROBE_TIMEOUT, \
+                    concurrency=PROBE_CONCURRENCY):
+    results = [None] * len(targets)
+    pending = deque(enumerate(targets))
+    inflight = {}   #fd -> (index, socket, start time)
+    poller = select.poll()
+
+    def finish(fd, err, now):
+        index, sock, start = inflight.pop(fd)
+        poller.unregister(fd)
+        sock.close()
+        ip, port = targets[index]
+        status = _connect_status(err)
+        results[index] = ProbeResult(ip, port, status, now - start, \
+                None if status == 'ok' else errno.errorcode.get(err, err))
+
+    while pending or inflight:
+        while pending and len(inflight) < concurrency:
+            index, (ip, port) = pending.popleft()
+            start = time.time()
+            sock, err = _start_connect(ip, int(port))
+            if err is not None:
+                if sock:
+                    sock.close()
+                status = _connect_status(err)
+                results[index] = ProbeResult(ip, port, status, \
+                        time.time() - start, errno.errorcode.get(err, err))
+                continue
+            inflight[sock.fileno()] = (index, sock, start)
+            poller.register(sock.fileno(), select.POLLOUT)
+        if not inflight:
+            continue
+
+        #sleep until the oldest connect times out at the latest
+        oldest = min(start for _index, _sock, start in inflight.values())
+        wait = max(oldest + timeout - time.time(), 0)
+        try:
+            events = poller.poll(wait * 1000)
+        except select.error, ex:
+            if ex.args[0] != errno.EINTR:
+                raise
+            events = []
+        now = time.time()
+        for fd, _event in events:
+            sock = inflight[fd][1]
+            finish(fd, sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR), \
+                   now)
+        for fd, (_index, _sock, start) in inflight.items():
+            if now - start >= timeout:
+                finish(fd, errno.ETIMEDOUT, now)
+    return results
+
+#parse "ip port" or "ip:port" (or "[ipv6]:port"), returns (ip, port)
+def parse_target(text):
+    text = text.strip()
+    if ' ' in text or '\t' in text:
+        ip, port = text.split()
+    elif text.startswith('['):
+        ip, port = text[1:].split(']:')
+    else:
+        ip, port = text.rsplit(':', 1)
+    return ip, int(port)
+
+#read targets from a file, one per line, # starts a comment
+def read_targets_file(path):
+    targets = []
+    for line in open(path):
+        line = line.split('#', 1)[0].strip()
+        if line:
+            targets.append(parse_target(line))
+    return targets
+
+#run query, which returns (ip, port) rows, against every sqlite file
+#matching the glob pattern and return the distinct targets
+def read_targets_sqlite(pattern, query):
+    targets = []
+    seen = set()
+    for db_name in sorted(glob.glob(pattern)):
+        conn = sqlite3.connect(db_name)
+        try:
+            for ip, port in conn.execute(query):
+                target = (str(ip), int(port))
+                if target not in seen:
+                    seen.add(target)
+                    targets.append(target)
+        except sqlite3.Error, ex:
+            print "ERROR: Failed to read targets from %s: %s" % (db_name, ex)
+        finally:
+            conn.close()
+    return targets
+
+def probe_main(targets, timeout, concurrency):
+    if not targets:
+        print "Error: No targets to probe"
+        return
+    start = time.time()
+    results = probe_endpoints(targets, timeout, concurrency)
+    elapsed = time.time() - start
+    for res in results:
+        print "%-40s %-8s %8.1f ms %s" % ("%s:%s" % (res.ip, res.port), \
+                                          res.status, res.latency * 1000, \
+                                          res.error or "")
+    ok = len([res for res in results if res.status == 'ok'])
+    print "INFO: %d of %d targets reachable, probed in %.3f seconds" \
+          % (ok, len(results), elapsed)
+
+def usage():
+    print "Usage: python sqlserver_connect.py [options]\
+ DB_IP DB_PORT Username \'Password\' \"QUERY\""
+    print "       python sqlserver_connect.py --file FILE [options]\
+ DB_IP DB_PORT Username \'Password\'"
+    print "       python sqlserver_connect.py --load FILE --table TABLE [options]\
+ DB_IP DB_PORT Username \'Password\'"
+    print "       python sqlserver_connect.py --probe [probe options]\
+ [IP:PORT ...]"
+    print """
+Options:
+    -s, --stream          : Print the rows as they arrive instead of
+                            fetching them all first
+    -b, --batch-size N    : Rows fetched per round trip when streaming
+                            or fetching columns (default %d)
+    -C, --columnar        : Fetch into typed per column buffers and print
+                            a summary of each column
+    --spill DIR           : With --columnar, keep numeric columns in
+                            memory mapped files in DIR
+    -F, --file FILE       : Run the statements in FILE, one round trip
+                            per batch, the batches separated by GO lines
+    -T, --trace FILE      : Write the timings of the connect and query
+                            phases to FILE as JSON lines ('-' for stdout)
+                            and print a summary of them
+    -h, --help            : Display help
+
+Load options:
+    -L, --load FILE       : Insert the rows of FILE, a CSV file with a
+                            header line or a JSON object per line
+    --table TABLE         : Table to insert into
+    --format FORMAT       : csv or jsonl (default from the file extension)
+    --insert-batch N      : Rows per executemany (default %d)
+    --commit-every N      : Rows per commit (default %d)
+
+Probe options:
+    -p, --probe           : Only check that the targets accept TCP
+                            connections, all of them at once
+    -f, --targets FILE    : Read targets from FILE, one IP:PORT per line
+    --sqlite GLOB         : Read targets from the sqlite files matching GLOB
+    --target-query SQL    : Query returning (ip, port) rows for --sqlite
+    -t, --timeout SECONDS : Connect timeout per target (default %s)
+    -c, --concurrency N   : Connects in flight at most (default %d)""" \
+          % (DEFAULT_BATCH_SIZE, INSERT_BATCH_SIZE, INSERT_COMMIT_EVERY, \
+             PROBE_TIMEOUT, PROBE_CONCURRENCY)
+
 def main():
-    if len(sys.argv) <> 6:
-        print "Error(%d): Please use the script as follows" % len(sys.argv)
-        print "Usage: python sqlserver_connect.py\
-         DB_IP DB_PORT Username \'Password\' \"QUERY\""
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], 'hsb:pf:t:c:CF:L:T:', \
+                                   ["help", "stream", "batch-size=", \
+                                    "columnar", "spill=", "file=", \
+                                    "load=", "table=", "format=", \
+                                    "insert-batch=", "commit-every=", \
+                                    "probe", "targets=", "sqlite=", \
+                                    "target-query=", "timeout=", \
+                                    "concurrency=", "trace="])
+    except getopt.GetoptError, ex:
+        print "Error: %s" % ex
+        usage()
+        return
+    stream = False
+    batch_size = DEFAULT_BATCH_SIZE
+    columnar = False
+    spill_dir = None
+    statements_file = None
+    load_file = table = load_format = None
+    insert_batch = INSERT_BATCH_SIZE
+    commit_every = INSERT_COMMIT_EVERY
+    probe = False
+    targets_file = sqlite_pattern = target_query = None
+    timeout = PROBE_TIMEOUT
+    concurrency = PROBE_CONCURRENCY
+    trace_file = None
+    for opt, value in opts:
+        if opt in ('-h', '--help'):
+            usage()
+            return
+        elif opt in ('-s', '--stream'):
+            stream = True
+        elif opt in ('-b', '--batch-size'):
+            batch_size = int(value)
+        elif opt in ('-C', '--columnar'):
+            columnar = True
+        elif opt == '--spill':
+            spill_dir = value
+        elif opt in ('-F', '--file'):
+            statements_file = value
+        elif opt in ('-L', '--load'):
+            load_file = value
+        elif opt == '--table':
+            table = value
+        elif opt == '--format':
+            load_format = value
+        elif opt == '--insert-batch':
+            insert_batch = int(value)
+        elif opt == '--commit-every':
+            commit_every = int(value)
+        elif opt in ('-p', '--probe'):
+            probe = True
+        elif opt in ('-f', '--targets'):
+            targets_file = value
+        elif opt == '--sqlite':
+            sqlite_pattern = value
+        elif opt == '--target-query':
+            target_query = value
+        elif opt in ('-t', '--timeout'):
+            timeout = float(value)
+        elif opt in ('-c', '--concurrency'):
+            concurrency = int(value)
+        elif opt in ('-T', '--trace'):
+            trace_file = value
+    if probe:
+        try:
+            targets = [parse_target(arg) for arg in args]
+            if targets_file:
+                targets.extend(read_targets_file(targets_file))
+        except ValueError, ex:
+            print "Error: Invalid target, expected IP:PORT: %s" % ex
+            return
+        if sqlite_pattern:
+            if not target_query:
+                print "Error: --sqlite needs --target-query"
+                return
+            targets.extend(read_targets_sqlite(sqlite_pattern, target_query))
+        probe_main(targets, timeout, concurrency)
+        return
+    if load_file:
+        if not table:
+            print "Error: --load needs --table"
+            return
+        if load_format is None:
+            load_format = 'jsonl' if load_file.endswith(('.jsonl', '.json')) \
+                          else 'csv'
+        if load_format not in ('csv', 'jsonl'):
+            print "Error: Unknown format %s, use csv or jsonl" % load_format
+            return
+    if len(args) <> (4 if statements_file or load_file else 5):
+        print "Error(%d): Please use the script as follows" % len(args)
+        usage()
+        return
+    ip = args[0]
+    port = int(args[1])
+    username = args[2]
+    password = args[3]
+    if statements_file:
+        batches = split_batches(open(statements_file).read())
+    elif load_file:
+        if load_format == 'csv':
+            columns, rows = read_csv_rows(load_file)
+        else:
+            columns, rows = read_jsonl_rows(load_file)
+    else:
+        query = args[4]
+    tracer = summary = trace_out = None
+    if trace_file:
+        trace_out = sys.stdout if trace_file == '-' else open(trace_file, 'a')
+        summary = TraceSummary()
+        tracer = Tracer(JsonLinesSink(trace_out), summary)
+    conn = get_connection(ip, port, username, password, tracer=tracer)
+    if conn is None:
+        if summary is not None:
+            if trace_out is not sys.stdout:
+                trace_out.close()
+            print_trace_summary(summary)
         return
-    ip = sys.argv[1]
-    port = int(sys.argv[2])
-    username = sys.argv[3]
-    password = sys.argv[4]
-    query = sys.argv[5]
-    conn = get_connection(ip, port, username, password)
     start_time = datetime.now()
-    print "Results:\n", execute_query(conn, query)
+    if statements_file:
+        print_batch_results(execute_batches(conn, batches))
+    elif load_file:
+        count, elapsed = bulk_insert(conn, table, columns, rows, \
+                                     insert_batch, commit_every)
+        print "INFO: Inserted %d rows into %s in %.3f seconds, %.1f rows/s" \
+              % (count, table, elapsed, count / elapsed if elapsed else 0)
+    elif stream:
+        print "Results:"
+        count, first_row = stream_query(conn, query, batch_size=batch_size)
+        print "Rows: ", count
+        if first_row is not None:
+            print "First row after: %.3f seconds" % first_row
+    elif columnar:
+        result = fetch_columns(conn, query, batch_size=batch_size, \
+                               spill_dir=spill_dir)
+        print_columns(result)
+        result.close()
+    else:
+        print "Results:\n", execute_query(conn, query, tracer=tracer)
     end_time = datetime.now()
     print "Started at: ", start_time
     print "Finished at: ", end_time
     conn.close()
+    if summary is not None:
+        if trace_out is not sys.stdout:
+            trace_out.close()
+        print_trace_summary(summary)
 
 if __name__ == '__main__':
     main()